@@ -0,0 +1,192 @@
+r"""Accountant results shared across processes through one SQLite file.
+
+The runs of a sweep mostly share (N, batch_size, noise multiplier, delta),
+and every one of them recomputes the same epsilons at every epoch; the
+moments accountant alone takes tens of milliseconds per call. An
+AccountantCache stores each result under a canonical key of the accountant
+and its arguments, in an SQLite database in WAL mode: any number of
+processes read concurrently and writers are serialized by SQLite, with a
+busy timeout instead of errors. The file holds at most max_entries results
+and evicts the least recently used ones; hits, misses and evictions are
+counted both per process and in the file. Keys carry a version of the
+accountant: a digest of its module and the accountant modules' sources
+and the tensorflow_privacy release, whose conversion from RDP changed
+across releases. An edited accountant or an upgrade misses the old
+entries, which age out of the file.
+
+The tutorials call cached_epsilon, cached_epsP and cached_epsU, which go
+through the file named by $GDP_ACCOUNTANT_CACHE when it is set and are the
+plain accountants otherwise; privacy_search.py sets it for its trials. The
+GDP mu (compute_muP, compute_muU) is a closed form that costs less than a
+lookup and is not cached.
+
+Example:
+  cache = AccountantCache('accountant.sqlite')
+  cache.call(compute_epsP, 15, 1.3, 60000, 256, 1e-5)
+  cache.stats()
+"""
+
+import contextlib
+import functools
+import hashlib
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+
+from gdp_accountant import *
+
+ACCOUNTANT_CACHE_ENV='GDP_ACCOUNTANT_CACHE'
+ACCOUNTANT_CACHE_ENTRIES=100000
+
+_SCHEMA='''
+CREATE TABLE IF NOT EXISTS results(key TEXT PRIMARY KEY,value BLOB,used REAL);
+CREATE INDEX IF NOT EXISTS results_used ON results(used);
+CREATE TABLE IF NOT EXISTS counters(name TEXT PRIMARY KEY,count INTEGER);
+INSERT OR IGNORE INTO counters VALUES ('hits',0),('misses',0),('evictions',0);
+'''
+_MISSING=object()
+# The modules every accountant builds on
+_ACCOUNTANT_MODULES=('gdp_accountant','pld_accountant','edgeworth_accountant')
+
+
+# Canonical key of fn(*args) at the current version of fn; numbers are
+# compared as floats, so that N=60000 and N=60000.0 share an entry
+def cache_key(fn,*args):
+    return '%s.%s@%s(%s)' % (fn.__module__,fn.__name__,accountant_version(fn.__module__),
+                             ','.join(map(_canonical,args)))
+
+def _canonical(a):
+    return repr(a) if isinstance(a,str) else repr(float(a))
+
+# Digest of the sources of module and the accountant modules, and of the
+# tensorflow_privacy release
+@functools.lru_cache(maxsize=None)
+def accountant_version(module):
+    h=hashlib.sha256()
+    for name in sorted(set(_ACCOUNTANT_MODULES+(module,))):
+        path=getattr(sys.modules.get(name),'__file__',None)
+        if path is not None:
+            with open(path,'rb') as f:
+                h.update(name.encode()+f.read())
+    h.update(repr(tensorflow_privacy_version()).encode())
+    return h.hexdigest()[:16]
+
+
+class AccountantCache(object):
+    """LRU store of accountant results in an SQLite file, safe across processes."""
+
+    def __init__(self,path,max_entries=ACCOUNTANT_CACHE_ENTRIES):
+        self.path=path
+        self.max_entries=max_entries
+        # Counters of this process; stats() also reports the file's
+        self.hits=0
+        self.misses=0
+        self._lock=threading.Lock()
+        self._db=None
+        self._pid=None
+
+    def call(self,fn,*args):
+        """fn(*args), computed only if no process has cached it yet."""
+        key=cache_key(fn,*args)
+        value=self.get(key,_MISSING)
+        if value is _MISSING:
+            value=fn(*args)
+            self.put(key,value)
+        return value
+
+    def get(self,key,default=None):
+        """Cached value of key, marked as recently used, or default."""
+        with self._transaction() as db:
+            row=db.execute('SELECT value FROM results WHERE key=?',(key,)).fetchone()
+            if row is None:
+                self.misses+=1
+                db.execute("UPDATE counters SET count=count+1 WHERE name='misses'")
+                return default
+            self.hits+=1
+            db.execute('UPDATE results SET used=? WHERE key=?',(time.time(),key))
+            db.execute("UPDATE counters SET count=count+1 WHERE name='hits'")
+        return pickle.loads(row[0])
+
+    def put(self,key,value):
+        """Stores value under key, evicting the least recently used entries."""
+        blob=pickle.dumps(value,protocol=pickle.HIGHEST_PROTOCOL)
+        with self._transaction() as db:
+            db.execute('INSERT OR REPLACE INTO results VALUES (?,?,?)',(key,blob,time.time()))
+            excess=db.execute('SELECT COUNT(*) FROM results').fetchone()[0]-self.max_entries
+            if excess>0:
+                db.execute('DELETE FROM results WHERE key IN '
+                           '(SELECT key FROM results ORDER BY used LIMIT ?)',(excess,))
+                db.execute("UPDATE counters SET count=count+? WHERE name='evictions'",(excess,))
+
+    def stats(self):
+        """Hits and misses of this process, and the totals kept in the file."""
+        with self._transaction() as db:
+            totals=dict(db.execute('SELECT name,count FROM counters'))
+            entries=db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        return {'hits':self.hits,'misses':self.misses,'total_hits':totals['hits'],
+                'total_misses':totals['misses'],'evictions':totals['evictions'],
+                'entries':entries}
+
+    def clear(self):
+        """Drops every entry and resets the counters in the file."""
+        with self._transaction() as db:
+            db.execute('DELETE FROM results')
+            db.execute('UPDATE counters SET count=0')
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+            self._db=None
+            self._pid=None
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            db=self._connect()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    # One connection per process: a forked child opens its own
+    def _connect(self):
+        if self._pid!=os.getpid():
+            db=sqlite3.connect(self.path,timeout=60,isolation_level=None,
+                               check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(_SCHEMA)
+            self._db,self._pid=db,os.getpid()
+        return self._db
+
+
+_default=None
+
+# Cache of the file named by $GDP_ACCOUNTANT_CACHE, None if it is not set
+def default_cache():
+    global _default
+    path=os.environ.get(ACCOUNTANT_CACHE_ENV)
+    if not path:
+        return None
+    if _default is None or _default.path!=path:
+        _default=AccountantCache(path)
+    return _default
+
+# fn going through default_cache() when there is one
+def cached(fn):
+    @functools.wraps(fn)
+    def wrapper(*args):
+        cache=default_cache()
+        return fn(*args) if cache is None else cache.call(fn,*args)
+    return wrapper
+
+cached_epsilon=cached(compute_epsilon)
+cached_epsP=cached(compute_epsP)
+cached_epsU=cached(compute_epsU)
@@ -5,6 +5,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+
 import numpy as np
 import tensorflow as tf
 
@@ -12,7 +14,13 @@ from absl import app
 from absl import flags
 
 from tensorflow_privacy.privacy.optimizers import dp_optimizer
+from dp_noise import *
+from accountant_cache import *
 from gdp_accountant import *
+from ghost_clipping import *
+from input_pipeline import *
+from streaming_eval import *
+from training_state import *
 
 #### FLAGS
 flags.DEFINE_boolean('dpsgd', True, 'If True, train with DP-SGD. If False, '
@@ -24,23 +32,32 @@ flags.DEFINE_float('l2_norm_clip', 5, 'Clipping norm')
 flags.DEFINE_integer('epochs', 1, 'Number of epochs')
 flags.DEFINE_string('model_dir', None, 'Model directory')
 flags.DEFINE_float('max_mu', 2, 'Maximum mu before termination')
+flags.DEFINE_boolean('async_eval', False, 'Evaluate each epoch in the '
+                     'background while the next one trains (keeps '
+                     'every checkpoint)')
 flags.DEFINE_string('subsampling', 'Poisson', 'Poisson or Uniform subsampling')
 flags.DEFINE_integer('batch_size', 256, 'Batch size')
 flags.DEFINE_integer(
     'microbatches', 256, 'Number of microbatches '
     '(must evenly divide batch_size)')
+flags.DEFINE_integer('seed', 0, 'Run seed of the initialization, shuffling '
+                     'and DP noise streams')
+flags.DEFINE_boolean('sparse', False, 'If True, feed the features as sparse '
+                     'rows and clip with ghost norms (microbatches unused)')
 
 FLAGS = flags.FLAGS
 
-np.random.seed(0)
-tf.compat.v1.set_random_seed(0)
-
 def nn_model_fn(features, labels, mode):
 
-  # Define CNN architecture using tf.keras.layers.
-  input_layer = tf.reshape(features['x'], [-1,123])
-  y = tf.keras.layers.Dense(16,activation='relu').apply(input_layer)
-  logits = tf.keras.layers.Dense(2).apply(y)
+  if FLAGS.sparse:
+    # The same network over SparseTensor rows, recorded for ghost clipping.
+    y, first = ghost_dense(features['x'], 16, tf.nn.relu)
+    logits, second = ghost_dense(y, 2)
+  else:
+    # Define CNN architecture using tf.keras.layers.
+    input_layer = tf.reshape(features['x'], [-1,123])
+    y = tf.keras.layers.Dense(16,activation='relu').apply(input_layer)
+    logits = tf.keras.layers.Dense(2).apply(y)
 
   # Calculate loss as a vector (to support microbatches in DP-SGD).
   vector_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
@@ -51,14 +68,23 @@ def nn_model_fn(features, labels, mode):
   # Configure the training op (for TRAIN mode).
   if mode == tf.estimator.ModeKeys.TRAIN:
 
-    if FLAGS.dpsgd:
+    if FLAGS.dpsgd and FLAGS.sparse:
+      # Per-example norms from the sparse inputs, without per-example
+      # gradients.
+      optimizer = GhostClippingOptimizer(
+          tf.compat.v1.train.GradientDescentOptimizer(
+              learning_rate=FLAGS.learning_rate),
+          [first, second], FLAGS.l2_norm_clip, FLAGS.noise_multiplier,
+          FLAGS.seed)
+      opt_loss = vector_loss
+    elif FLAGS.dpsgd:
       # Use DP version of GradientDescentOptimizer. Other optimizers are
       # available in dp_optimizer. Most optimizers inheriting from
       # tf.train.Optimizer should be wrappable in differentially private
       # counterparts by calling dp_optimizer.optimizer_from_args().
-      optimizer = dp_optimizer.DPGradientDescentGaussianOptimizer(
-          l2_norm_clip=FLAGS.l2_norm_clip,
-          noise_multiplier=FLAGS.noise_multiplier,
+      optimizer = dp_optimizer.DPGradientDescentOptimizer(
+          stateless_gaussian_query(FLAGS.l2_norm_clip, FLAGS.noise_multiplier,
+                                   FLAGS.seed),
           num_microbatches=FLAGS.microbatches,
           learning_rate=FLAGS.learning_rate)
       opt_loss = vector_loss
@@ -89,81 +115,132 @@ def nn_model_fn(features, labels, mode):
                                       eval_metric_ops=eval_metric_ops)
 
 
-def load_adult():
-  """Loads ADULT a2a as in LIBSVM and preprocesses to combine training and validation data."""
-  """https://www.csie.ntu.edu.tw/~cjlin/libsvmtools/datasets/binary.html"""  
+def convert_adult(csv_path='data/adult.csv', path='data/adult.npz'):
+  """Converts ADULT a2a as in LIBSVM to a bit-packed save_table file."""
+  """https://www.csie.ntu.edu.tw/~cjlin/libsvmtools/datasets/binary.html"""
   import pandas as pd
-  from sklearn.model_selection import KFold
 
-  X=pd.read_csv("data/adult.csv")
-  kf = KFold(n_splits=10)
-  for train_index, test_index in kf.split(X):
-      train, test = X.iloc[train_index,:], X.iloc[test_index,:]
-  train_data = train.iloc[:,range(X.shape[1]-1)].values.astype('float32')
-  test_data = test.iloc[:,range(X.shape[1]-1)].values.astype('float32')
+  X = pd.read_csv(csv_path).values
+  # The last tenth of the rows is the test set, i.e. the last fold of
+  # KFold(n_splits=10) which the original loader kept.
+  n = len(X)
+  save_table(path, X[:, :-1], (X[:, -1] == 1).astype(np.uint8),
+             {'train': np.arange(n - n // 10), 'test': np.arange(n - n // 10, n)})
+
 
-  train_labels = (train.iloc[:,X.shape[1]-1]==1).astype('int32').values
-  test_labels = (test.iloc[:,X.shape[1]-1]==1).astype('int32').values
+def load_adult(path='data/adult.npz', sparse=False):
+  """Loads the train and test splits of ADULT a2a.
 
-  return train_data, train_labels, test_data, test_labels
+  Each split is load_table's (bit-packed rows, labels, unpacking map_fn) or,
+  with sparse, load_table_csr's (CSR rows, labels, number of features).
+  """
+  if not os.path.exists(path):
+    convert_adult(path=path)
+  load = load_table_csr if sparse else load_table
+  return load(path, 'train'), load(path, 'test')
+
+
+def adult_input_fn(split, **kwargs):
+  """input_fn of a load_adult split, dense or sparse as loaded."""
+  if FLAGS.sparse:
+    csr, labels, num_features = split
+    return csr_input_fn(csr, labels, num_features, **kwargs)
+  packed, labels, unpack = split
+  return array_input_fn(x={'x': packed}, y=labels, map_fn=unpack, **kwargs)
 
 
 def main(unused_argv):
   tf.compat.v1.logging.set_verbosity(3)
 
   # Load training and test data.
-  train_data, train_labels, test_data, test_labels = load_adult()
+  train, test = load_adult(sparse=FLAGS.sparse)
 
   # Instantiate the tf.Estimator.
-  adult_classifier = tf.estimator.Estimator(model_fn=nn_model_fn,
-                                            model_dir=FLAGS.model_dir)
+  adult_classifier = tf.estimator.Estimator(
+      model_fn=nn_model_fn,
+      model_dir=FLAGS.model_dir,
+      # --async_eval keeps every checkpoint: an evaluation lagging behind
+      # training must still find its epoch's
+      config=tf.estimator.RunConfig(
+          tf_random_seed=FLAGS.seed,
+          keep_checkpoint_max=None if FLAGS.async_eval else 5))
 
   # Create tf.Estimator input functions for the training and test data.
-  eval_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-      x={'x': test_data},
-      y=test_labels,
-      num_epochs=1,
-      shuffle=False)
-  train_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-      x={'x': train_data},
-      y=train_labels,
-      batch_size=FLAGS.batch_size,
-      num_epochs=FLAGS.epochs,
-      shuffle=True)
+  eval_input_fn = adult_input_fn(test, num_epochs=1, shuffle=False)
 
-  # Training loop.
+  # Resume after the epochs and steps of the last checkpoint, if any.
   steps_per_epoch = 29305 // 256
-  test_accuracy_list = []
-  for epoch in range(1, FLAGS.epochs + 1):
-    np.random.seed(epoch)
-
-    # Train the model for one step.
-    adult_classifier.train(input_fn=train_input_fn, steps=steps_per_epoch)
-
-    # Evaluate the model and print results
-    eval_results = adult_classifier.evaluate(input_fn=eval_input_fn)
+  state = TrainingState(adult_classifier.model_dir,
+                        {'seed': FLAGS.seed, 'dpsgd': FLAGS.dpsgd,
+                         'noise_multiplier': FLAGS.noise_multiplier,
+                         'batch_size': FLAGS.batch_size,
+                         'subsampling': FLAGS.subsampling})
+  if state.exhausted(FLAGS.max_mu):
+    print('The privacy budget was already spent by this run')
+    return
+  first_epoch, skip = state.resume(checkpoint_step(adult_classifier.model_dir),
+                                   steps_per_epoch)
+  test_accuracy_list = state.values('accuracy')
+
+  # Report the test metric of an epoch once its evaluation is done.
+  def report(epoch, eval_results):
     test_accuracy = eval_results['accuracy']
     test_accuracy_list.append(test_accuracy)
     print('Test accuracy after %d epochs is: %.3f' % (epoch, test_accuracy))
+    state.snapshot(epoch=epoch, accuracy=test_accuracy)
+
+  # Epochs are evaluated from their checkpoint, here or, with
+  # --async_eval, on a thread while the next epoch trains.
+  evaluations = AsyncEvaluator(
+      lambda path: adult_classifier.evaluate(input_fn=eval_input_fn,
+                                             checkpoint_path=path),
+      workers=1 if FLAGS.async_eval else 0)
+
+  # Training loop.
+  for epoch in range(first_epoch + 1, FLAGS.epochs + 1):
+    train_input_fn = adult_input_fn(
+        train,
+        batch_size=FLAGS.batch_size,
+        num_epochs=1,
+        shuffle=True,
+        seed=stream_seed(FLAGS.seed, SHUFFLE, epoch),
+        skip_batches=skip)
+
+    # Train the model for one step.
+    adult_classifier.train(input_fn=train_input_fn, steps=steps_per_epoch - skip)
+    skip = 0
+
+    # Evaluate the model in the background if --async_eval
+    evaluations.submit(epoch,
+                       tf.train.latest_checkpoint(adult_classifier.model_dir))
     
     # Compute the privacy budget expended so far.
+    mu = None
     if FLAGS.dpsgd:
         if FLAGS.subsampling=='Poisson':
-            eps = compute_epsP(epoch,FLAGS.noise_multiplier,29305,256,1e-5)
+            eps = cached_epsP(epoch,FLAGS.noise_multiplier,29305,256,1e-5)
             mu = compute_muP(epoch,FLAGS.noise_multiplier,29305,256)
         if FLAGS.subsampling=='Uniform':
-            eps = compute_epsU(epoch,FLAGS.noise_multiplier,29305,256,1e-5)
+            eps = cached_epsU(epoch,FLAGS.noise_multiplier,29305,256,1e-5)
             mu = compute_muU(epoch,FLAGS.noise_multiplier,29305,256)
       
         print('For delta=1e-5, the current MA epsilon is: %.2f' % 
-              compute_epsilon(epoch,FLAGS.noise_multiplier,29305,256,1e-5))
+              cached_epsilon(epoch,FLAGS.noise_multiplier,29305,256,1e-5))
         print('For delta=1e-5, the current CLT epsilon is: %.2f' % eps)
         print('For delta=1e-5, the current mu is: %.2f' % mu)
-      
-        if mu>FLAGS.max_mu:
-            break
     else:
       print('Trained with vanilla non-private SGD optimizer')
+
+    # The budget check does not wait for the evaluation
+    state.snapshot(epoch=epoch, global_step=epoch * steps_per_epoch, mu=mu)
+    for done in evaluations.completed():
+      report(*done)
+    if FLAGS.dpsgd and mu>FLAGS.max_mu:
+      break
+  for done in evaluations.drain():
+    report(*done)
+  evaluations.close()
+  state.close()
     
 if __name__ == '__main__':
   app.run(main)
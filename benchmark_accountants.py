@@ -0,0 +1,256 @@
+r"""Checks every accountant against frozen reference values and times it.
+
+accountant_reference.json holds a grid of DP-SGD configurations (epoch,
+noise multiplier, N, batch size, delta) with reference values:
+
+  muP, muU, epsP, epsU  exact GDP values, from mpmath at 50 digits;
+  pld_epsP              pld_epsilon at eps_error=0.001, the numerical
+                        reference for the approximate accountants;
+  ma_eps                compute_epsilon, the moments accountant of the
+                        tensorflow_privacy release recorded in the file.
+
+Each accountant, whether scalar, vectorized over the grid, tabulated
+(cached) or numerical, is run over the grid and compared with its
+reference within its tolerance. A table shows the largest errors and the
+time per configuration. The exit status is nonzero if any value drifted.
+The moments accountant is only checked against the release it was frozen
+with, since the RDP conversion changed across releases. The MNIST example
+of the README is recomputed and compared with the numbers quoted there.
+--freeze recomputes the reference file, and needs tensorflow_privacy. Do
+this only on purpose, e.g. after upgrading tensorflow_privacy.
+
+Example:
+  python benchmark_accountants.py
+  python benchmark_accountants.py --only=compute_epsP,gdp_profile --repeats=100
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+import mpmath
+import numpy as np
+
+from absl import app
+from absl import flags
+
+from accountant_cache import *
+from edgeworth_accountant import *
+from gdp_accountant import *
+from phase_accountant import *
+from pld_accountant import *
+from privacy_profile import *
+
+flags.DEFINE_string('reference', os.path.join(os.path.dirname(__file__),
+                                              'accountant_reference.json'),
+                    'Frozen reference grid')
+flags.DEFINE_list('only', [], 'Accountants to run (default: all)')
+flags.DEFINE_integer('repeats', 20, 'Largest number of timed runs of the grid')
+flags.DEFINE_float('min_seconds', 0.2, 'Timing stops once the runs of an '
+                   'accountant took this long')
+flags.DEFINE_boolean('freeze', False, 'Recompute the reference file')
+
+FLAGS = flags.FLAGS
+
+# The configurations of the tutorials and a few harder points
+GRID = [
+    (15, 1.3, 60000, 256, 1e-5),
+    (15, 1.1, 60000, 256, 1e-5),
+    (45, 0.7, 60000, 256, 1e-5),
+    (1, 0.6, 60000, 256, 1e-5),
+    (1, 1.0, 60000, 256, 1e-5),
+    (1, 1.3, 60000, 256, 1e-5),
+    (20, 0.55, 29305, 256, 1e-5),
+    (10, 0.56, 25000, 512, 1e-5),
+    (20, 0.55, 800167, 10000, 1e-6),
+    (3, 2.0, 60000, 1024, 1e-5),
+]
+
+# The MNIST example of the README, to 4 decimals; its moments accountant
+# value is that of the release in the reference file
+README_CONFIG = (15, 1.3, 60000, 256, 1e-5)
+README = [(compute_epsilon, 0.9545), (compute_epsU, 1.0685),
+          (compute_epsP, 0.8345)]
+
+
+
+def exact_muP(epoch, noise_multi, N, batch_size):
+  T = mpmath.mpf(epoch) * N / batch_size
+  return (mpmath.sqrt(mpmath.exp(mpmath.mpf(noise_multi)**-2) - 1) *
+          mpmath.sqrt(T) * batch_size / N)
+
+
+def exact_muU(epoch, noise_multi, N, batch_size):
+  T = mpmath.mpf(epoch) * N / batch_size
+  sigma = mpmath.mpf(noise_multi)
+  term = (mpmath.exp(sigma**-2) * mpmath.ncdf(1.5 / sigma) +
+          3 * mpmath.ncdf(-0.5 / sigma) - 2)
+  return mpmath.sqrt(2) * batch_size * mpmath.sqrt(T) / N * mpmath.sqrt(term)
+
+
+def exact_eps(mu, delta):
+  """eps of mu-GDP at delta, by bisection at 50 digits."""
+  def delta_at(eps):
+    return (mpmath.ncdf(-eps / mu + mu / 2) -
+            mpmath.exp(eps) * mpmath.ncdf(-eps / mu - mu / 2))
+  if delta_at(0) <= delta:
+    return mpmath.mpf(0)
+  lo, hi = mpmath.mpf(0), mpmath.mpf(1)
+  while delta_at(hi) > delta:
+    hi *= 2
+  for _ in range(200):
+    mid = (lo + hi) / 2
+    lo, hi = (mid, hi) if delta_at(mid) > delta else (lo, mid)
+  return (lo + hi) / 2
+
+
+def freeze(path):
+  """Recomputes the reference values of GRID and writes them to path."""
+  version = tensorflow_privacy_version()
+  if version is None:
+    raise app.UsageError('--freeze needs tensorflow_privacy for the moments '
+                         'accountant reference')
+  mpmath.mp.dps = 50
+  entries = []
+  for config in GRID:
+    epoch, noise_multi, N, batch_size, delta = config
+    muP = exact_muP(*config[:4])
+    muU = exact_muU(*config[:4])
+    entry = {'config': list(config), 'muP': float(muP), 'muU': float(muU),
+             'epsP': float(exact_eps(muP, delta)),
+             'epsU': float(exact_eps(muU, delta)),
+             'pld_epsP': pld_epsilon(*config, eps_error=1e-3),
+             'ma_eps': float(compute_epsilon(*config))}
+    entries.append(entry)
+    print('froze', config)
+  with open(path, 'w') as f:
+    f.write('{"tensorflow_privacy": %s, "entries": [\n%s\n]}\n' %
+            (json.dumps(version),
+             ',\n'.join(json.dumps(entry) for entry in entries)))
+
+
+def _scalar(fn):
+  return lambda grid: np.array([float(fn(*config)) for config in grid])
+
+
+def _scalar_mu(fn):
+  return lambda grid: np.array([float(fn(*config[:4])) for config in grid])
+
+
+def _vectorized_muU(grid):
+  return compute_muU(*np.array([config[:4] for config in grid]).T)
+
+
+def _gdp_profile(grid):
+  return np.array([gdp_profile(compute_muP(*config[:4]), [config[4]])[0]
+                   for config in grid])
+
+
+def _phase_epsilon(grid):
+  # One-phase plans through the per-phase cache of phase_accountant
+  return np.array([compose_epsilon([Phase(*config[:4])], config[4])
+                   for config in grid])
+
+
+def _cached_epsP(grid):
+  return np.array([float(CACHE.call(compute_epsP, *config)) for config in grid])
+
+
+def _edgeworth(grid):
+  return np.array([edgeworth_epsilon(*config)[0] for config in grid])
+
+
+CACHE = None
+
+# name, kind, function of the grid, reference key, (abs, rel) tolerance
+ACCOUNTANTS = [
+    ('compute_muP', 'scalar', _scalar_mu(compute_muP), 'muP', (0, 1e-12)),
+    ('compute_muU', 'scalar', _scalar_mu(compute_muU), 'muU', (0, 1e-10)),
+    ('compute_muU', 'vectorized', _vectorized_muU, 'muU', (0, 1e-10)),
+    ('compute_epsP', 'scalar', _scalar(compute_epsP), 'epsP', (1e-10, 1e-9)),
+    ('compute_epsU', 'scalar', _scalar(compute_epsU), 'epsU', (1e-10, 1e-9)),
+    ('gdp_profile', 'vectorized', _gdp_profile, 'epsP', (1e-10, 1e-9)),
+    ('compose_epsilon', 'tabulated', _phase_epsilon, 'epsP', (1e-10, 1e-9)),
+    ('cached_epsP', 'tabulated', _cached_epsP, 'epsP', (1e-10, 1e-9)),
+    # Both PLD values are upper bounds within ~eps_error of the exact epsilon
+    ('pld_epsilon', 'numerical', _scalar(pld_epsilon), 'pld_epsP', (0.02, 0)),
+    ('edgeworth_epsilon', 'numerical', _edgeworth, 'pld_epsP', (0, 0.05)),
+    ('compute_epsilon', 'numerical', _scalar(compute_epsilon), 'ma_eps',
+     (1e-4, 0)),
+]
+
+
+def check(name, kind, fn, key, tolerance, entries):
+  """Errors against the reference, seconds per configuration and status."""
+  entries = [entry for entry in entries if key in entry]
+  grid = [tuple(entry['config']) for entry in entries]
+  reference = np.array([entry[key] for entry in entries])
+  values = fn(grid)
+  # The first call above warms up the caches and is not timed
+  runs, start = 0, time.perf_counter()
+  while not runs or (runs < FLAGS.repeats and
+                     time.perf_counter() - start < FLAGS.min_seconds):
+    fn(grid)
+    runs += 1
+  seconds = (time.perf_counter() - start) / runs / len(grid)
+  errors = np.abs(values - reference)
+  relative = errors / np.maximum(np.abs(reference), 1e-300)
+  ok = np.all(errors <= tolerance[0] + tolerance[1] * np.abs(reference))
+  return errors.max(), relative.max(), seconds, 'ok' if ok else 'DRIFTED'
+
+
+def main(unused_argv):
+  global CACHE
+  if FLAGS.freeze:
+    freeze(FLAGS.reference)
+    return
+  with open(FLAGS.reference) as f:
+    reference = json.load(f)
+  entries = reference['entries']
+  version = tensorflow_privacy_version()
+  stale = (version != reference['tensorflow_privacy'] and
+           'skipped (tensorflow_privacy %s, reference from %s)' %
+           (version, reference['tensorflow_privacy']))
+  directory = tempfile.mkdtemp()
+  CACHE = AccountantCache(os.path.join(directory, 'accountant_cache.sqlite'))
+  failed = False
+  print('%-18s %-11s %11s %11s %13s  %s' %
+        ('accountant', 'kind', 'max abs err', 'max rel err', 'us/config',
+         'status'))
+  for name, kind, fn, key, tolerance in ACCOUNTANTS:
+    if FLAGS.only and name not in FLAGS.only:
+      continue
+    if key == 'ma_eps' and stale:
+      error = None
+      status = stale
+    else:
+      error, relative, seconds, status = check(name, kind, fn, key, tolerance,
+                                               entries)
+    failed |= status == 'DRIFTED'
+    if error is None:
+      print('%-18s %-11s %11s %11s %13s  %s' % (name, kind, '-', '-', '-',
+                                               status))
+    else:
+      print('%-18s %-11s %11.2e %11.2e %13.1f  %s' %
+            (name, kind, error, relative, 1e6 * seconds, status))
+  CACHE.close()
+  for fn, value in README:
+    if fn is compute_epsilon and stale:
+      continue
+    computed = float(fn(*README_CONFIG))
+    if round(computed, 4) != value:
+      print('%s%s = %.6f, the README says %.4f' %
+            (fn.__name__, README_CONFIG, computed, value))
+      failed = True
+  if failed:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  app.run(main)
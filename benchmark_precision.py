@@ -0,0 +1,135 @@
+r"""Benchmarks the CPU time of one DP-SGD step of the MNIST CNN and the IMDB
+embedding model in float32, bfloat16 and float16.
+
+Each step computes per-example gradients in the compute dtype, then clips
+them and adds Gaussian noise in float32, as the tutorials do with
+--precision. Inputs are synthetic, so no dataset download is needed.
+
+Example:
+  python benchmark_precision.py --batch_size=256 --steps=20
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from absl import app
+from absl import flags
+
+from precision import *
+
+flags.DEFINE_integer('batch_size', 256, 'Batch size')
+flags.DEFINE_integer('steps', 20, 'Number of timed steps per configuration')
+flags.DEFINE_float('l2_norm_clip', 1.5, 'Clipping norm')
+flags.DEFINE_float('noise_multiplier', 1.1,
+                   'Ratio of the standard deviation to the clipping norm')
+flags.DEFINE_float('loss_scale', 128., 'Static loss scale used for float16')
+
+FLAGS = flags.FLAGS
+
+max_features = 10000
+maxlen = 256
+
+
+def mnist_model():
+  """Same architecture as cnn_model_fn in mnist_tutorial.py."""
+  return tf.keras.Sequential([
+      tf.keras.layers.Conv2D(16, 8, strides=2, padding='same',
+                             activation='relu', input_shape=(28, 28, 1)),
+      tf.keras.layers.MaxPool2D(2, 1),
+      tf.keras.layers.Conv2D(32, 4, strides=2, padding='valid',
+                             activation='relu'),
+      tf.keras.layers.MaxPool2D(2, 1),
+      tf.keras.layers.Flatten(),
+      tf.keras.layers.Dense(32, activation='relu'),
+      tf.keras.layers.Dense(10)])
+
+
+def imdb_model():
+  """Same architecture as rnn_model_fn in imdb_tutorial.py."""
+  return tf.keras.Sequential([
+      tf.keras.layers.Embedding(max_features, 16, input_length=maxlen),
+      tf.keras.layers.GlobalAveragePooling1D(),
+      tf.keras.layers.Dense(16, activation='relu'),
+      tf.keras.layers.Dense(2)])
+
+
+def mnist_batch(batch_size):
+  x = np.random.random_sample((batch_size, 28, 28, 1)).astype('float32')
+  y = np.random.randint(0, 10, batch_size).astype('int32')
+  return x, y
+
+
+def imdb_batch(batch_size):
+  x = np.random.randint(0, max_features, (batch_size, maxlen)).astype('int32')
+  y = np.random.randint(0, 2, batch_size).astype('int32')
+  return x, y
+
+
+def make_dp_step(model, loss_scale):
+  """Returns a DP-SGD step with float32 clipping and noise."""
+  optimizer = tf.keras.optimizers.SGD(learning_rate=0.1)
+  l2_norm_clip = FLAGS.l2_norm_clip * loss_scale
+  stddev = FLAGS.noise_multiplier * l2_norm_clip
+
+  @tf.function
+  def dp_step(x, y):
+    variables = model.trainable_variables
+
+    def example_gradients(example):
+      xi, yi = example
+      with tf.GradientTape() as tape:
+        logits = tf.cast(model(xi[None]), tf.float32)
+        loss = tf.reduce_sum(tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=yi[None], logits=logits)) * loss_scale
+      return [tf.convert_to_tensor(g) for g in tape.gradient(loss, variables)]
+
+    # Variables are float32, so per-example gradients arrive in float32.
+    grads = tf.vectorized_map(example_gradients, (x, y))
+    batch_size = tf.shape(x)[0]
+    norms = tf.sqrt(tf.add_n([
+        tf.reduce_sum(tf.reshape(tf.square(g), [batch_size, -1]), axis=1)
+        for g in grads]))
+    factors = tf.minimum(1., l2_norm_clip / tf.maximum(norms, 1e-12))
+    denominator = tf.cast(batch_size, tf.float32) * loss_scale
+    noised = [(tf.tensordot(factors, g, axes=1) +
+               tf.random.normal(tf.shape(g)[1:], stddev=stddev)) / denominator
+              for g in grads]
+    optimizer.apply_gradients(zip(noised, variables))
+
+  return dp_step
+
+
+def time_dp_step(build_model, make_batch, precision):
+  set_precision(precision)
+  model = build_model()
+  loss_scale = FLAGS.loss_scale if precision == 'float16' else 1.
+  dp_step = make_dp_step(model, loss_scale)
+  x, y = make_batch(FLAGS.batch_size)
+  dp_step(x, y)  # Trace and warm up.
+  start = time.perf_counter()
+  for _ in range(FLAGS.steps):
+    dp_step(x, y)
+  return (time.perf_counter() - start) / FLAGS.steps
+
+
+def main(unused_argv):
+  models = [('MNIST CNN', mnist_model, mnist_batch),
+            ('IMDB embedding', imdb_model, imdb_batch)]
+  for name, build_model, make_batch in models:
+    baseline = None
+    for precision in PRECISIONS:
+      seconds = time_dp_step(build_model, make_batch, precision)
+      baseline = baseline or seconds
+      print('%-15s %-9s %8.1f ms/step  speedup %.2fx' %
+            (name, precision, 1000 * seconds, baseline / seconds))
+  set_precision('float32')
+
+
+if __name__ == '__main__':
+  app.run(main)
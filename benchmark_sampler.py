@@ -0,0 +1,68 @@
+r"""Benchmarks one step of Poisson subsampling: the uniform mask used by the
+naive subsampling scripts against geometric gap skipping.
+
+Example:
+  python benchmark_sampler.py --N=60000,100000000 --batch_size=256
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import numpy as np
+
+from absl import app
+from absl import flags
+
+from poisson_sampler import *
+
+flags.DEFINE_list('N', ['60000', '100000000'], 'Dataset sizes')
+flags.DEFINE_integer('batch_size', 256, 'Expected batch size')
+flags.DEFINE_integer('repeats', 5, 'Timed steps per method')
+flags.DEFINE_integer('max_list_N', 10**6,
+                     'Largest N for the pure-Python list comprehension')
+
+FLAGS = flags.FLAGS
+
+
+def list_comprehension(N, q, rng):
+  """The naive subsampling scripts' sampler."""
+  whether = rng.random_sample(N) > (1 - q)
+  return [i for i in np.arange(N) if whether[i]]
+
+
+def uniform_mask(N, q, rng):
+  """The same mask, vectorized."""
+  return np.flatnonzero(rng.random_sample(N) > (1 - q))
+
+
+def geometric_skipping(N, q, rng):
+  return poisson_sample(N, q, np.random.default_rng(rng.randint(2**31)))
+
+
+def time_step(sampler, N, q):
+  rng = np.random.RandomState(0)
+  sizes = []
+  start = time.perf_counter()
+  for _ in range(FLAGS.repeats):
+    sizes.append(len(sampler(N, q, rng)))
+  return (time.perf_counter() - start) / FLAGS.repeats, np.mean(sizes)
+
+
+def main(unused_argv):
+  for N in [int(n) for n in FLAGS.N]:
+    q = FLAGS.batch_size / N
+    samplers = [('uniform mask', uniform_mask),
+                ('geometric skipping', geometric_skipping)]
+    if N <= FLAGS.max_list_N:
+      samplers.insert(0, ('list comprehension', list_comprehension))
+    for name, sampler in samplers:
+      seconds, size = time_step(sampler, N, q)
+      print('N=%-10d %-19s %10.3f ms/step  mean batch %.1f' %
+            (N, name, 1000 * seconds, size))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,181 @@
+r"""Privacy-budget admission control for training jobs on shared datasets.
+
+Jobs register (dataset, N, batch_size, noise_multiplier, epochs, delta). The
+service answers with the job's mu and epsilon and accepts it only if the
+dataset's cumulative budget stays within max_mu. Jobs on the same dataset
+compose as GDP: the total is sqrt of the sum of their mu^2. Rejected jobs
+spend nothing. Per-job accounting is cached, so repeated configurations
+cost one dictionary lookup.
+
+Example (one job, no server):
+  python budget_service.py \
+    --N=60000 \
+    --batch_size=256 \
+    --noise_multiplier=1.3 \
+    --epochs=15
+
+Example (HTTP service on localhost:8000):
+  python budget_service.py --port=8000 --max_mu=2
+
+  POST /query     {"N": 60000, "batch_size": 256, "noise_multiplier": 1.3,
+                   "epochs": 15, "delta": 1e-5}
+  POST /register  the same with a "dataset" key; either endpoint also takes
+                  a JSON list of jobs and answers with a list
+  GET  /budget?dataset=mnist
+"""
+
+import functools
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from gdp_accountant import *
+
+
+# mu and epsilon of one job, cached across queries
+@functools.lru_cache(maxsize=65536)
+def job_privacy(N,batch_size,noise_multiplier,epochs,delta,subsampling='Poisson'):
+    if not N>0 or not batch_size>0:
+        raise ValueError('N and batch_size must be positive, got %r and %r' % (N,batch_size))
+    if not noise_multiplier>0:
+        raise ValueError('noise_multiplier must be positive, got %r' % noise_multiplier)
+    if not epochs>=0:
+        raise ValueError('epochs must be nonnegative, got %r' % epochs)
+    if not 0<delta<1:
+        raise ValueError('delta must be in (0, 1), got %r' % delta)
+    if subsampling=='Poisson':
+        mu=compute_muP(epochs,noise_multiplier,N,batch_size)
+    elif subsampling=='Uniform':
+        mu=compute_muU(epochs,noise_multiplier,N,batch_size)
+    else:
+        raise ValueError('subsampling must be Poisson or Uniform, got %r' % subsampling)
+    return float(mu),float(eps_from_mu(mu,delta))
+
+
+class BudgetService(object):
+    """Thread-safe per-dataset GDP budget ledger kept in memory."""
+
+    def __init__(self,max_mu,budgets=None):
+        self.max_mu=max_mu
+        self.budgets=dict(budgets or {})
+        self._mu_squared={}
+        self._jobs={}
+        self._lock=threading.Lock()
+
+    def query(self,N,batch_size,noise_multiplier,epochs,delta,subsampling='Poisson'):
+        """Privacy cost of a job without registering it."""
+        mu,eps=job_privacy(N,batch_size,noise_multiplier,epochs,delta,subsampling)
+        return {'mu':mu,'eps':eps}
+
+    def register(self,dataset,N,batch_size,noise_multiplier,epochs,delta,
+                 subsampling='Poisson'):
+        """Admits the job if the dataset's composed mu stays within budget."""
+        mu,eps=job_privacy(N,batch_size,noise_multiplier,epochs,delta,subsampling)
+        max_mu=self.budgets.get(dataset,self.max_mu)
+        with self._lock:
+            spent=self._mu_squared.get(dataset,0.)
+            accepted=spent+mu**2<=max_mu**2
+            if accepted:
+                spent+=mu**2
+                self._mu_squared[dataset]=spent
+                self._jobs[dataset]=self._jobs.get(dataset,0)+1
+        total_mu=np.sqrt(spent)
+        return {'accepted':accepted,'mu':mu,'eps':eps,'total_mu':total_mu,
+                'total_eps':float(eps_from_mu(total_mu,delta)) if total_mu>0 else 0.,
+                'remaining_mu':np.sqrt(max(max_mu**2-spent,0.))}
+
+    def budget(self,dataset):
+        """Composed mu spent on a dataset and what is left of its budget."""
+        max_mu=self.budgets.get(dataset,self.max_mu)
+        with self._lock:
+            spent=self._mu_squared.get(dataset,0.)
+            jobs=self._jobs.get(dataset,0)
+        return {'dataset':dataset,'jobs':jobs,'total_mu':np.sqrt(spent),
+                'max_mu':max_mu,'remaining_mu':np.sqrt(max(max_mu**2-spent,0.))}
+
+
+def _handle_jobs(method,payload):
+    """Applies method to one job (a dict) or a batch of jobs (a list)."""
+    if isinstance(payload,list):
+        return [method(**job) for job in payload]
+    return method(**payload)
+
+
+class _BudgetHandler(BaseHTTPRequestHandler):
+    service=None
+
+    def do_GET(self):
+        url=urlparse(self.path)
+        dataset=parse_qs(url.query).get('dataset',[None])[0]
+        if url.path!='/budget' or dataset is None:
+            return self._reply(404,{'error':'use GET /budget?dataset=<name>'})
+        self._reply(200,self.service.budget(dataset))
+
+    def do_POST(self):
+        methods={'/query':self.service.query,'/register':self.service.register}
+        if self.path not in methods:
+            return self._reply(404,{'error':'use POST /query or /register'})
+        try:
+            body=self.rfile.read(int(self.headers.get('Content-Length',0)))
+            result=_handle_jobs(methods[self.path],json.loads(body))
+        except (TypeError,ValueError) as e:
+            return self._reply(400,{'error':str(e)})
+        self._reply(200,result)
+
+    def _reply(self,code,payload):
+        body=json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        pass
+
+
+def serve(service,port,host='127.0.0.1'):
+    """Serves the HTTP front end of service until interrupted."""
+    handler=type('BudgetHandler',(_BudgetHandler,),{'service':service})
+    server=ThreadingHTTPServer((host,port),handler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def main(unused_argv):
+    FLAGS=flags.FLAGS
+    service=BudgetService(FLAGS.max_mu)
+    if FLAGS.port:
+        print('Serving privacy budgets on http://%s:%d' % (FLAGS.host,FLAGS.port))
+        serve(service,FLAGS.port,FLAGS.host)
+        return
+    result=service.register(FLAGS.dataset,FLAGS.N,FLAGS.batch_size,
+                            FLAGS.noise_multiplier,FLAGS.epochs,FLAGS.delta,
+                            FLAGS.subsampling)
+    print('DP-optimizer satisfies %.3f-GDP, i.e. (%.3f, %g)-DP' %
+          (result['mu'],result['eps'],FLAGS.delta))
+    print('Job %s under max_mu=%g' %
+          ('accepted' if result['accepted'] else 'rejected',FLAGS.max_mu))
+
+
+if __name__ == '__main__':
+    from absl import app
+    from absl import flags
+
+    flags.DEFINE_integer('port', 0, 'Serve HTTP on this port; 0 accounts one job and exits')
+    flags.DEFINE_string('host', '127.0.0.1', 'Interface to serve on')
+    flags.DEFINE_float('max_mu', 2, 'Default per-dataset budget')
+    flags.DEFINE_string('dataset', 'default', 'Dataset of the job')
+    flags.DEFINE_integer('N', 60000, 'Total number of examples')
+    flags.DEFINE_integer('batch_size', 256, 'Batch size')
+    flags.DEFINE_float('noise_multiplier', 1.3,
+                       'Ratio of the standard deviation to the clipping norm')
+    flags.DEFINE_integer('epochs', 15, 'Number of epochs')
+    flags.DEFINE_float('delta', 1e-5, 'Target delta')
+    flags.DEFINE_string('subsampling', 'Poisson', 'Poisson or Uniform subsampling')
+    app.run(main)
@@ -0,0 +1,68 @@
+r"""In-graph DP noise drawn from counter-based streams.
+
+A stateful op such as tf.random.normal restarts its sequence whenever the
+Estimator rebuilds the graph, i.e. on every train() call. With a fixed graph
+seed every call would then add the same noise, which silently breaks the
+privacy analysis. StatelessGaussianSumQuery instead draws the noise of each
+step from stateless Philox ops seeded by (run, worker) and the global step:
+independent across steps, reproducible across reruns, generated on device,
+and unaffected by graph rebuilds or global seeds.
+"""
+
+import tensorflow as tf
+
+from tensorflow_privacy.privacy.dp_query import gaussian_query
+try:
+  from tensorflow_privacy.privacy.analysis import dp_event
+except ImportError:  # releases before DpEvents
+  dp_event = None
+
+from dp_random import *
+
+
+def stateless_normal_like(tensors, seed):
+  """Standard normal noise shaped like tensors, from one stateless stream."""
+  sizes = [tf.size(t) for t in tensors]
+  flat = tf.random.stateless_normal(tf.reshape(tf.add_n(sizes), [1]),
+                                    seed=seed)
+  pieces = tf.split(flat, tf.stack(sizes), num=len(sizes))
+  return [tf.cast(tf.reshape(n, tf.shape(t)), t.dtype)
+          for n, t in zip(pieces, tensors)]
+
+
+class StatelessGaussianSumQuery(gaussian_query.GaussianSumQuery):
+  """GaussianSumQuery whose noise is keyed by (run, worker, global step)."""
+
+  def __init__(self, l2_norm_clip, stddev, run=0, worker=0):
+    super(StatelessGaussianSumQuery, self).__init__(l2_norm_clip, stddev)
+    self._run = run
+    self._worker = worker
+
+  def get_noised_result(self, sample_state, global_state):
+    # The base class sums without noise (its return signature differs
+    # between tensorflow_privacy versions); the noise is added here.
+    outputs = super(StatelessGaussianSumQuery, self).get_noised_result(
+        sample_state, global_state._replace(stddev=0.))
+    leaves = tf.nest.flatten(outputs[0])
+    step = tf.cast(tf.compat.v1.train.get_global_step(), tf.int64)
+    noised = [v + global_state.stddev * n
+              for v, n in zip(leaves, self.standard_noise(leaves, step))]
+    events = tuple(outputs[2:])
+    if events and dp_event is not None:
+      # The base class's event saw stddev 0, i.e. no privacy at all
+      events = (dp_event.GaussianDpEvent(
+          global_state.stddev / global_state.l2_norm_clip),) + events[1:]
+    return ((tf.nest.pack_sequence_as(outputs[0], noised), global_state) +
+            events)
+
+  def standard_noise(self, leaves, step):
+    """Standard normal noise shaped like leaves for global step `step`."""
+    seed = tf.stack([tf.constant(stream_seed(self._run, NOISE, self._worker),
+                                 tf.int64), step])
+    return stateless_normal_like(leaves, seed)
+
+
+def stateless_gaussian_query(l2_norm_clip, noise_multiplier, run=0, worker=0):
+  """Drop-in dp_sum_query for the DP optimizers of the tutorials."""
+  return StatelessGaussianSumQuery(l2_norm_clip,
+                                   l2_norm_clip * noise_multiplier, run, worker)
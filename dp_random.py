@@ -0,0 +1,36 @@
+r"""Counter-based random streams for DP training.
+
+Every random draw of a run is addressed by (run, purpose, step, worker)
+instead of coming from a global seeded state. Streams for different steps,
+workers or purposes (sampling, noise, shuffling, the noised counts of
+adaptive clipping) are independent. Any one of
+them can be regenerated on its own, in any order and on any thread, so
+reruns are exact without serializing anything or resetting global seeds.
+
+On the host the streams are numpy Philox generators: the run and purpose
+form the key, and the step and worker sit in the high words of the 256-bit
+counter. TF ops get a seed derived from (run, purpose, index), see
+dp_noise.py for the in-graph DP noise.
+"""
+
+import hashlib
+
+import numpy as np
+
+SAMPLING, NOISE, SHUFFLE, CLIPPING = 0, 1, 2, 3
+
+
+def numpy_stream(run, purpose, step, worker=0, chunk=0):
+  """Philox generator of the (run, purpose, step, worker) stream.
+
+  chunk splits a stream into independent substreams (2^64 draws each), e.g.
+  to fill the pieces of one large array in parallel.
+  """
+  return np.random.Generator(np.random.Philox(key=[run, purpose],
+                                              counter=[0, chunk, step, worker]))
+
+
+def stream_seed(run, purpose, index=0):
+  """63-bit seed for TF ops of the (run, purpose, index) stream."""
+  digest = hashlib.sha256(repr((run, purpose, index)).encode()).digest()
+  return int.from_bytes(digest[:8], 'little') >> 1
@@ -1,10 +1,11 @@
 r"""This code applies the moments accountant (MA), Dual and Central Limit 
 Theorem (CLT) to estimate privacy budget of an iterated subsampled 
 Gaussian Mechanism (either uniformly or by Poisson subsampling). 
-The mechanism's parameters are controlled by flags.
+From the command line, budget_service.py controls the mechanism's
+parameters by flags.
 
 Example:
-  compute_muP
+  python budget_service.py \
     --N=60000 \
     --batch_size=256 \
     --noise_multiplier=1.3 \
@@ -13,36 +14,100 @@ Example:
 The output states that DP-optimizer satisfies 0.227-GDP.
 """
 
+import importlib.metadata
+
 import numpy as np
 from scipy.stats import norm
+from scipy.special import erf, log_ndtr
 from scipy import optimize
 
+from pld_accountant import *
+from edgeworth_accountant import *
+
 # Total number of examples:N
 # batch size:batch_size
 # Noise multiplier for DP-SGD/DP-Adam:noise_multiplier
 # current epoch:epoch
 # Target delta:delta
 
-# Compute mu from uniform subsampling
+# Compute mu from uniform subsampling, elementwise on arrays
 def compute_muU(epoch,noise_multi,N,batch_size):
     T=epoch*N/batch_size
     c=batch_size*np.sqrt(T)/N
-    return(np.sqrt(2)*c*np.sqrt(np.exp(noise_multi**(-2))*norm.cdf(1.5/noise_multi)+3*norm.cdf(-0.5/noise_multi)-2))
+    with np.errstate(over='ignore'):
+        return(np.sqrt(2)*c*np.exp(0.5*_log_muU_term(noise_multi)))
+
+# log of exp(sigma^-2)*Phi(1.5/sigma)+3*Phi(-0.5/sigma)-2, written as
+# expm1(sigma^-2)*Phi(1.5/sigma)+0.5*erf(3x)-1.5*erf(x) with x=0.5/(sqrt(2)*sigma):
+# exp(sigma^-2) stays in log space for small sigma, and the erf difference,
+# whose linear terms cancel for large sigma, is summed as a series there
+def _log_muU_term(noise_multi):
+    noise_multi=np.asarray(noise_multi,dtype=float)
+    a=noise_multi**(-2)
+    log_first=a+np.log(-np.expm1(-a))+log_ndtr(1.5/noise_multi)
+    x=0.5/(np.sqrt(2)*noise_multi)
+    n=np.arange(1,30)
+    terms=((-1.)**n*(0.5*3.**(2*n+1)-1.5)/(_factorial(n)*(2*n+1)))*np.power.outer(x,2*n+1)
+    series=2/np.sqrt(np.pi)*terms.sum(axis=-1)
+    second=np.where(x<0.5,series,0.5*erf(3*x)-1.5*erf(x))
+    return log_first+np.log1p(second*np.exp(-log_first))
+
+def _factorial(n):
+    return np.cumprod(np.maximum(n,1).astype(float))
 
 # Compute mu from Poisson subsampling
 def compute_muP(epoch,noise_multi,N,batch_size):
     T=epoch*N/batch_size
     return(np.sqrt(np.exp(noise_multi**(-2))-1)*np.sqrt(T)*batch_size/N)
     
-# Dual between mu-GDP and (epsilon,delta)-DP
+# Dual between mu-GDP and (epsilon,delta)-DP, elementwise on arrays
+# Both terms are kept in log space so that exp(eps) never multiplies a
+# vanishing CDF, which keeps delta accurate for large eps; the scipy.special
+# ufuncs also avoid the per-call overhead of scipy.stats.norm
 def delta_eps_mu(eps,mu):
-    return norm.cdf(-eps/mu+mu/2)-np.exp(eps)*norm.cdf(-eps/mu-mu/2)
+    log_first=log_ndtr(-eps/mu+mu/2)
+    log_second=eps+log_ndtr(-eps/mu-mu/2)
+    return -np.exp(log_first)*np.expm1(log_second-log_first)
 
 # inverse Dual
 def eps_from_mu(mu,delta):
     def f(x):
         return delta_eps_mu(x,mu)-delta    
-    return optimize.root_scalar(f, bracket=[0, 500], method='brentq').root
+    if not np.isfinite(mu):
+        return np.inf
+    if mu<=0:
+        return 0.
+    if f(0)<=0:
+        return 0.
+    return optimize.root_scalar(f, bracket=[0, max(500,mu**2+20*mu)], method='brentq').root
+
+# Smallest mu-GDP that is (eps,delta)-DP, i.e. the inverse of eps_from_mu in mu
+# The bracket is widened until it holds the root, which goes to 0 with eps and delta
+def mu_from_eps(eps,delta):
+    def f(mu):
+        return delta_eps_mu(eps,mu)-delta
+    lo,hi=1e-3,50.
+    while f(lo)>0:
+        lo/=10
+    while f(hi)<0:
+        hi*=2
+    return optimize.root_scalar(f,bracket=[lo,hi],method='brentq').root
+
+# Noise multiplier of Poisson subsampling reaching mu (compute_muP solved for sigma)
+def noise_multi_from_muP(mu,epoch,N,batch_size):
+    T=epoch*N/batch_size
+    return 1/np.sqrt(np.log1p((mu*N/(batch_size*np.sqrt(T)))**2))
+
+# Noise multiplier of Poisson subsampling reaching (eps,delta)-DP by CLT
+def noise_multi_from_epsP(eps,epoch,N,batch_size,delta):
+    return noise_multi_from_muP(mu_from_eps(eps,delta),epoch,N,batch_size)
+
+# Noise multiplier of a step that also releases `groups` clipped counts with
+# noise stddev clipped_count_stddev (adaptive clipping, see ghost_clipping.py).
+# Each count moves by at most 1 per example, so the step is one Gaussian
+# mechanism with mu=sqrt(noise_multi^-2+groups*clipped_count_stddev^-2)
+def effective_noise_multi(noise_multi,clipped_count_stddev,groups=1):
+    return (noise_multi**(-2)+groups*clipped_count_stddev**(-2))**(-0.5)
 
 # inverse Dual of uniform subsampling
 def compute_epsU(epoch,noise_multi,N,batch_size,delta):
@@ -52,16 +117,86 @@ def compute_epsU(epoch,noise_multi,N,batch_size,delta):
 def compute_epsP(epoch,noise_multi,N,batch_size,delta):
     return(eps_from_mu(compute_muP(epoch,noise_multi,N,batch_size),delta))
 
+# The CLT treats the privacy loss composed over T steps as Gaussian. It is
+# reliable when the skewness of that loss is small and the sampling rate is
+# small; with skewness <= 0.1 the CLT epsilon is within ~10% of the
+# numerical one (pld_accountant) over sigma 0.6-3, p 0.001-0.1, T 1e2-1e4
+CLT_MAX_SKEWNESS=0.1
+CLT_MAX_SAMPLING_RATE=0.1
+_HERMITE_X,_HERMITE_W=np.polynomial.hermite_e.hermegauss(80)
+
+# Skewness of the privacy loss of T Poisson subsampled Gaussian steps
+def clt_skewness(epoch,noise_multi,N,batch_size):
+    T=np.asarray(epoch*N/batch_size,dtype=float)[...,None]
+    p=np.asarray(batch_size/N,dtype=float)[...,None]
+    mu=1/np.asarray(noise_multi,dtype=float)[...,None]
+    with np.errstate(divide='ignore'):
+        loss=np.logaddexp(np.log1p(-p),np.log(p)+mu*_HERMITE_X-mu**2/2)
+    w=_HERMITE_W/_HERMITE_W.sum()
+    centered=loss-(loss*w).sum(axis=-1,keepdims=True)
+    k2=(centered**2*w).sum(axis=-1)
+    k3=(centered**3*w).sum(axis=-1)
+    return k3/k2**1.5/np.sqrt(T[...,0])
+
+# Whether the CLT applies, elementwise
+def clt_reliable(epoch,noise_multi,N,batch_size):
+    return ((clt_skewness(epoch,noise_multi,N,batch_size)<=CLT_MAX_SKEWNESS)&
+            (np.asarray(batch_size/N)<=CLT_MAX_SAMPLING_RATE))
+
+# Epsilon by CLT where it is reliable and by the numerical accountant
+# elsewhere, elementwise; also returns where the CLT was used
+def compute_epsU_checked(epoch,noise_multi,N,batch_size,delta):
+    return _eps_checked(epoch,noise_multi,N,batch_size,delta,'Uniform')
+
+def compute_epsP_checked(epoch,noise_multi,N,batch_size,delta):
+    return _eps_checked(epoch,noise_multi,N,batch_size,delta,'Poisson')
+
+def _eps_checked(epoch,noise_multi,N,batch_size,delta,subsampling):
+    args=np.broadcast_arrays(*[np.asarray(a,dtype=float) for a in (epoch,noise_multi,N,batch_size,delta)])
+    reliable=clt_reliable(*args[:4])
+    compute_mu=compute_muP if subsampling=='Poisson' else compute_muU
+    eps=np.empty(reliable.shape)
+    for i in np.ndindex(reliable.shape):
+        e,s,n,b,d=[float(a[i]) for a in args]
+        if reliable[i]:
+            eps[i]=eps_from_mu(compute_mu(e,s,n,b),d)
+        else:
+            eps[i]=pld_epsilon(e,s,n,b,d,subsampling)
+    if eps.ndim==0:
+        return float(eps),bool(reliable)
+    return eps,reliable
+
 from tensorflow_privacy.privacy.analysis.rdp_accountant import compute_rdp
 from tensorflow_privacy.privacy.analysis.rdp_accountant import get_privacy_spent
 
+# RDP orders tracked by the moments accountant
+RDP_ORDERS = [1 + x / 10. for x in range(1, 100)] + list(np.arange(12, 60,0.2))+list(np.arange(60,100,1))
+
+# Release of tensorflow_privacy, None if it is not installed as a package;
+# its conversion from RDP to epsilon changed across releases
+def tensorflow_privacy_version():
+  try:
+    return importlib.metadata.version('tensorflow_privacy')
+  except importlib.metadata.PackageNotFoundError:
+    return None
+
+# Compute the RDP vector at RDP_ORDERS by MA; RDP vectors compose by summation
+def compute_rdp_vector(epoch,noise_multi,N,batch_size):
+  sampling_probability = batch_size / N
+  return compute_rdp(q=sampling_probability,
+                     noise_multiplier=noise_multi,
+                     steps=epoch*N/batch_size,
+                     orders=RDP_ORDERS)
+
+# Convert an RDP vector at RDP_ORDERS to epsilon
+def eps_from_rdp(rdp,delta):
+  return get_privacy_spent(RDP_ORDERS, rdp, target_delta=delta)[0]
+
+# Convert an RDP vector at RDP_ORDERS to delta at epsilon
+def delta_from_rdp(rdp,eps):
+  return get_privacy_spent(RDP_ORDERS, rdp, target_eps=eps)[1]
+
 # Compute epsilon by MA
 def compute_epsilon(epoch,noise_multi,N,batch_size,delta):
   """Computes epsilon value for given hyperparameters."""
-  orders = [1 + x / 10. for x in range(1, 100)] + list(np.arange(12, 60,0.2))+list(np.arange(60,100,1))
-  sampling_probability = batch_size / N
-  rdp = compute_rdp(q=sampling_probability,
-                    noise_multiplier=noise_multi,
-                    steps=epoch*N/batch_size,
-                    orders=orders)
-  return get_privacy_spent(orders, rdp, target_delta=delta)[0]
\ No newline at end of file
+  return eps_from_rdp(compute_rdp_vector(epoch,noise_multi,N,batch_size),delta)
\ No newline at end of file
@@ -0,0 +1,272 @@
+r"""Per-example gradient clipping without per-example gradients.
+
+dp_optimizer clips microbatch by microbatch: with one example per
+microbatch it materializes the gradient of every example, so a dense first
+layer over thousands of input columns costs batch_size full kernel
+gradients per step. For a dense layer z = x W + b, however, the gradient of
+example i is the outer product x_i delta_i^T (plus delta_i for the bias),
+with delta_i = dloss_i/dz_i, and its norm is known without forming it:
+
+  ||dloss_i/dW||^2 = ||x_i||^2 ||delta_i||^2,   ||dloss_i/db||^2 = ||delta_i||^2
+
+One backward pass to the layer outputs thus gives every example's gradient
+norm ("ghost" norms), and a second one, of the losses weighted by the
+clipping factors min(1, C/||g_i||), gives the sum of the clipped gradients.
+With SparseTensor inputs ||x_i||^2 sums over the nonzeros and the kernel
+gradient X^T delta is a sparse matmul, so memory and time scale with the
+number of nonzeros instead of the width.
+
+A Conv2D kernel gradient is a sum over the P output positions,
+U_i^T D_i, with U_i the [P, k] input patches (k = kernel area * channels)
+and D_i the [P, c] output gradients. Its squared norm is either
+<U_i U_i^T, D_i D_i^T> (the ghost norm, P^2 numbers per example) or that
+of the [k, c] product itself; the smaller of P^2 and k*c is used, so no
+layer ever holds more than min(P^2, k*c) numbers per example. In the MNIST
+CNN the first convolution (P=196, k*c=1024) is computed directly and the
+second (P=25, k*c=8192) by the ghost norm.
+
+The noise is drawn as by StatelessGaussianSumQuery (keyed by run, worker
+and global step) with stddev l2_norm_clip * noise_multiplier, and the sum
+is divided by the batch size, which is dp_optimizer with one example per
+microbatch: the privacy analysis is unchanged. The clipped sum itself needs
+no second backward pass: the output gradients of a layer, scaled by the
+clipping factors, are pushed back through that layer only.
+
+The layers can be clipped in groups, e.g. one per layer, each group to its
+own norm C_g; an example then moves the sum by at most
+C = sqrt(sum of C_g^2), and the noise is that of C. With a target_quantile
+q the norms adapt during training (Andrew et al., "Differentially Private
+Learning with Adaptive Clipping"): each step also releases the fraction b_g
+of examples whose group norm is within C_g, with Gaussian noise of stddev
+clipped_count_stddev on the count, and sets C_g <- C_g exp(-eta (b_g - q)).
+The counts are a second Gaussian query of the same examples; account for
+them with effective_noise_multi in gdp_accountant.
+
+Every trainable variable of the model must belong to a recorded layer;
+GhostClippingOptimizer refuses models with others, whose gradients would
+otherwise go unclipped.
+
+Example:
+  hidden, first = ghost_dense(features['x'], 16, tf.nn.relu)
+  logits, second = ghost_dense(hidden, 2)
+  optimizer = GhostClippingOptimizer(
+      tf.compat.v1.train.GradientDescentOptimizer(0.01), [first, second],
+      l2_norm_clip=1., noise_multiplier=1.1)
+  train_op = optimizer.minimize(loss=vector_loss, global_step=global_step)
+"""
+
+import collections
+
+import tensorflow as tf
+
+from dp_noise import *
+
+# conv is (kernel_size, strides, padding) for Conv2D layers, None for dense
+GhostLayer = collections.namedtuple(
+    'GhostLayer', ['inputs', 'outputs', 'kernel', 'bias', 'conv'],
+    defaults=[None])
+
+
+def ghost_dense(inputs, units, activation=None, name=None):
+  """Dense layer over a dense or SparseTensor batch, recorded for clipping.
+
+  Returns the activations and the GhostLayer that `ghost_norms` needs.
+  SparseTensor inputs need a static width, e.g. from csr_input_fn.
+  """
+  with tf.compat.v1.variable_scope(name, default_name='ghost_dense'):
+    width = int(inputs.shape[-1])
+    kernel = tf.compat.v1.get_variable(
+        'kernel', [width, units],
+        initializer=tf.compat.v1.glorot_uniform_initializer())
+    bias = tf.compat.v1.get_variable(
+        'bias', [units], initializer=tf.compat.v1.zeros_initializer())
+    if isinstance(inputs, tf.SparseTensor):
+      outputs = tf.sparse.sparse_dense_matmul(inputs, kernel) + bias
+    else:
+      # Variables stay float32 under reduced precision, see precision.py
+      outputs = (tf.matmul(inputs, tf.cast(kernel, inputs.dtype)) +
+                 tf.cast(bias, inputs.dtype))
+  layer = GhostLayer(inputs, outputs, kernel, bias)
+  return (activation(outputs) if activation else outputs), layer
+
+
+def ghost_conv2d(inputs, filters, kernel_size, strides=1, padding='valid',
+                 activation=None, name=None):
+  """Conv2D layer (NHWC) recorded for ghost clipping, like ghost_dense."""
+  with tf.compat.v1.variable_scope(name, default_name='ghost_conv2d'):
+    channels = int(inputs.shape[-1])
+    kernel = tf.compat.v1.get_variable(
+        'kernel', [kernel_size, kernel_size, channels, filters],
+        initializer=tf.compat.v1.glorot_uniform_initializer())
+    bias = tf.compat.v1.get_variable(
+        'bias', [filters], initializer=tf.compat.v1.zeros_initializer())
+    outputs = tf.nn.conv2d(inputs, tf.cast(kernel, inputs.dtype),
+                           strides=strides, padding=padding.upper())
+    outputs += tf.cast(bias, inputs.dtype)
+  layer = GhostLayer(inputs, outputs, kernel, bias,
+                     (kernel_size, strides, padding.upper()))
+  return (activation(outputs) if activation else outputs), layer
+
+
+def squared_input_norms(inputs):
+  """||x_i||^2 of every example of a dense or SparseTensor batch."""
+  if isinstance(inputs, tf.SparseTensor):
+    return tf.math.unsorted_segment_sum(tf.square(inputs.values),
+                                        inputs.indices[:, 0],
+                                        inputs.dense_shape[0])
+  return tf.reduce_sum(tf.square(tf.cast(inputs, tf.float32)), axis=1)
+
+
+def conv2d_squared_norms(layer, delta):
+  """Squared per-example gradient norms of a ghost_conv2d layer."""
+  kernel_size, strides, padding = layer.conv
+  patches = tf.image.extract_patches(
+      tf.cast(layer.inputs, tf.float32),
+      sizes=[1, kernel_size, kernel_size, 1], strides=[1, strides, strides, 1],
+      rates=[1, 1, 1, 1], padding=padding)
+  positions = int(delta.shape[1]) * int(delta.shape[2])
+  u = tf.reshape(patches, [-1, positions, int(patches.shape[-1])])
+  d = tf.reshape(tf.cast(delta, tf.float32), [-1, positions, int(delta.shape[-1])])
+  if positions ** 2 <= int(u.shape[-1]) * int(d.shape[-1]):
+    squared = tf.reduce_sum(tf.matmul(u, u, transpose_b=True) *
+                            tf.matmul(d, d, transpose_b=True), axis=[1, 2])
+  else:
+    squared = tf.reduce_sum(tf.square(tf.matmul(u, d, transpose_a=True)),
+                            axis=[1, 2])
+  if layer.bias is not None:
+    squared += tf.reduce_sum(tf.square(tf.reduce_sum(d, axis=1)), axis=1)
+  return squared
+
+
+def dense_squared_norms(layer, delta):
+  """Squared per-example gradient norms of a ghost_dense layer."""
+  delta_norms = tf.reduce_sum(tf.square(tf.cast(delta, tf.float32)), axis=1)
+  squared = squared_input_norms(layer.inputs) * delta_norms
+  if layer.bias is not None:
+    squared += delta_norms
+  return squared
+
+
+def layer_squared_norms(layers, deltas):
+  """Squared per-example gradient norms of each layer.
+
+  deltas are the gradients of the summed loss w.r.t. the layer outputs.
+  """
+  return [dense_squared_norms(layer, delta) if layer.conv is None else
+          conv2d_squared_norms(layer, delta)
+          for layer, delta in zip(layers, deltas)]
+
+
+def ghost_norms(vector_loss, layers):
+  """Per-example gradient norms over the variables of layers."""
+  deltas = tf.gradients(tf.reduce_sum(vector_loss),
+                        [layer.outputs for layer in layers])
+  return tf.sqrt(tf.add_n(layer_squared_norms(layers, deltas)))
+
+
+def _layer_variables(layer):
+  return [v for v in (layer.kernel, layer.bias) if v is not None]
+
+
+class GhostClippingOptimizer(object):
+  """DP-SGD step with ghost clipping around a tf.compat.v1 optimizer.
+
+  groups lists the indices into layers of each clipping group (default: one
+  group of all layers) and l2_norm_clip is one norm for every group or a list
+  with one per group. With a target_quantile the group norms are variables
+  updated every step, which needs clipped_count_stddev.
+  """
+
+  def __init__(self, optimizer, layers, l2_norm_clip, noise_multiplier,
+               run=0, worker=0, groups=None, target_quantile=None,
+               clip_learning_rate=0.2, clipped_count_stddev=None):
+    self._optimizer = optimizer
+    self._layers = layers
+    self._groups = groups or [list(range(len(layers)))]
+    if sorted(i for group in self._groups for i in group) != list(
+        range(len(layers))):
+      raise ValueError('groups must hold every layer index exactly once, '
+                       'got %r' % (groups,))
+    if not isinstance(l2_norm_clip, (list, tuple)):
+      l2_norm_clip = [l2_norm_clip] * len(self._groups)
+    if len(l2_norm_clip) != len(self._groups):
+      raise ValueError('expected %d clipping norms, got %d' %
+                       (len(self._groups), len(l2_norm_clip)))
+    if target_quantile is not None and clipped_count_stddev is None:
+      raise ValueError('adaptive clipping needs clipped_count_stddev')
+    self._l2_norm_clip = [float(c) for c in l2_norm_clip]
+    self._noise_multiplier = noise_multiplier
+    self._target_quantile = target_quantile
+    self._clip_learning_rate = clip_learning_rate
+    self._clipped_count_stddev = clipped_count_stddev
+    self._noise_seed = stream_seed(run, NOISE, worker)
+    self._count_seed = stream_seed(run, CLIPPING, worker)
+
+  def _variables(self):
+    variables = [v for layer in self._layers for v in _layer_variables(layer)]
+    others = set(tf.compat.v1.trainable_variables()) - set(variables)
+    if others:
+      raise ValueError('variables outside the ghost layers would not be '
+                       'clipped: %s' % ', '.join(sorted(v.name for v in others)))
+    return variables
+
+  def clip_norms(self):
+    """Current clipping norm of each group, a variable when adaptive."""
+    if self._target_quantile is None:
+      return tf.constant(self._l2_norm_clip, tf.float32)
+    # Not trainable, but checkpointed: a resumed run keeps its norms
+    return tf.compat.v1.get_variable(
+        'ghost_clip_norms', initializer=self._l2_norm_clip, trainable=False,
+        use_resource=True)
+
+  def compute_gradients(self, loss):
+    """Noised mean of the clipped per-example gradients, as (grad, var).
+
+    loss is the vector of per-example losses. With a target_quantile the
+    gradients also update the clipping norms.
+    """
+    self._variables()
+    clip_norms = self.clip_norms()
+    clips = tf.convert_to_tensor(clip_norms)
+    deltas = tf.gradients(tf.reduce_sum(loss),
+                          [layer.outputs for layer in self._layers])
+    squared = layer_squared_norms(self._layers, deltas)
+    sums, variables, unclipped = [], [], []
+    for g, group in enumerate(self._groups):
+      norms = tf.sqrt(tf.add_n([squared[i] for i in group]))
+      factors = tf.stop_gradient(
+          tf.minimum(1., clips[g] / tf.maximum(norms, 1e-12)))
+      unclipped.append(tf.reduce_sum(tf.cast(norms <= clips[g], tf.float32)))
+      # The clipped sum's output gradients are the factors times deltas
+      for i in group:
+        layer = self._layers[i]
+        scale = tf.reshape(factors, [-1] + [1] * (deltas[i].shape.ndims - 1))
+        sums += tf.gradients(layer.outputs, _layer_variables(layer),
+                             grad_ys=tf.cast(scale, deltas[i].dtype) * deltas[i])
+        variables += _layer_variables(layer)
+    step = tf.cast(tf.compat.v1.train.get_global_step(), tf.int64)
+    seed = tf.stack([tf.constant(self._noise_seed, tf.int64), step])
+    batch = tf.cast(tf.shape(loss)[0], tf.float32)
+    stddev = self._noise_multiplier * tf.norm(clips)
+    grads = [(s + stddev * n) / batch for s, n in
+             zip(sums, stateless_normal_like(sums, seed))]
+    if self._target_quantile is not None:
+      update = self._update_clip_norms(clip_norms, tf.stack(unclipped), step,
+                                       batch, grads)
+      with tf.control_dependencies([update]):
+        grads = [tf.identity(g) for g in grads]
+    return list(zip(grads, variables))
+
+  def _update_clip_norms(self, clip_norms, unclipped, step, batch, grads):
+    seed = tf.stack([tf.constant(self._count_seed, tf.int64), step])
+    noise = tf.random.stateless_normal(tf.shape(unclipped), seed=seed)
+    fraction = (unclipped + self._clipped_count_stddev * noise) / batch
+    # Assigned after the gradients have read the current norms
+    with tf.control_dependencies(grads):
+      return clip_norms.assign(clip_norms.read_value() * tf.exp(
+          -self._clip_learning_rate * (fraction - self._target_quantile)))
+
+  def minimize(self, loss, global_step=None):
+    # The arguments of tf.compat.v1.train.Optimizer.minimize
+    return self._optimizer.apply_gradients(
+        self.compute_gradients(loss), global_step=global_step)
@@ -12,8 +12,13 @@ from absl import app
 from absl import flags
 
 from tensorflow_privacy.privacy.optimizers import dp_optimizer
+from dp_noise import *
+from accountant_cache import *
 from gdp_accountant import *
-from keras.preprocessing import sequence
+from precision import *
+from input_pipeline import *
+from streaming_eval import *
+from training_state import *
 
 #### FLAGS
 flags.DEFINE_boolean('dpsgd', True, 'If True, train with DP-SGD. If False, '
@@ -25,17 +30,24 @@ flags.DEFINE_float('l2_norm_clip', 5, 'Clipping norm')
 flags.DEFINE_integer('epochs', 1, 'Number of epochs')
 flags.DEFINE_string('model_dir', None, 'Model directory')
 flags.DEFINE_float('max_mu', 2, 'Maximum mu before termination')
+flags.DEFINE_boolean('async_eval', False, 'Evaluate each epoch in the '
+                     'background while the next one trains (keeps '
+                     'every checkpoint)')
 flags.DEFINE_string('subsampling', 'Poisson', 'Poisson or Uniform subsampling')
 flags.DEFINE_integer('batch_size', 512, 'Batch size')
 flags.DEFINE_integer(
     'microbatches', 512, 'Number of microbatches '
     '(must evenly divide batch_size)')
+flags.DEFINE_string('precision', 'float32', 'Compute dtype: float32, bfloat16 '
+                    'or float16 (clipping and noise always run in float32)')
+flags.DEFINE_float('loss_scale', 1., 'Static loss scale for float16 training')
+flags.DEFINE_list('bucket_boundaries', ['64', '128', '192', '256'],
+                  'Review-length buckets each batch is split into')
+flags.DEFINE_integer('seed', 0, 'Run seed of the initialization, shuffling '
+                     'and DP noise streams')
 
 FLAGS = flags.FLAGS
 
-np.random.seed(0)
-tf.compat.v1.set_random_seed(0)
-
 max_features = 10000
 # cut texts after this number of words (among top max_features most common words)
 maxlen = 256
@@ -44,11 +56,18 @@ maxlen = 256
 def rnn_model_fn(features, labels, mode):
 
   # Define CNN architecture using tf.keras.layers.
-  input_layer = tf.reshape(features['x'], [-1,maxlen])
-  y = tf.keras.layers.Embedding(max_features,16).apply(input_layer)
-  y=tf.keras.layers.GlobalAveragePooling1D().apply(y)
+  # Each batch arrives split into length buckets, padded with id 0 only up to
+  # the longest review in the bucket; masking keeps each example's output
+  # independent of that length. Pooled buckets are concatenated in label order.
+  embedding = tf.keras.layers.Embedding(max_features,16)
+  pooling = tf.keras.layers.GlobalAveragePooling1D()
+  pooled = [pooling.apply(embedding.apply(x), mask=tf.not_equal(x, 0))
+            for x in bucket_inputs(features)]
+  y = tf.concat(pooled, axis=0)
   y=  tf.keras.layers.Dense(16, activation='relu').apply(y)
   logits=  tf.keras.layers.Dense(2).apply(y)
+  # Loss, per-example clipping and noise are computed in float32.
+  logits = tf.cast(logits, tf.float32)
   
   # Calculate loss as a vector (to support microbatches in DP-SGD).
   vector_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
@@ -64,16 +83,19 @@ def rnn_model_fn(features, labels, mode):
       # available in dp_optimizer. Most optimizers inheriting from
       # tf.train.Optimizer should be wrappable in differentially private
       # counterparts by calling dp_optimizer.optimizer_from_args().
-      optimizer = dp_optimizer.DPAdamGaussianOptimizer(
-          l2_norm_clip=FLAGS.l2_norm_clip,
-          noise_multiplier=FLAGS.noise_multiplier,
+      opt_loss, l2_norm_clip = scale_for_clipping(
+          vector_loss, FLAGS.l2_norm_clip, FLAGS.loss_scale)
+      optimizer = dp_optimizer.DPAdamOptimizer(
+          stateless_gaussian_query(l2_norm_clip, FLAGS.noise_multiplier,
+                                   FLAGS.seed),
           num_microbatches=FLAGS.microbatches,
-          learning_rate=FLAGS.learning_rate)
-      opt_loss = vector_loss
+          learning_rate=FLAGS.learning_rate,
+          epsilon=unscaled_epsilon(1e-8, FLAGS.loss_scale))
     else:
       optimizer = tf.compat.v1.train.AdamOptimizer(
-          learning_rate=FLAGS.learning_rate)
-      opt_loss = scalar_loss
+          learning_rate=FLAGS.learning_rate,
+          epsilon=unscaled_epsilon(1e-8, FLAGS.loss_scale))
+      opt_loss = scalar_loss * FLAGS.loss_scale
     
     global_step = tf.compat.v1.train.get_global_step()
     train_op = optimizer.minimize(loss=opt_loss, global_step=global_step)
@@ -102,67 +124,113 @@ def rnn_model_fn(features, labels, mode):
 def load_imdb():
   (train_data,train_labels), (test_data,test_labels) = tf.keras.datasets.imdb.load_data(num_words=max_features)
 
-  train_data = sequence.pad_sequences(train_data, maxlen=maxlen).astype('float32')
-  test_data = sequence.pad_sequences(test_data, maxlen=maxlen).astype('float32')
-  return train_data,train_labels,test_data,test_labels
+  # Token ids stay uint16 in a packed ragged layout; padding is per batch.
+  train_data = pack_sequences(train_data, maxlen=maxlen)
+  test_data = pack_sequences(test_data, maxlen=maxlen)
+  return train_data,train_labels.astype('int32'),test_data,test_labels.astype('int32')
 
 
 def main(unused_argv):
   tf.compat.v1.logging.set_verbosity(3)
+  set_precision(FLAGS.precision)
 
   # Load training and test data.
   train_data,train_labels,test_data,test_labels = load_imdb()
 
   # Instantiate the tf.Estimator.
-  imdb_classifier = tf.estimator.Estimator(model_fn=rnn_model_fn,
-                                            model_dir=FLAGS.model_dir)
+  imdb_classifier = tf.estimator.Estimator(
+      model_fn=rnn_model_fn,
+      model_dir=FLAGS.model_dir,
+      # --async_eval keeps every checkpoint: an evaluation lagging behind
+      # training must still find its epoch's
+      config=tf.estimator.RunConfig(
+          tf_random_seed=FLAGS.seed,
+          keep_checkpoint_max=None if FLAGS.async_eval else 5))
 
   # Create tf.Estimator input functions for the training and test data.
-  eval_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-    x={'x': test_data},
-    y=test_labels,
+  bucket_boundaries = [int(b) for b in FLAGS.bucket_boundaries]
+  eval_input_fn = sequence_input_fn(
+    test_data,
+    test_labels,
+    batch_size=128,
     num_epochs=1,
-    shuffle=False)
-  train_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-    x={'x': train_data},
-    y=train_labels,
-    batch_size=FLAGS.batch_size,
-    num_epochs=FLAGS.epochs,
-    shuffle=True)
-  # Training loop.
+    shuffle=False,
+    bucket_boundaries=bucket_boundaries)
+  # Resume after the epochs and steps of the last checkpoint, if any.
   steps_per_epoch = 25000 // 512
-  test_accuracy_list = []
+  state = TrainingState(imdb_classifier.model_dir,
+                        {'seed': FLAGS.seed, 'dpsgd': FLAGS.dpsgd,
+                         'noise_multiplier': FLAGS.noise_multiplier,
+                         'batch_size': FLAGS.batch_size,
+                         'subsampling': FLAGS.subsampling})
+  if state.exhausted(FLAGS.max_mu):
+    print('The privacy budget was already spent by this run')
+    return
+  first_epoch, skip = state.resume(checkpoint_step(imdb_classifier.model_dir),
+                                   steps_per_epoch)
+  test_accuracy_list = state.values('accuracy')
+
+  # Report the test metric of an epoch once its evaluation is done.
+  def report(epoch, eval_results):
+    test_accuracy = eval_results['accuracy']
+    test_accuracy_list.append(test_accuracy)
+    print('Test accuracy after %d epochs is: %.3f' % (epoch, test_accuracy))
+    state.snapshot(epoch=epoch, accuracy=test_accuracy)
+
+  # Epochs are evaluated from their checkpoint, here or, with
+  # --async_eval, on a thread while the next epoch trains.
+  evaluations = AsyncEvaluator(
+      lambda path: imdb_classifier.evaluate(input_fn=eval_input_fn,
+                                            checkpoint_path=path),
+      workers=1 if FLAGS.async_eval else 0)
 
-  for epoch in range(1, FLAGS.epochs + 1):
-    np.random.seed(epoch)
+  # Training loop.
+  for epoch in range(first_epoch + 1, FLAGS.epochs + 1):
+    train_input_fn = sequence_input_fn(
+      train_data,
+      train_labels,
+      batch_size=FLAGS.batch_size,
+      num_epochs=1,
+      shuffle=True,
+      bucket_boundaries=bucket_boundaries,
+      seed=stream_seed(FLAGS.seed, SHUFFLE, epoch),
+      skip_batches=skip)
 
     # Train the model for one step.
-    imdb_classifier.train(input_fn=train_input_fn, steps=steps_per_epoch)
+    imdb_classifier.train(input_fn=train_input_fn, steps=steps_per_epoch - skip)
+    skip = 0
 
-    # Evaluate the model and print results
-    eval_results = imdb_classifier.evaluate(input_fn=eval_input_fn)
-    test_accuracy = eval_results['accuracy']
-    test_accuracy_list.append(test_accuracy)
-    print('Test accuracy after %d epochs is: %.3f' % (epoch, test_accuracy))
+    # Evaluate the model in the background if --async_eval
+    evaluations.submit(epoch,
+                       tf.train.latest_checkpoint(imdb_classifier.model_dir))
     
     # Compute the privacy budget expended so far.
+    mu = None
     if FLAGS.dpsgd:
         if FLAGS.subsampling=='Poisson':
-            eps = compute_epsP(epoch,FLAGS.noise_multiplier,25000,512,1e-5)
+            eps = cached_epsP(epoch,FLAGS.noise_multiplier,25000,512,1e-5)
             mu = compute_muP(epoch,FLAGS.noise_multiplier,25000,512)
         if FLAGS.subsampling=='Uniform':
-            eps = compute_epsU(epoch,FLAGS.noise_multiplier,25000,512,1e-5)
+            eps = cached_epsU(epoch,FLAGS.noise_multiplier,25000,512,1e-5)
             mu = compute_muU(epoch,FLAGS.noise_multiplier,25000,512)
       
         print('For delta=1e-5, the current MA epsilon is: %.2f' % 
-              compute_epsilon(epoch,FLAGS.noise_multiplier,25000,512,1e-5))
+              cached_epsilon(epoch,FLAGS.noise_multiplier,25000,512,1e-5))
         print('For delta=1e-5, the current CLT epsilon is: %.2f' % eps)
         print('For delta=1e-5, the current mu is: %.2f' % mu)
-      
-        if mu>FLAGS.max_mu:
-            break
     else:
       print('Trained with vanilla non-private SGD optimizer')
+
+    # The budget check does not wait for the evaluation
+    state.snapshot(epoch=epoch, global_step=epoch * steps_per_epoch, mu=mu)
+    for done in evaluations.completed():
+      report(*done)
+    if FLAGS.dpsgd and mu>FLAGS.max_mu:
+      break
+  for done in evaluations.drain():
+    report(*done)
+  evaluations.close()
+  state.close()
     
 if __name__ == '__main__':
   app.run(main)
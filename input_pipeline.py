@@ -0,0 +1,270 @@
+r"""tf.data input pipelines shared by the tutorials.
+
+`array_input_fn` replaces numpy_input_fn, whose Python queue runners assemble
+batches on a single thread while the training step waits. Only example
+indices go through tf.data: they are shuffled and batched there, the rows of
+each batch are gathered from the host arrays by parallel map calls, and
+batches are prefetched so that assembly overlaps with the training step.
+The arrays themselves never become graph constants, which would otherwise
+be copied into every checkpoint's meta graph by the Estimator.
+
+Token sequences are packed into one flat uint16 array plus int64 row offsets
+(a CSR-style ragged layout) instead of a padded float32 matrix, and are only
+padded per batch, to the longest sequence in that batch. Models consuming
+these batches must mask id 0 so that an example's output does not depend on
+the other examples it is batched with, which per-example clipping requires.
+
+Tabular datasets whose features are binary (or small integers) are stored
+by `save_table` as an .npz of bit-packed (or uint8) rows together with the
+index of every split, so loading one is a single read with no CSV parsing,
+and a split stays packed in memory (16 bytes per Adult row instead of 492).
+Rows are unpacked to float32 per batch by the map_fn `load_table` returns.
+
+Batches can further be split into length buckets. Each batch is drawn first
+(by the same shuffling the accountant assumes) and only then split, so which
+examples are trained on together never depends on their length. Bucketing
+the whole dataset by length (tf.data's bucket_by_sequence_length) would make
+batch membership data-dependent and invalidate the subsampling analysis.
+"""
+
+import itertools
+
+import numpy as np
+import tensorflow as tf
+
+
+def pack_sequences(sequences, maxlen=None, dtype=np.uint16):
+  """Packs variable-length id sequences into (values, offsets).
+
+  Sequence i is values[offsets[i]:offsets[i + 1]]. With maxlen, only the last
+  maxlen ids of each sequence are kept, as sequence.pad_sequences does.
+  """
+  if maxlen is not None:
+    sequences = [s[-maxlen:] for s in sequences]
+  lengths = np.fromiter((len(s) for s in sequences), dtype=np.int64,
+                        count=len(sequences))
+  offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+  np.cumsum(lengths, out=offsets[1:])
+  values = np.fromiter(itertools.chain.from_iterable(sequences),
+                       dtype=np.int64, count=offsets[-1])
+  if values.size and (values.min() < 0 or values.max() > np.iinfo(dtype).max):
+    raise ValueError('ids do not fit in %s' % np.dtype(dtype).name)
+  return values.astype(dtype), offsets
+
+
+def sequence_input_fn(packed, labels, batch_size, num_epochs=1,
+                      shuffle=False, bucket_boundaries=None, seed=None,
+                      skip_batches=0):
+  """Returns an Estimator input_fn over packed sequences.
+
+  Each batch is split into features 'x0', 'x1', ..., where bucket k holds the
+  sequences of length at most bucket_boundaries[k] (one bucket by default),
+  padded with id 0 to the longest sequence in the bucket and cast to int32
+  for the embedding lookup. Labels follow the concatenated bucket order, see
+  `bucket_inputs`. Training batches (shuffle=True) drop the final partial
+  batch so that microbatches always divide the batch size. seed fixes the
+  shuffling order; skip_batches drops the first batches, e.g. those already
+  trained on before a restart.
+  """
+  values, offsets = packed
+  longest = int(np.diff(offsets).max(initial=0))
+  boundaries = sorted(bucket_boundaries or [longest])
+  if longest > boundaries[-1]:
+    raise ValueError('sequences of length %d exceed the last bucket '
+                     'boundary %d' % (longest, boundaries[-1]))
+
+  def split_buckets(features, y):
+    x = features['x']
+    lengths = tf.reduce_sum(tf.cast(tf.not_equal(x, 0), tf.int32), axis=1)
+    bucket = tf.searchsorted(tf.constant(boundaries, tf.int32), lengths)
+    buckets, order = {}, []
+    for k in range(len(boundaries)):
+      index = tf.where(tf.equal(bucket, k))[:, 0]
+      width = tf.reduce_max(tf.concat([[0], tf.gather(lengths, index)], 0))
+      buckets['x%d' % k] = tf.cast(tf.gather(x, index)[:, :width], tf.int32)
+      order.append(index)
+    return buckets, tf.gather(y, tf.concat(order, 0))
+
+  def input_fn():
+    sequences = tf.RaggedTensor.from_row_splits(values, offsets)
+    dataset = tf.data.Dataset.from_tensor_slices(({'x': sequences}, labels))
+    if shuffle:
+      dataset = dataset.shuffle(len(labels), seed=seed)
+    dataset = dataset.repeat(num_epochs)
+    dataset = dataset.padded_batch(batch_size,
+                                   padded_shapes=({'x': [None]}, []),
+                                   drop_remainder=shuffle)
+    dataset = dataset.skip(skip_batches)
+    dataset = dataset.map(split_buckets,
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+  return input_fn
+
+
+def array_input_fn(x, y, batch_size=128, num_epochs=1, shuffle=False,
+                   map_fn=None, cache=None, seed=None, skip_batches=0):
+  """Returns an Estimator input_fn over a dict of arrays x and labels y.
+
+  Batches follow numpy_input_fn: with shuffle=True every epoch is a fresh
+  permutation of the examples, and the final partial batch is dropped so that
+  microbatches always divide the batch size. map_fn(features, labels), if
+  given, preprocesses whole batches in parallel. cache='' keeps the
+  preprocessed batches in memory and cache=<filename> on disk; it only makes
+  sense for unshuffled data such as the test set. seed fixes the shuffling
+  order; skip_batches drops the first batches, e.g. those already trained on
+  before a restart.
+  """
+  names = sorted(x)
+  arrays = [x[name] for name in names] + [y]
+  dtypes = [tf.as_dtype(a.dtype) for a in arrays]
+  autotune = tf.data.experimental.AUTOTUNE
+
+  def gather(index):
+    rows = tf.numpy_function(lambda i: [a[i] for a in arrays], [index], dtypes)
+    for row, a in zip(rows, arrays):
+      row.set_shape([None] + list(a.shape[1:]))
+    return dict(zip(names, rows[:-1])), rows[-1]
+
+  def input_fn():
+    dataset = _index_batches(len(y), batch_size, num_epochs, shuffle, seed,
+                             skip_batches)
+    dataset = dataset.map(gather, num_parallel_calls=autotune)
+    if map_fn is not None:
+      dataset = dataset.map(map_fn, num_parallel_calls=autotune)
+    if cache is not None:
+      dataset = dataset.cache(cache)
+    return dataset.prefetch(autotune)
+
+  return input_fn
+
+
+def csr_input_fn(csr, y, num_features, batch_size=128, num_epochs=1,
+                 shuffle=False, seed=None, skip_batches=0):
+  """Returns an Estimator input_fn over CSR rows, e.g. from load_table_csr.
+
+  csr is (columns, values, offsets): row i has the nonzeros values[k] (1 if
+  values is None) at columns[k] for offsets[i] <= k < offsets[i + 1]. Each
+  batch is a float32 SparseTensor 'x' of shape [batch, num_features] built
+  from the batch's nonzeros only, with int32 labels. Batching follows
+  array_input_fn.
+  """
+  columns, values, offsets = csr
+  autotune = tf.data.experimental.AUTOTUNE
+
+  def rows(index):
+    starts, lengths = offsets[index], offsets[index + 1] - offsets[index]
+    take = (np.repeat(starts - np.cumsum(lengths) + lengths, lengths) +
+            np.arange(lengths.sum()))
+    row = np.repeat(np.arange(len(index)), lengths)
+    nonzeros = (np.ones(len(take), np.float32) if values is None else
+                values[take].astype(np.float32))
+    return (np.stack([row, columns[take]], axis=1).astype(np.int64), nonzeros,
+            y[index].astype(np.int32))
+
+  def gather(index):
+    indices, nonzeros, labels = tf.numpy_function(
+        rows, [index], [tf.int64, tf.float32, tf.int32])
+    indices.set_shape([None, 2])
+    nonzeros.set_shape([None])
+    labels.set_shape([None])
+    shape = tf.stack([tf.size(index, out_type=tf.int64),
+                      tf.constant(num_features, tf.int64)])
+    return {'x': tf.SparseTensor(indices, nonzeros, shape)}, labels
+
+  def input_fn():
+    dataset = _index_batches(len(y), batch_size, num_epochs, shuffle, seed,
+                             skip_batches)
+    dataset = dataset.map(gather, num_parallel_calls=autotune)
+    return dataset.prefetch(autotune)
+
+  return input_fn
+
+
+def _index_batches(size, batch_size, num_epochs, shuffle, seed, skip_batches):
+  """Batches of example indices, shuffled per epoch with shuffle=True."""
+  dataset = tf.data.Dataset.range(size)
+  if shuffle:
+    dataset = dataset.shuffle(size, seed=seed, reshuffle_each_iteration=True)
+  dataset = dataset.repeat(num_epochs)
+  dataset = dataset.batch(batch_size, drop_remainder=shuffle)
+  return dataset.skip(skip_batches)
+
+
+def save_table(path, features, labels, splits):
+  """Writes features, labels and split indices to a save_table .npz file.
+
+  features are bit-packed when every value is 0 or 1 and stored as uint8
+  otherwise; splits maps split names, e.g. 'train', to row indices.
+  """
+  features = np.asarray(features)
+  binary = bool(np.isin(features, (0, 1)).all())
+  if not binary and (features.min() < 0 or features.max() > 255 or
+                     (features != np.round(features)).any()):
+    raise ValueError('features must be integers in [0, 255]')
+  x = np.packbits(features.astype(bool), axis=1) if binary else (
+      features.astype(np.uint8))
+  index = {'split_' + name: np.asarray(rows, dtype=np.int64)
+           for name, rows in splits.items()}
+  np.savez(path, x=x, y=np.asarray(labels), binary=binary,
+           num_features=features.shape[1], **index)
+
+
+def load_table(path, split):
+  """Returns (x, y, map_fn) for a split of a save_table file.
+
+  x stays packed; pass map_fn to array_input_fn to unpack each batch to a
+  float32 'x' (and cast the labels to int32) inside the pipeline.
+  """
+  with np.load(path) as table:
+    index = table['split_' + split]
+    x, y = table['x'][index], table['y'][index]
+    return x, y, unpack_table(int(table['num_features']), bool(table['binary']))
+
+
+def load_table_csr(path, split, chunk_rows=65536):
+  """Returns ((columns, values, offsets), y, num_features) for csr_input_fn.
+
+  values is None for bit-packed tables, whose nonzeros are all 1. Rows are
+  converted chunk_rows at a time, so the dense rows never exist at once.
+  """
+  with np.load(path) as table:
+    index = table['split_' + split]
+    x, y = table['x'][index], table['y'][index]
+    num_features, binary = int(table['num_features']), bool(table['binary'])
+  columns, values = [np.zeros(0, np.int32)], [np.zeros(0, np.uint8)]
+  lengths = [np.zeros(0, np.int64)]
+  for start in range(0, len(x), chunk_rows):
+    chunk = x[start:start + chunk_rows]
+    if binary:
+      chunk = np.unpackbits(chunk, axis=1, count=num_features)
+    row, column = np.nonzero(chunk)
+    columns.append(column.astype(np.int32))
+    values.append(chunk[row, column])
+    lengths.append(np.bincount(row, minlength=len(chunk)))
+  offsets = np.zeros(len(x) + 1, dtype=np.int64)
+  np.cumsum(np.concatenate(lengths), out=offsets[1:])
+  values = None if binary else np.concatenate(values)
+  return (np.concatenate(columns), values, offsets), y, num_features
+
+
+def unpack_table(num_features, binary):
+  """map_fn turning packed batches of a save_table file into float32."""
+  def map_fn(features, labels):
+    x = features['x']
+    if binary:
+      # np.packbits stores the first feature in the most significant bit
+      weights = tf.constant([128, 64, 32, 16, 8, 4, 2, 1], tf.uint8)
+      bits = tf.bitwise.bitwise_and(tf.expand_dims(x, -1), weights)
+      x = tf.reshape(tf.cast(tf.not_equal(bits, 0), tf.float32),
+                     [-1, x.shape[1] * 8])[:, :num_features]
+    else:
+      x = tf.cast(x, tf.float32)
+    return dict(features, x=x), tf.cast(labels, tf.int32)
+
+  return map_fn
+
+
+def bucket_inputs(features):
+  """Bucket tensors of a `sequence_input_fn` batch, in label order."""
+  return [features['x%d' % k] for k in range(len(features))]
@@ -1,237 +1,440 @@
-import pickle
+r"""Reproduces the MNIST figures of the paper as a cached, parallel report.
+
+Each figure is a task: a draw function, its parameters and its inputs. The
+inputs are either accountant arrays (Accountant: a function of this module
+and its arguments) or runs read from the results store (Results: the
+pickles of finished trainings). Every input has a key hashing what it
+depends on: the arguments and source of its function and the accountant
+modules for Accountant, the file contents for Results. A figure's key
+combines its inputs' keys with its own parameters, its draw code and the
+accountant modules. The source of a function includes that of every
+function of this module it calls, e.g. _finish and _dp_tradeoff, so
+editing a helper redraws the figures that use it.
+
+A run recomputes only the missing inputs and redraws only the figures whose
+key changed since they were last written (or whose PDF is gone): inputs
+first, then figures, each stage in a process pool. Drawing uses the
+headless Agg backend, so the report runs on servers without a display.
+
+Example:
+  python mnist_plot.py --output_dir=figures --workers=8
+  python mnist_plot.py --only=sigma_best.pdf,delta_07.pdf --force
+"""
+
+import hashlib
+import inspect
+import json
 import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import numpy as np
-import pandas as pd
-from matplotlib.pyplot import *
 from scipy.stats import norm
-from scipy import optimize
-from tensorflow_privacy.privacy.analysis.rdp_accountant import compute_rdp
-from tensorflow_privacy.privacy.analysis.rdp_accountant import get_privacy_spent
-from privacy_accountants import *
-
-rc('xtick',labelsize=12)
-rc('ytick',labelsize=12)
-####### MNIST accuracy boost by adding necessary noise 1
-MAnoise=pickle.load(open(os.getcwd()+"/pickle/MNIST_MA1.pkl","rb"))
-CLTnoise=pickle.load(open(os.getcwd()+"/pickle/MNIST_CLT1.pkl","rb"))
-NOnoise=pickle.load(open(os.getcwd()+"/pickle/MNIST_NO1.pkl","rb"))
-
-
-l1=plot(np.arange(1,71),MAnoise,linewidth=2,color='royalblue',
-                label='MA $\sigma$',linestyle='dashed')
-xlabel('epochs',fontsize=15)
-ylabel('accuracy',fontsize=15)
-title('Accuracy with different noise scales',fontsize=16)
-l2=plot(np.arange(1,71),NOnoise,linewidth=2,linestyle='-.',
-                   color='k',label='Non-private')
-l3=plot(np.arange(1,71),CLTnoise,linewidth=2,
-                   color='r',label='CLT $\widetilde\sigma$')
-legend(loc='lower right',fontsize=12)
-savefig(fname="acc_best.pdf",format="pdf")
-show()
-
-
-#### make sure final epsilon budget is the same
-final_eps=compute_epsilon(70,0.7,60000,256,1e-5)
-final_geps=compute_epsP(70,0.64,60000,256,1e-5)
-
-eps=[compute_epsilon(i,0.7,60000,256,1e-5) for i in np.arange(1,71)]
-geps=[compute_epsP(i,0.64,60000,256,1e-5) for i in np.arange(1,71)]
-xlabel('epochs',fontsize=15)
-ylabel('$\epsilon$',fontsize=15)
-title('Privacy cost versus epochs',fontsize=16)
-l1=plot(np.arange(1,71),geps,label='CLT $\epsilon$',linewidth=2,color='red')
-l2=plot(np.arange(1,71),eps,label='MA $\epsilon$',linewidth=2,color='royalblue',linestyle='dashed')
-legend(loc='lower right',fontsize=12)
-savefig(fname="private_everywhere.pdf",format="pdf")
-show()
-
-
-
-####### MNIST accuracy boost by adding necessary noise 2
-MAnoise=pickle.load(open(os.getcwd()+"/pickle/boost2.pkl","rb"))
-CLTnoise=pickle.load(open(os.getcwd()+"/pickle/boost1.pkl","rb"))
-NOnoise=pickle.load(open(os.getcwd()+"/pickle/boost_nonprivate.pkl","rb"))
-
-
-l1=plot(np.arange(1,20),MAnoise,linewidth=2,color='royalblue',
-                label='MA $\sigma$',linestyle='dashed')
-xlabel('epochs',fontsize=15)
-ylabel('accuracy',fontsize=15)
-title('Accuracy with different noise scales',fontsize=16)
-l2=plot(np.arange(1,20),NOnoise,linewidth=2,linestyle='-.',
-                   color='k',label='Non-private')
-l3=plot(np.arange(1,20),CLTnoise,linewidth=2,
-                   color='r',label='CLT $\widetilde\sigma$')
-legend(loc='lower right',fontsize=12)
-savefig(fname="acc_best2.pdf",format="pdf")
-show()
-
-
-#### make sure final epsilon budget is the same
-final_eps=compute_epsilon(20,1.3,60000,256,1e-5)
-final_geps=compute_epsP(20,1.06,60000,256,1e-5)
-
-eps=[compute_epsilon(i,1.3,60000,256,1e-5) for i in np.arange(1,21)]
-geps=[compute_epsP(i,1.06,60000,256,1e-5) for i in np.arange(1,21)]
-xlabel('epochs',fontsize=15)
-ylabel('$\epsilon$',fontsize=15)
-title('Privacy cost versus epochs',fontsize=16)
-l1=plot(np.arange(1,21),geps,label='CLT $\epsilon$',linewidth=2,color='red')
-l2=plot(np.arange(1,21),eps,label='MA $\epsilon$',linewidth=2,color='royalblue',linestyle='dashed')
-legend(loc='lower right',fontsize=12)
-savefig(fname="private_everywhere2.pdf",format="pdf")
-show()
-
-
-
-
-
-
-
-
-
-###### MNIST epsilon comparision
-gdp_epsilon=[compute_epsP(i,0.7,60000,256,1e-5) for i in range(10,101)]
-dp_epsilon=[compute_epsilon(i,0.7,60000,256,1e-5) for i in range(10,101)]
-l1=plot(np.arange(10,101)*60000/256/1000,gdp_epsilon,label='CLT $\epsilon$',linewidth=2,color='red')
-l2=plot(np.arange(10,101)*60000/256/1000,dp_epsilon,label='MA $\epsilon$',linewidth=2,color='royalblue',linestyle='dashed')
-xlabel('iterations/1000',fontsize=15)
-title('Privacy cost versus iterations',fontsize=16)
-autoscale(axis='x',tight=True)
-legend(loc='lower right',fontsize=12)
-savefig(fname="epsilon_07.pdf",format="pdf")
-show()
-
-###### MNIST delta comparision
-delta_MA=np.concatenate((np.arange(1e-5,1e-2,1e-4),np.arange(1e-2,1,1e-2)))
-dp_epsilon2=[compute_epsilon(100,0.7,60000,256,i) for i in delta_MA]
-gdp_mu=compute_muP(100,0.7,60000,256)
-delta_CLT=[delta_eps_mu(i,gdp_mu) for i in dp_epsilon2]
-l1=plot(dp_epsilon2,delta_CLT,label='CLT $\delta$',linewidth=2,color='red')
-l2=plot(dp_epsilon2,delta_MA,label='MA $\delta$',linewidth=2,color='royalblue',linestyle='dashed')
-xlabel('$\epsilon$',fontsize=15)
-title('$\delta$ versus $\epsilon$',fontsize=16)
-legend(loc='upper right',fontsize=12)
-savefig(fname="delta_07.pdf",format="pdf")
-show()
-
-
-###### MNIST delta comparision2
-delta=np.concatenate((np.arange(1e-6,1.5e-5,1e-6),np.arange(2e-5,1e-4,1e-5)))
-dp_epsilon3=[compute_epsilon(100,0.7,60000,256,i) for i in delta]
-gdp_epsilon=[compute_epsP(100,0.7,60000,256,i) for i in delta]
-l1=plot(delta,gdp_epsilon,label='CLT $\epsilon$',linewidth=2,color='red')
-l2=plot(delta,dp_epsilon3,label='MA $\epsilon$',linewidth=2,color='royalblue',linestyle='dashed')
-xlabel('$\delta$',fontsize=15)
-title('$\epsilon$ versus $\delta$',fontsize=16)
-legend(loc='upper right',fontsize=12)
-savefig(fname="delta_x.pdf",format="pdf")
-show()
-
-
-###### MNIST noise comparision
-dp_epsilon4=[compute_epsilon(100,i,60000,256,1e-5) for i in np.arange(0.7,3,0.1)]
-gdp_noise=[noise_multi_from_epsP(i,100,60000,256,1e-5) for i in dp_epsilon4]
-l1=plot(dp_epsilon4,gdp_noise,label=r'CLT $\widetilde{\sigma}$',linewidth=2,color='red')
-l2=plot(dp_epsilon4,np.arange(0.7,3,0.1),linewidth=2,
-        label='MA $\sigma$',color='royalblue',linestyle='dashed')
-xlabel('$\epsilon$',fontsize=15)
-title('Noise scale versus $\epsilon$',fontsize=16)
-autoscale(axis='x',tight=True)
-legend(loc='upper right',fontsize=12)
-savefig(fname="sigma_best.pdf",format="pdf")
-show()
-
-####### MNIST trade-off diagrams
-def plot_tradeoff(eps,mu,title_name,save):
-    l1=plot(np.arange(0,1.01,0.01),norm.cdf(norm.ppf(1-np.arange(0,1.01,0.01))-mu),color='r',linewidth=2,label=str(mu)+'-GDP by CLT')
-    x_array1=np.arange(0,(1-np.exp(-eps))/(np.exp(eps)-np.exp(-eps)),0.01)
-    x_array2=np.arange((1-np.exp(-eps))/(np.exp(eps)-np.exp(-eps)),1.01,0.01)
-    y_array1=-np.exp(eps)*x_array1+1
-    y_array2=-np.exp(-eps)*(x_array2-1)
-    l2=plot(np.concatenate((x_array1+0.003,x_array2+0.003)),np.concatenate((y_array1,y_array2)),color='royalblue',linewidth=2,linestyle='--',label='('+str(eps)+',1e-5)-DP by MA')
-    xlabel('Type I error',fontsize=15)
-    ylabel('Type II error',fontsize=15)
-    xlim(0,1);ylim(0,1)
-    title(title_name,fontsize=16)
-    legend(loc='upper right',fontsize=12)
-    gca().set_aspect('equal', adjustable='box')
-    savefig(fname=save,format="pdf",bbox_inches='tight')
-    show()
-    return None
-
-plot_tradeoff(1.19,0.23,'95.0% accuracy, $\sigma=1.3$','tradeoff023.pdf')
-plot_tradeoff(3.01,0.57,'96.6% accuracy, $\sigma=1.1$','tradeoff057.pdf')
-plot_tradeoff(7.10,1.13,'97.0% accuracy, $\sigma=0.7$','tradeoff113.pdf')
-plot_tradeoff(13.27,2.00,'97.6% accuracy, $\sigma=0.6$','tradeoff200.pdf')
-plot_tradeoff(18.72,2.76,'97.8% accuracy, $\sigma=0.55$','tradeoff276.pdf')
-plot_tradeoff(32.40,4.78,'98.0% accuracy, $\sigma=0.5$','tradeoff478.pdf')
-
-
-
-
-####### MNIST trade-off diagrams
-def plot_tradeoff_envelope(mu,sigma,E,title_name,save):
-    l1=plot(np.arange(0,1.01,0.01),norm.cdf(norm.ppf(1-np.arange(0,1.01,0.01))-mu),color='r',linewidth=2,label=str(mu)+'-GDP by CLT')
-    rowIndex=np.arange(1e-5,0.1,1e-3)
-    frame=pd.DataFrame(0,index=rowIndex,columns=np.arange(0,1.01,0.01))
-    
-    row=0
-    for delta in rowIndex:
-        eps=compute_epsilon(E,sigma,60000,256,delta)
-        breaking=(1-np.exp(-eps))/(np.exp(eps)-np.exp(-eps))*(1-delta)
-        x_array1=np.arange(0,breaking,0.01)
-        x_array2=np.arange(breaking,1,0.01)
-        y_array1=-np.exp(eps)*x_array1+1-delta
-        y_array2=np.exp(-eps)*(1-delta-x_array2)
-        frame.iloc[row,:len(y_array1)]=y_array1;frame.iloc[row,len(y_array1):]=y_array2; row+=1
-    
-    l2=plot(np.concatenate((x_array1,x_array2)),frame.max(),color='royalblue',linewidth=2,linestyle='--',label='($\epsilon,\delta$)-DP by MA')
-    xlabel('Type I error',fontsize=15)
-    ylabel('Type II error',fontsize=15)
-    xlim(0,1);ylim(0,1)
-    title(title_name,fontsize=16)
-    legend(loc='upper right',fontsize=12)
-    gca().set_aspect('equal', adjustable='box')
-    savefig(fname=save,format="pdf",bbox_inches='tight')
-    show()
-    return None
-
-plot_tradeoff_envelope(0.23,1.3,15,'95.0% accuracy, $\sigma=1.3$','envelope_tradeoff023.pdf')
-plot_tradeoff_envelope(0.57,1.1,60,'96.6% accuracy, $\sigma=1.1$','envelope_tradeoff057.pdf')
-plot_tradeoff_envelope(1.13,0.7,45,'97.0% accuracy, $\sigma=0.7$','envelope_tradeoff113.pdf')
-
-
-
-
-
-
-####### MNIST trade-off diagrams, with shade
-def plot_tradeoff_envelopeS(mu,sigma,E,title_name,save):
-    l1=plot(np.arange(0,1.01,0.01),norm.cdf(norm.ppf(1-np.arange(0,1.01,0.01))-mu),color='r',linewidth=2,label=str(mu)+'-GDP by CLT')
-    
-    row=0
-    for delta in np.arange(1e-5,1,1e-3):
-        eps=compute_epsilon(E,sigma,60000,256,delta)
-        breaking=(1-np.exp(-eps))/(np.exp(eps)-np.exp(-eps))*(1-delta)
-        x_array1=np.arange(0,breaking,0.01)
-        x_array2=np.arange(breaking,1,0.01)
-        y_array1=-np.exp(eps)*x_array1+1-delta
-        y_array2=np.exp(-eps)*(1-delta-x_array2)
-        plot(np.concatenate((x_array1+0.002,x_array2+0.002)),np.concatenate((y_array1,y_array2)),color='royalblue',linewidth=2)
-    
-    l2=plot(np.concatenate((x_array1+0.002,x_array2+0.002)),np.concatenate((y_array1,y_array2)),color='royalblue',linewidth=2,label='($\epsilon,\delta$)-DP by MA')
-    xlabel('Type I error',fontsize=15)
-    ylabel('Type II error',fontsize=15)
-    xlim(0,1);ylim(0,1)
-    title(title_name,fontsize=16)
-    legend(loc='upper right',fontsize=12)
-    gca().set_aspect('equal', adjustable='box')
-    savefig(fname=save,format="pdf",bbox_inches='tight')
-    show()
-    return None
-
-plot_tradeoff_envelopeS(0.23,1.3,15,'95.0% accuracy, $\sigma=1.3$','envelope_tradeoff023S.pdf')
-plot_tradeoff_envelopeS(0.57,1.1,60,'96.6% accuracy, $\sigma=1.1$','envelope_tradeoff057S.pdf')
-plot_tradeoff_envelopeS(1.13,0.7,45,'97.0% accuracy, $\sigma=0.7$','envelope_tradeoff113S.pdf')
+
+from absl import app
+from absl import flags
+
+import gdp_accountant
+from gdp_accountant import *
+from privacy_profile import *
+
+flags.DEFINE_string('output_dir', '.', 'Directory of the figures')
+flags.DEFINE_string('results_dir', 'pickle', 'Directory of the results store')
+flags.DEFINE_string('cache_dir', '.report_cache', 'Directory of the cached inputs')
+flags.DEFINE_integer('workers', os.cpu_count(), 'Processes computing inputs and figures')
+flags.DEFINE_list('only', [], 'Figures to make (default: all)')
+flags.DEFINE_boolean('force', False, 'Redraw figures even if their inputs did not change')
+
+FLAGS = flags.FLAGS
+
+_MODULE_DIR=os.path.dirname(os.path.abspath(__file__))
+# Directory of the results store, set in every worker by make_report
+RESULTS_DIR='pickle'
+_ACCOUNTANT_FILES=['gdp_accountant.py','pld_accountant.py','edgeworth_accountant.py',
+                   'privacy_profile.py']
+
+
+def _digest(value):
+    """Stable hash of arrays, inputs, containers and plain values."""
+    h=hashlib.sha256()
+    def update(v):
+        if isinstance(v,_Input):
+            h.update(b'input'+v.key.encode())
+        elif isinstance(v,np.ndarray):
+            h.update(repr((v.dtype.str,v.shape)).encode()+np.ascontiguousarray(v).tobytes())
+        elif isinstance(v,(list,tuple)):
+            h.update(b'%d[' % len(v))
+            for item in v:
+                update(item)
+        elif isinstance(v,dict):
+            update(sorted(v.items()))
+        else:
+            h.update(repr(v).encode())
+    update(value)
+    return h.hexdigest()
+
+
+def _file_digest(path):
+    with open(path,'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _accountant_digest():
+    """Hash of the accountant modules and the tensorflow_privacy release."""
+    return _digest([_file_digest(os.path.join(_MODULE_DIR,name)) for name in _ACCOUNTANT_FILES]+
+                   [tensorflow_privacy_version()])
+
+
+def _source(function,seen=None):
+    """Source of function and of the functions of this module it calls."""
+    seen=set() if seen is None else seen
+    seen.add(function.__name__)
+    sources=[inspect.getsource(function)]
+    for name in sorted(_names(function.__code__)-seen):
+        value=globals().get(name)
+        if inspect.isfunction(value) and value.__module__==__name__:
+            sources.append(_source(value,seen))
+    return ''.join(sources)
+
+def _names(code):
+    names=set(code.co_names)
+    for constant in code.co_consts:
+        if inspect.iscode(constant):
+            names|=_names(constant)
+    return names
+
+
+class _Input(object):
+
+    def load(self,cache_dir):
+        path=os.path.join(cache_dir,'inputs',self.key+'.pkl')
+        if os.path.exists(path):
+            with open(path,'rb') as f:
+                return pickle.load(f)
+        value=self.compute(cache_dir)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        # Written under a temporary name, so readers never see a partial file
+        tmp='%s.%d' % (path,os.getpid())
+        with open(tmp,'wb') as f:
+            pickle.dump(value,f)
+        os.replace(tmp,path)
+        return value
+
+    def cached(self,cache_dir):
+        return os.path.exists(os.path.join(cache_dir,'inputs',self.key+'.pkl'))
+
+
+class Accountant(_Input):
+    """Array computed by function(*args); arguments may be other inputs."""
+
+    def __init__(self,function,*args):
+        self.function=function
+        self.args=args
+
+    @property
+    def key(self):
+        if not hasattr(self,'_key'):
+            self._key=_digest([self.function.__name__,_source(self.function),
+                               list(self.args),_accountant_digest()])
+        return self._key
+
+    def dependencies(self):
+        return [a for a in self.args if isinstance(a,_Input)]
+
+    def compute(self,cache_dir):
+        args=[a.load(cache_dir) if isinstance(a,_Input) else a for a in self.args]
+        return self.function(*args)
+
+
+class Results(_Input):
+    """A run from the results store, keyed by the contents of its file."""
+
+    def __init__(self,name):
+        self.name=name
+
+    @property
+    def key(self):
+        return _digest(['results',self.name,_file_digest(self.path)])
+
+    @property
+    def path(self):
+        return os.path.join(RESULTS_DIR,self.name)
+
+    def dependencies(self):
+        return []
+
+    def compute(self,cache_dir):
+        with open(self.path,'rb') as f:
+            return np.asarray(pickle.load(f))
+
+
+class Figure(object):
+    """A PDF drawn by draw(ax, **inputs, **params) from cached inputs."""
+
+    def __init__(self,filename,draw,inputs=None,**params):
+        self.filename=filename
+        self.draw=draw
+        self.inputs=dict(inputs or {})
+        self.params=params
+
+    @property
+    def key(self):
+        return _digest([self.filename,_source(self.draw),self.params,_accountant_digest(),
+                        sorted((name,i.key) for name,i in self.inputs.items())])
+
+    def render(self,output_dir,cache_dir):
+        values={name:i.load(cache_dir) for name,i in self.inputs.items()}
+        fig,ax=plt.subplots()
+        try:
+            bbox=self.draw(ax,**dict(values,**self.params))
+            fig.savefig(os.path.join(output_dir,self.filename),format='pdf',bbox_inches=bbox)
+        finally:
+            plt.close(fig)
+
+
+####### Accountant arrays
+# MA epsilon after each of epochs; RDP is linear in the number of steps
+def ma_eps_by_epoch(epochs,noise_multi,N,batch_size,delta):
+    rdp=compute_rdp_vector(1,noise_multi,N,batch_size)
+    return np.array([eps_from_rdp(e*rdp,delta) for e in epochs])
+
+def clt_eps_by_epoch(epochs,noise_multi,N,batch_size,delta):
+    return np.array([compute_epsP(e,noise_multi,N,batch_size,delta) for e in epochs])
+
+def ma_eps_by_delta(epoch,noise_multi,N,batch_size,deltas):
+    rdp=compute_rdp_vector(epoch,noise_multi,N,batch_size)
+    return np.array([eps_from_rdp(rdp,d) for d in deltas])
+
+def clt_eps_by_delta(epoch,noise_multi,N,batch_size,deltas):
+    return gdp_profile(compute_muP(epoch,noise_multi,N,batch_size),deltas)
+
+def clt_delta_by_eps(epoch,noise_multi,N,batch_size,eps):
+    return delta_eps_mu(np.asarray(eps),compute_muP(epoch,noise_multi,N,batch_size))
+
+def ma_eps_by_noise(epoch,noise_multis,N,batch_size,delta):
+    return np.array([compute_epsilon(epoch,s,N,batch_size,delta) for s in noise_multis])
+
+def clt_noise_by_eps(eps,epoch,N,batch_size,delta):
+    return np.array([noise_multi_from_epsP(e,epoch,N,batch_size,delta) for e in eps])
+
+
+####### Drawing
+def _finish(ax,xlabel,title,loc,ylabel=None):
+    ax.set_xlabel(xlabel,fontsize=15)
+    if ylabel:
+        ax.set_ylabel(ylabel,fontsize=15)
+    ax.set_title(title,fontsize=16)
+    ax.legend(loc=loc,fontsize=12)
+    ax.tick_params(labelsize=12)
+
+def draw_accuracy(ax,ma,clt,nonprivate):
+    epochs=np.arange(1,len(ma)+1)
+    ax.plot(epochs,ma,linewidth=2,color='royalblue',label=r'MA $\sigma$',linestyle='dashed')
+    ax.plot(epochs,nonprivate,linewidth=2,linestyle='-.',color='k',label='Non-private')
+    ax.plot(epochs,clt,linewidth=2,color='r',label=r'CLT $\widetilde\sigma$')
+    _finish(ax,'epochs','Accuracy with different noise scales','lower right','accuracy')
+
+def draw_eps_by_epoch(ax,ma,clt):
+    epochs=np.arange(1,len(ma)+1)
+    ax.plot(epochs,clt,label=r'CLT $\epsilon$',linewidth=2,color='red')
+    ax.plot(epochs,ma,label=r'MA $\epsilon$',linewidth=2,color='royalblue',linestyle='dashed')
+    _finish(ax,'epochs','Privacy cost versus epochs','lower right',r'$\epsilon$')
+
+def draw_eps_by_iteration(ax,ma,clt,epochs,N,batch_size):
+    iterations=np.asarray(epochs)*N/batch_size/1000
+    ax.plot(iterations,clt,label=r'CLT $\epsilon$',linewidth=2,color='red')
+    ax.plot(iterations,ma,label=r'MA $\epsilon$',linewidth=2,color='royalblue',linestyle='dashed')
+    ax.autoscale(axis='x',tight=True)
+    _finish(ax,'iterations/1000','Privacy cost versus iterations','lower right')
+
+def draw_delta_by_eps(ax,ma_eps,clt_delta,deltas):
+    ax.plot(ma_eps,clt_delta,label=r'CLT $\delta$',linewidth=2,color='red')
+    ax.plot(ma_eps,deltas,label=r'MA $\delta$',linewidth=2,color='royalblue',linestyle='dashed')
+    _finish(ax,r'$\epsilon$',r'$\delta$ versus $\epsilon$','upper right')
+
+def draw_eps_by_delta(ax,ma,clt,deltas):
+    ax.plot(deltas,clt,label=r'CLT $\epsilon$',linewidth=2,color='red')
+    ax.plot(deltas,ma,label=r'MA $\epsilon$',linewidth=2,color='royalblue',linestyle='dashed')
+    _finish(ax,r'$\delta$',r'$\epsilon$ versus $\delta$','upper right')
+
+def draw_noise_by_eps(ax,ma_eps,clt_noise,noise_multis):
+    ax.plot(ma_eps,clt_noise,label=r'CLT $\widetilde{\sigma}$',linewidth=2,color='red')
+    ax.plot(ma_eps,noise_multis,linewidth=2,label=r'MA $\sigma$',color='royalblue',linestyle='dashed')
+    ax.autoscale(axis='x',tight=True)
+    _finish(ax,r'$\epsilon$',r'Noise scale versus $\epsilon$','upper right')
+
+# Type II error of (eps,delta)-DP at Type I errors x
+def _dp_tradeoff(x,eps,delta):
+    return np.maximum.reduce([np.zeros_like(x),1-delta-np.exp(eps)*x,np.exp(-eps)*(1-delta-x)])
+
+def _gdp_line(ax,mu):
+    x=np.arange(0,1.01,0.01)
+    ax.plot(x,norm.cdf(norm.ppf(1-x)-mu),color='r',linewidth=2,label=str(mu)+'-GDP by CLT')
+
+def _finish_tradeoff(ax,title):
+    ax.set_xlim(0,1);ax.set_ylim(0,1)
+    ax.set_aspect('equal',adjustable='box')
+    _finish(ax,'Type I error',title,'upper right','Type II error')
+    return 'tight'
+
+def draw_tradeoff(ax,eps,mu,title):
+    _gdp_line(ax,mu)
+    x=np.arange(0,1.01,0.01)
+    ax.plot(x+0.003,_dp_tradeoff(x,eps,0),color='royalblue',linewidth=2,linestyle='--',
+            label='('+str(eps)+',1e-5)-DP by MA')
+    return _finish_tradeoff(ax,title)
+
+def draw_tradeoff_envelope(ax,ma_eps,deltas,mu,title):
+    _gdp_line(ax,mu)
+    x=np.linspace(0,1,1001)
+    envelope=np.max([_dp_tradeoff(x,e,d) for e,d in zip(ma_eps,deltas)],axis=0)
+    ax.plot(x,envelope,color='royalblue',linewidth=2,linestyle='--',
+            label=r'($\epsilon,\delta$)-DP by MA')
+    return _finish_tradeoff(ax,title)
+
+def draw_tradeoff_family(ax,ma_eps,deltas,mu,title):
+    _gdp_line(ax,mu)
+    x=np.linspace(0,1,201)
+    lines=[np.column_stack([x+0.002,_dp_tradeoff(x,e,d)]) for e,d in zip(ma_eps,deltas)]
+    ax.add_collection(LineCollection(lines,colors='royalblue',linewidths=2,
+                                     label=r'($\epsilon,\delta$)-DP by MA'))
+    return _finish_tradeoff(ax,title)
+
+
+####### The figures of the paper
+N,BATCH=60000,256
+_envelope_deltas=np.arange(1e-5,0.1,1e-3)
+_family_deltas=np.arange(1e-5,1,1e-3)
+_delta_MA=np.concatenate((np.arange(1e-5,1e-2,1e-4),np.arange(1e-2,1,1e-2)))
+_delta_small=np.concatenate((np.arange(1e-6,1.5e-5,1e-6),np.arange(2e-5,1e-4,1e-5)))
+_noise_multis=np.arange(0.7,3,0.1)
+_ma_delta_07=Accountant(ma_eps_by_delta,100,0.7,N,BATCH,_delta_MA)
+_ma_noise=Accountant(ma_eps_by_noise,100,_noise_multis,N,BATCH,1e-5)
+
+FIGURES=[
+    # MNIST accuracy boost by adding necessary noise
+    Figure('acc_best.pdf',draw_accuracy,{'ma':Results('MNIST_MA1.pkl'),
+           'clt':Results('MNIST_CLT1.pkl'),'nonprivate':Results('MNIST_NO1.pkl')}),
+    Figure('acc_best2.pdf',draw_accuracy,{'ma':Results('MNIST_MA2.pkl'),
+           'clt':Results('MNIST_CLT2.pkl'),'nonprivate':Results('MNIST_NO2.pkl')}),
+    # make sure final epsilon budget is the same
+    Figure('private_everywhere.pdf',draw_eps_by_epoch,
+           {'ma':Accountant(ma_eps_by_epoch,np.arange(1,71),0.7,N,BATCH,1e-5),
+            'clt':Accountant(clt_eps_by_epoch,np.arange(1,71),0.64,N,BATCH,1e-5)}),
+    Figure('private_everywhere2.pdf',draw_eps_by_epoch,
+           {'ma':Accountant(ma_eps_by_epoch,np.arange(1,21),1.3,N,BATCH,1e-5),
+            'clt':Accountant(clt_eps_by_epoch,np.arange(1,21),1.06,N,BATCH,1e-5)}),
+    # MNIST epsilon, delta and noise comparisons
+    Figure('epsilon_07.pdf',draw_eps_by_iteration,
+           {'ma':Accountant(ma_eps_by_epoch,np.arange(10,101),0.7,N,BATCH,1e-5),
+            'clt':Accountant(clt_eps_by_epoch,np.arange(10,101),0.7,N,BATCH,1e-5)},
+           epochs=np.arange(10,101),N=N,batch_size=BATCH),
+    Figure('delta_07.pdf',draw_delta_by_eps,
+           {'ma_eps':_ma_delta_07,
+            'clt_delta':Accountant(clt_delta_by_eps,100,0.7,N,BATCH,_ma_delta_07)},
+           deltas=_delta_MA),
+    Figure('delta_x.pdf',draw_eps_by_delta,
+           {'ma':Accountant(ma_eps_by_delta,100,0.7,N,BATCH,_delta_small),
+            'clt':Accountant(clt_eps_by_delta,100,0.7,N,BATCH,_delta_small)},
+           deltas=_delta_small),
+    Figure('sigma_best.pdf',draw_noise_by_eps,
+           {'ma_eps':_ma_noise,'clt_noise':Accountant(clt_noise_by_eps,_ma_noise,100,N,BATCH,1e-5)},
+           noise_multis=_noise_multis),
+]
+# MNIST trade-off diagrams
+for eps,mu,title,filename in [
+        (1.19,0.23,r'95.0% accuracy, $\sigma=1.3$','tradeoff023.pdf'),
+        (3.01,0.57,r'96.6% accuracy, $\sigma=1.1$','tradeoff057.pdf'),
+        (7.10,1.13,r'97.0% accuracy, $\sigma=0.7$','tradeoff113.pdf'),
+        (13.27,2.00,r'97.6% accuracy, $\sigma=0.6$','tradeoff200.pdf'),
+        (18.72,2.76,r'97.8% accuracy, $\sigma=0.55$','tradeoff276.pdf'),
+        (32.40,4.78,r'98.0% accuracy, $\sigma=0.5$','tradeoff478.pdf')]:
+    FIGURES.append(Figure(filename,draw_tradeoff,eps=eps,mu=mu,title=title))
+for mu,sigma,epochs,title,name in [
+        (0.23,1.3,15,r'95.0% accuracy, $\sigma=1.3$','tradeoff023'),
+        (0.57,1.1,60,r'96.6% accuracy, $\sigma=1.1$','tradeoff057'),
+        (1.13,0.7,45,r'97.0% accuracy, $\sigma=0.7$','tradeoff113')]:
+    FIGURES.append(Figure('envelope_%s.pdf' % name,draw_tradeoff_envelope,
+                          {'ma_eps':Accountant(ma_eps_by_delta,epochs,sigma,N,BATCH,_envelope_deltas)},
+                          deltas=_envelope_deltas,mu=mu,title=title))
+    FIGURES.append(Figure('envelope_%sS.pdf' % name,draw_tradeoff_family,
+                          {'ma_eps':Accountant(ma_eps_by_delta,epochs,sigma,N,BATCH,_family_deltas)},
+                          deltas=_family_deltas,mu=mu,title=title))
+
+
+####### Report
+def _init_worker(results_dir):
+    global RESULTS_DIR
+    RESULTS_DIR=results_dir
+
+def _load_input(i,cache_dir):
+    i.load(cache_dir)
+
+def _render(index,output_dir,cache_dir):
+    FIGURES[index].render(output_dir,cache_dir)
+
+def _inputs(figures):
+    """Every input of figures once, each after the inputs it depends on."""
+    ordered,seen=[],set()
+    def visit(i):
+        if i.key in seen:
+            return
+        for dependency in i.dependencies():
+            visit(dependency)
+        seen.add(i.key)
+        ordered.append(i)
+    for figure in figures:
+        for i in figure.inputs.values():
+            visit(i)
+    return ordered
+
+def _depth(i):
+    return 1+max([_depth(d) for d in i.dependencies()],default=0)
+
+
+def make_report(output_dir,cache_dir,results_dir='pickle',workers=None,only=(),force=False):
+    """Draws the figures whose inputs or code changed; returns their names."""
+    unknown=set(only)-{figure.filename for figure in FIGURES}
+    if unknown:
+        raise ValueError('Unknown figures: %s' % ', '.join(sorted(unknown)))
+    _init_worker(results_dir)
+    os.makedirs(output_dir,exist_ok=True)
+    os.makedirs(cache_dir,exist_ok=True)
+    manifest_path=os.path.join(cache_dir,'figures.json')
+    manifest={}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest=json.load(f)
+    stale=[k for k,figure in enumerate(FIGURES)
+           if (not only or figure.filename in only) and
+           (force or manifest.get(figure.filename)!=figure.key or
+            not os.path.exists(os.path.join(output_dir,figure.filename)))]
+    missing=[i for i in _inputs([FIGURES[k] for k in stale]) if not i.cached(cache_dir)]
+    with ProcessPoolExecutor(max_workers=workers,initializer=_init_worker,
+                             initargs=(results_dir,)) as executor:
+        # Inputs in waves: an input only waits for those it depends on
+        for depth in sorted({_depth(i) for i in missing}):
+            wave=[i for i in missing if _depth(i)==depth]
+            for future in [executor.submit(_load_input,i,cache_dir) for i in wave]:
+                future.result()
+        futures=[(k,executor.submit(_render,k,output_dir,cache_dir)) for k in stale]
+        for k,future in futures:
+            future.result()
+            manifest[FIGURES[k].filename]=FIGURES[k].key
+    with open(manifest_path,'w') as f:
+        json.dump(manifest,f,indent=1,sort_keys=True)
+    return [FIGURES[k].filename for k in stale]
+
+def main(unused_argv):
+    made=make_report(FLAGS.output_dir,FLAGS.cache_dir,FLAGS.results_dir,FLAGS.workers,
+                     FLAGS.only,FLAGS.force)
+    print('Drew %d of %d figures%s' % (len(made),len(FIGURES),
+                                      ': '+', '.join(made) if made else ''))
+
+
+if __name__ == '__main__':
+  app.run(main)
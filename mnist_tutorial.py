@@ -12,7 +12,14 @@ from absl import app
 from absl import flags
 
 from tensorflow_privacy.privacy.optimizers import dp_optimizer
+from dp_noise import *
+from accountant_cache import *
 from gdp_accountant import *
+from ghost_clipping import *
+from input_pipeline import *
+from precision import *
+from streaming_eval import *
+from training_state import *
 
 #### FLAGS
 flags.DEFINE_boolean('dpsgd', True, 'If True, train with DP-SGD. If False, '
@@ -24,35 +31,91 @@ flags.DEFINE_float('l2_norm_clip', 1.5, 'Clipping norm')
 flags.DEFINE_integer('epochs', 1, 'Number of epochs')
 flags.DEFINE_string('model_dir', None, 'Model directory')
 flags.DEFINE_float('max_mu', 2, 'Maximum mu before termination')
+flags.DEFINE_boolean('async_eval', False, 'Evaluate each epoch in the '
+                     'background while the next one trains (keeps '
+                     'every checkpoint)')
 flags.DEFINE_string('subsampling', 'Poisson', 'Poisson or Uniform subsampling')
 flags.DEFINE_integer('batch_size', 256, 'Batch size')
 flags.DEFINE_integer(
     'microbatches', 256, 'Number of microbatches '
     '(must evenly divide batch_size)')
+flags.DEFINE_string('precision', 'float32', 'Compute dtype: float32, bfloat16 '
+                    'or float16 (clipping and noise always run in float32)')
+flags.DEFINE_float('loss_scale', 1., 'Static loss scale for float16 training')
+flags.DEFINE_integer('seed', 0, 'Run seed of the initialization, shuffling '
+                     'and DP noise streams')
+flags.DEFINE_string('clipping', 'microbatch', 'Per-example clipping: '
+                    'microbatch (dp_optimizer) or ghost (ghost_clipping.py, '
+                    'no per-example gradients; microbatches unused)')
+flags.DEFINE_string('clip_groups', 'all', 'Ghost clipping groups: all (one '
+                    'norm) or layer (one norm per layer)')
+flags.DEFINE_float('target_quantile', None, 'Adapt the ghost clipping norms '
+                   'to this quantile of the per-example gradient norms, '
+                   'starting from l2_norm_clip')
+flags.DEFINE_float('clip_learning_rate', 0.2, 'Geometric learning rate of '
+                   'the adaptive clipping norms')
+flags.DEFINE_float('clipped_count_stddev', None, 'Noise stddev of the '
+                   'adaptive clipping counts (default batch_size / 20)')
 
 FLAGS = flags.FLAGS
 
-np.random.seed(0)
-tf.compat.v1.set_random_seed(0)
+def clip_groups():
+  """Clipping groups of the ghost CNN's four layers."""
+  if FLAGS.clip_groups == 'layer':
+    return [[0], [1], [2], [3]]
+  return [[0, 1, 2, 3]]
+
+
+def clipped_count_stddev():
+  if FLAGS.clipped_count_stddev is None:
+    return FLAGS.batch_size / 20
+  return FLAGS.clipped_count_stddev
+
+
+def accounted_noise_multiplier():
+  """Noise multiplier to account for, with the adaptive clipping counts."""
+  if FLAGS.clipping == 'ghost' and FLAGS.target_quantile is not None:
+    return effective_noise_multi(FLAGS.noise_multiplier,
+                                 clipped_count_stddev(),
+                                 len(clip_groups()))
+  return FLAGS.noise_multiplier
+
 
 def cnn_model_fn(features, labels, mode):
   """Model function for a CNN."""
 
   # Define CNN architecture using tf.keras.layers.
   input_layer = tf.reshape(features['x'], [-1, 28, 28, 1])
-  y = tf.keras.layers.Conv2D(16, 8,
-                             strides=2,
-                             padding='same',
-                             activation='relu').apply(input_layer)
-  y = tf.keras.layers.MaxPool2D(2, 1).apply(y)
-  y = tf.keras.layers.Conv2D(32, 4,
-                             strides=2,
-                             padding='valid',
-                             activation='relu').apply(y)
-  y = tf.keras.layers.MaxPool2D(2, 1).apply(y)
-  y = tf.keras.layers.Flatten().apply(y)
-  y = tf.keras.layers.Dense(32, activation='relu').apply(y)
-  logits = tf.keras.layers.Dense(10).apply(y)
+  if FLAGS.clipping == 'ghost':
+    # The same CNN, with the layers recorded for ghost clipping.
+    if FLAGS.precision != 'float32':
+      input_layer = tf.cast(input_layer, FLAGS.precision)
+    y, conv1 = ghost_conv2d(input_layer, 16, 8, strides=2, padding='same',
+                            activation=tf.nn.relu)
+    y = tf.keras.layers.MaxPool2D(2, 1).apply(y)
+    y, conv2 = ghost_conv2d(y, 32, 4, strides=2, padding='valid',
+                            activation=tf.nn.relu)
+    y = tf.keras.layers.MaxPool2D(2, 1).apply(y)
+    y = tf.keras.layers.Flatten().apply(y)
+    y, dense1 = ghost_dense(y, 32, tf.nn.relu)
+    logits, dense2 = ghost_dense(y, 10)
+    layers = [conv1, conv2, dense1, dense2]
+  else:
+    y = tf.keras.layers.Conv2D(16, 8,
+                               strides=2,
+                               padding='same',
+                               activation='relu').apply(input_layer)
+    y = tf.keras.layers.MaxPool2D(2, 1).apply(y)
+    y = tf.keras.layers.Conv2D(32, 4,
+                               strides=2,
+                               padding='valid',
+                               activation='relu').apply(y)
+    y = tf.keras.layers.MaxPool2D(2, 1).apply(y)
+    y = tf.keras.layers.Flatten().apply(y)
+    y = tf.keras.layers.Dense(32, activation='relu').apply(y)
+    logits = tf.keras.layers.Dense(10).apply(y)
+  # Loss, per-example clipping and noise are computed in float32.
+  logits = tf.cast(logits, tf.float32)
 
   # Calculate loss as a vector (to support microbatches in DP-SGD).
   vector_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
@@ -63,21 +126,39 @@ def cnn_model_fn(features, labels, mode):
   # Configure the training op (for TRAIN mode).
   if mode == tf.estimator.ModeKeys.TRAIN:
 
-    if FLAGS.dpsgd:
+    if FLAGS.dpsgd and FLAGS.clipping == 'ghost':
+      # Per-example norms without per-example gradients: memory no longer
+      # grows with the number of microbatches.
+      opt_loss, l2_norm_clip = scale_for_clipping(
+          vector_loss, FLAGS.l2_norm_clip, FLAGS.loss_scale)
+      optimizer = GhostClippingOptimizer(
+          tf.compat.v1.train.GradientDescentOptimizer(
+              learning_rate=unscaled_learning_rate(FLAGS.learning_rate,
+                                                   FLAGS.loss_scale)),
+          # The group norms start from an even split of l2_norm_clip
+          layers, l2_norm_clip / np.sqrt(len(clip_groups())),
+          FLAGS.noise_multiplier, FLAGS.seed, groups=clip_groups(),
+          target_quantile=FLAGS.target_quantile,
+          clip_learning_rate=FLAGS.clip_learning_rate,
+          clipped_count_stddev=clipped_count_stddev())
+    elif FLAGS.dpsgd:
       # Use DP version of GradientDescentOptimizer. Other optimizers are
       # available in dp_optimizer. Most optimizers inheriting from
       # tf.train.Optimizer should be wrappable in differentially private
       # counterparts by calling dp_optimizer.optimizer_from_args().
-      optimizer = dp_optimizer.DPGradientDescentGaussianOptimizer(
-          l2_norm_clip=FLAGS.l2_norm_clip,
-          noise_multiplier=FLAGS.noise_multiplier,
+      opt_loss, l2_norm_clip = scale_for_clipping(
+          vector_loss, FLAGS.l2_norm_clip, FLAGS.loss_scale)
+      optimizer = dp_optimizer.DPGradientDescentOptimizer(
+          stateless_gaussian_query(l2_norm_clip, FLAGS.noise_multiplier,
+                                   FLAGS.seed),
           num_microbatches=FLAGS.microbatches,
-          learning_rate=FLAGS.learning_rate)
-      opt_loss = vector_loss
+          learning_rate=unscaled_learning_rate(FLAGS.learning_rate,
+                                               FLAGS.loss_scale))
     else:
       optimizer = tf.compat.v1.train.GradientDescentOptimizer(
-          learning_rate=FLAGS.learning_rate)
-      opt_loss = scalar_loss
+          learning_rate=unscaled_learning_rate(FLAGS.learning_rate,
+                                               FLAGS.loss_scale))
+      opt_loss = scalar_loss * FLAGS.loss_scale
     global_step = tf.compat.v1.train.get_global_step()
     train_op = optimizer.minimize(loss=opt_loss, global_step=global_step)
     # In the following, we pass the mean of the loss (scalar_loss) rather than
@@ -125,59 +206,103 @@ def load_mnist():
 
 def main(unused_argv):
     tf.compat.v1.logging.set_verbosity(3)
+    set_precision(FLAGS.precision)
     
       # Load training and test data.
     train_data, train_labels, test_data, test_labels = load_mnist()
     
       # Instantiate the tf.Estimator.
-    mnist_classifier = tf.estimator.Estimator(model_fn=cnn_model_fn,
-                                            model_dir=FLAGS.model_dir)
+    mnist_classifier = tf.estimator.Estimator(
+        model_fn=cnn_model_fn,
+        model_dir=FLAGS.model_dir,
+        # --async_eval keeps every checkpoint: an evaluation lagging behind
+        # training must still find its epoch's
+        config=tf.estimator.RunConfig(
+            tf_random_seed=FLAGS.seed,
+            keep_checkpoint_max=None if FLAGS.async_eval else 5))
     
       # Create tf.Estimator input functions for the training and test data.
-    eval_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
+    eval_input_fn = array_input_fn(
         x={'x': test_data},
         y=test_labels,
         num_epochs=1,
         shuffle=False)
-    train_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-        x={'x': train_data},
-        y=train_labels,
-        batch_size=FLAGS.batch_size,
-        num_epochs=FLAGS.epochs,
-        shuffle=True)
-        
-      # Training loop.
-    steps_per_epoch = 60000 // 256
-    test_accuracy_list = []
-    for epoch in range(1, FLAGS.epochs + 1):
-        np.random.seed(epoch)
-        # Train the model for one step.
-        mnist_classifier.train(input_fn=train_input_fn, steps=steps_per_epoch)
         
-        # Evaluate the model and print results
-        eval_results = mnist_classifier.evaluate(input_fn=eval_input_fn)
+      # Resume after the epochs and steps of the last checkpoint, if any.
+    steps_per_epoch = 60000 // FLAGS.batch_size
+    noise_multiplier = accounted_noise_multiplier()
+    state = TrainingState(mnist_classifier.model_dir,
+                          {'seed': FLAGS.seed, 'dpsgd': FLAGS.dpsgd,
+                           'noise_multiplier': noise_multiplier,
+                           'batch_size': FLAGS.batch_size,
+                           'subsampling': FLAGS.subsampling})
+    if state.exhausted(FLAGS.max_mu):
+        print('The privacy budget was already spent by this run')
+        return
+    first_epoch, skip = state.resume(checkpoint_step(mnist_classifier.model_dir),
+                                     steps_per_epoch)
+    test_accuracy_list = state.values('accuracy')
+
+    # Report the test metric of an epoch once its evaluation is done.
+    def report(epoch, eval_results):
         test_accuracy = eval_results['accuracy']
         test_accuracy_list.append(test_accuracy)
         print('Test accuracy after %d epochs is: %.3f' % (epoch, test_accuracy))
+        state.snapshot(epoch=epoch, accuracy=test_accuracy)
+
+    # Epochs are evaluated from their checkpoint, here or, with
+    # --async_eval, on a thread while the next epoch trains.
+    evaluations = AsyncEvaluator(
+        lambda path: mnist_classifier.evaluate(input_fn=eval_input_fn,
+                                               checkpoint_path=path),
+        workers=1 if FLAGS.async_eval else 0)
+
+      # Training loop.
+    for epoch in range(first_epoch + 1, FLAGS.epochs + 1):
+        train_input_fn = array_input_fn(
+            x={'x': train_data},
+            y=train_labels,
+            batch_size=FLAGS.batch_size,
+            num_epochs=1,
+            shuffle=True,
+            seed=stream_seed(FLAGS.seed, SHUFFLE, epoch),
+            skip_batches=skip)
+        # Train the model for one step.
+        mnist_classifier.train(input_fn=train_input_fn,
+                               steps=steps_per_epoch - skip)
+        skip = 0
+        
+        # Evaluate the model in the background if --async_eval
+        evaluations.submit(epoch,
+                           tf.train.latest_checkpoint(mnist_classifier.model_dir))
         
         # Compute the privacy budget expended so far.
+        mu = None
         if FLAGS.dpsgd:
             if FLAGS.subsampling=='Poisson':
-                eps = compute_epsP(epoch,FLAGS.noise_multiplier,60000,256,1e-5)
-                mu = compute_muP(epoch,FLAGS.noise_multiplier,60000,256)
+                eps = cached_epsP(epoch,noise_multiplier,60000,FLAGS.batch_size,1e-5)
+                mu = compute_muP(epoch,noise_multiplier,60000,FLAGS.batch_size)
             if FLAGS.subsampling=='Uniform':
-                eps = compute_epsU(epoch,FLAGS.noise_multiplier,60000,256,1e-5)
-                mu = compute_muU(epoch,FLAGS.noise_multiplier,60000,256)
+                eps = cached_epsU(epoch,noise_multiplier,60000,FLAGS.batch_size,1e-5)
+                mu = compute_muU(epoch,noise_multiplier,60000,FLAGS.batch_size)
           
             print('For delta=1e-5, the current MA epsilon is: %.2f' % 
-                  compute_epsilon(epoch,FLAGS.noise_multiplier,60000,256,1e-5))
+                  cached_epsilon(epoch,noise_multiplier,60000,FLAGS.batch_size,1e-5))
             print('For delta=1e-5, the current CLT epsilon is: %.2f' % eps)
             print('For delta=1e-5, the current mu is: %.2f' % mu)
-          
-            if mu>FLAGS.max_mu:
-                break
         else:
           print('Trained with vanilla non-private SGD optimizer')
+
+        # The budget check does not wait for the evaluation
+        state.snapshot(epoch=epoch, global_step=epoch * steps_per_epoch, mu=mu)
+        for done in evaluations.completed():
+            report(*done)
+        if FLAGS.dpsgd and mu>FLAGS.max_mu:
+            break
+    for done in evaluations.drain():
+        report(*done)
+    evaluations.close()
+    state.close()
     
 
 if __name__ == '__main__':
@@ -5,6 +5,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import functools
+import os
+
 import numpy as np
 import tensorflow as tf
 
@@ -12,7 +15,13 @@ from absl import app
 from absl import flags
 
 from tensorflow_privacy.privacy.optimizers import dp_optimizer
+from dp_noise import *
+from accountant_cache import *
 from gdp_accountant import *
+from noise_engine import *
+from streaming_eval import *
+from input_pipeline import *
+from training_state import *
 
 #### FLAGS
 flags.DEFINE_boolean('dpsgd', True, 'If True, train with DP-SGD. If False, '
@@ -24,18 +33,27 @@ flags.DEFINE_float('l2_norm_clip', 5, 'Clipping norm')
 flags.DEFINE_integer('epochs', 1, 'Number of epochs')
 flags.DEFINE_string('model_dir', None, 'Model directory')
 flags.DEFINE_float('max_mu', 2, 'Maximum mu before termination')
+flags.DEFINE_boolean('async_eval', False, 'Evaluate each epoch in the '
+                     'background while the next one trains (keeps '
+                     'every checkpoint)')
 flags.DEFINE_string('subsampling', 'Poisson', 'Poisson or Uniform subsampling')
 flags.DEFINE_integer('batch_size', 10000, 'Batch size')
 flags.DEFINE_integer(
     'microbatches', 1000, 'Number of microbatches '
     '(must evenly divide batch_size)')
+flags.DEFINE_integer('seed', 0, 'Run seed of the initialization, shuffling '
+                     'and DP noise streams')
+flags.DEFINE_integer('noise_threads', 0, 'Host threads pre-generating the DP '
+                     'noise of the next steps (0: draw it in the graph)')
+flags.DEFINE_boolean('stream_eval', False, 'Evaluate by streaming the test set '
+                     'from memory-mapped columns in eval_dir')
+flags.DEFINE_string('eval_dir', 'data/movielens_test', 'Memory-mapped test '
+                    'columns, written on the first streaming evaluation')
+flags.DEFINE_integer('eval_chunk_size', 65536, 'Rows per streamed chunk')
 
 FLAGS = flags.FLAGS
 
 
-np.random.seed(0)
-tf.compat.v1.set_random_seed(0)
-
 n_users=6040
 n_movies=3706
 
@@ -72,6 +90,13 @@ def nn_model_fn(features, labels, mode):
     predict_vector = tf.keras.layers.concatenate([mf_vector, mlp_vector])
     
     logits = tf.keras.layers.Dense(5)(predict_vector)    
+    # Expected rating under the predicted distribution
+    rating = tf.tensordot(a=tf.nn.softmax(logits,axis=1),b=tf.constant(np.array([0,1,2,3,4]),dtype=tf.float32),axes=1)
+
+    # Predictions for streaming evaluation (there are no labels).
+    if mode == tf.estimator.ModeKeys.PREDICT:
+      return tf.estimator.EstimatorSpec(mode=mode,
+                                        predictions={'rating': rating})
 
     # Calculate loss as a vector (to support microbatches in DP-SGD).
     vector_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=labels, logits=logits)
@@ -86,9 +111,15 @@ def nn_model_fn(features, labels, mode):
         # available in dp_optimizer. Most optimizers inheriting from
         # tf.train.Optimizer should be wrappable in differentially private
         # counterparts by calling dp_optimizer.optimizer_from_args().
-        optimizer = dp_optimizer.DPAdamGaussianOptimizer(
-            l2_norm_clip=FLAGS.l2_norm_clip,
-            noise_multiplier=FLAGS.noise_multiplier,
+        if FLAGS.noise_threads:
+          query = engine_gaussian_query(FLAGS.l2_norm_clip,
+                                        FLAGS.noise_multiplier, FLAGS.seed,
+                                        threads=FLAGS.noise_threads)
+        else:
+          query = stateless_gaussian_query(FLAGS.l2_norm_clip,
+                                           FLAGS.noise_multiplier, FLAGS.seed)
+        optimizer = dp_optimizer.DPAdamOptimizer(
+            query,
             num_microbatches=FLAGS.microbatches,
             learning_rate=FLAGS.learning_rate)
         opt_loss = vector_loss
@@ -113,7 +144,7 @@ def nn_model_fn(features, labels, mode):
           'rmse':
               tf.compat.v1.metrics.root_mean_squared_error(
                   labels=tf.cast(labels, tf.float32),
-                  predictions=tf.tensordot(a=tf.nn.softmax(logits,axis=1),b=tf.constant(np.array([0,1,2,3,4]),dtype=tf.float32),axes=1))
+                  predictions=rating)
       }
       return tf.estimator.EstimatorSpec(mode=mode,
                                       loss=scalar_loss,
@@ -139,8 +170,23 @@ def load_adult():
 
     from sklearn.model_selection import train_test_split
     train,test=train_test_split(data,test_size=0.2,random_state=100)
-    
-    return train.values-1, test.values-1, np.mean(train['rating'])
+
+    # keep only the user index, movie index and rating as int32, with the
+    # minimum of each reduced to 0; the timestamp and raw movieId are unused
+    columns=['userId','movieIndex','rating']
+    return (train[columns].values-1).astype('int32'), (test[columns].values-1).astype('int32'), np.mean(train['rating'])
+
+
+def build_estimator(model_dir):
+  """The tutorial's Estimator (module level, so evaluators can rebuild it)."""
+  return tf.estimator.Estimator(
+      model_fn=nn_model_fn,
+      model_dir=model_dir,
+      # --async_eval keeps every checkpoint: an evaluation lagging behind
+      # training must still find its epoch's
+      config=tf.estimator.RunConfig(
+          tf_random_seed=FLAGS.seed,
+          keep_checkpoint_max=None if FLAGS.async_eval else 5))
 
 
 def main(unused_argv):
@@ -150,54 +196,112 @@ def main(unused_argv):
   train_data, test_data, mean = load_adult()
 
   # Instantiate the tf.Estimator.
-  adult_classifier = tf.estimator.Estimator(model_fn=nn_model_fn,
-                                            model_dir=FLAGS.model_dir)
+  adult_classifier = build_estimator(FLAGS.model_dir)
 
   # Create tf.Estimator input functions for the training and test data.
-  eval_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-      x={'user': test_data[:,0], 'movie': test_data[:,4]},
-      y=test_data[:,2],
-      num_epochs=1,
-      shuffle=False)
-  train_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-    x={'user': train_data[:,0], 'movie': train_data[:,4]},
-    y=train_data[:,2],
-    batch_size=FLAGS.batch_size,
-    num_epochs=FLAGS.epochs,
-    shuffle=True)
-  # Training loop.
+  if FLAGS.stream_eval:
+    # The test set is read back memory mapped, chunk by chunk.
+    if not os.path.exists(os.path.join(FLAGS.eval_dir, 'rating.npy')):
+      save_columns(FLAGS.eval_dir, user=test_data[:,0], movie=test_data[:,1],
+                   rating=test_data[:,2])
+    del test_data
+    evaluator = StreamingEvaluator(
+        functools.partial(build_estimator, adult_classifier.model_dir),
+        FLAGS.eval_dir, ['user', 'movie'], 'rating',
+        [RootMeanSquaredError('rating')], FLAGS.eval_chunk_size,
+        process=FLAGS.async_eval)
+  else:
+    eval_input_fn = array_input_fn(
+        x={'user': test_data[:,0], 'movie': test_data[:,1]},
+        y=test_data[:,2],
+        num_epochs=1,
+        shuffle=False)
+  # Resume after the epochs and steps of the last checkpoint, if any.
   steps_per_epoch = 800167 // 10000
-  test_accuracy_list = []
-  for epoch in range(1, FLAGS.epochs + 1):
-    np.random.seed(epoch)
+  state = TrainingState(adult_classifier.model_dir,
+                        {'seed': FLAGS.seed, 'dpsgd': FLAGS.dpsgd,
+                         'noise_multiplier': FLAGS.noise_multiplier,
+                         'batch_size': FLAGS.batch_size,
+                         'subsampling': FLAGS.subsampling})
+  if state.exhausted(FLAGS.max_mu):
+    print('The privacy budget was already spent by this run')
+    return
+  first_epoch, skip = state.resume(checkpoint_step(adult_classifier.model_dir),
+                                   steps_per_epoch)
+  test_accuracy_list = state.values('accuracy')
 
-    # Train the model for one step.
-    adult_classifier.train(input_fn=train_input_fn, steps=steps_per_epoch)
-
-    # Evaluate the model and print results
-    eval_results = adult_classifier.evaluate(input_fn=eval_input_fn)
+  # Report the test metric of an epoch once its evaluation is done.
+  def report(epoch, eval_results):
     test_accuracy = eval_results['rmse']
     test_accuracy_list.append(test_accuracy)
     print('Test RMSE after %d epochs is: %.3f' % (epoch, test_accuracy))
+    state.snapshot(epoch=epoch, accuracy=test_accuracy)
+
+  # Epochs are evaluated from their checkpoint, here or, with
+  # --async_eval, while the next epoch trains: on a thread, which waits for
+  # a worker process when streaming.
+  if FLAGS.stream_eval:
+    evaluate = evaluator.evaluate
+  else:
+    evaluate = lambda path: adult_classifier.evaluate(input_fn=eval_input_fn,
+                                                      checkpoint_path=path)
+  evaluations = AsyncEvaluator(evaluate, workers=1 if FLAGS.async_eval else 0)
+
+  # Training loop.
+  for epoch in range(first_epoch + 1, FLAGS.epochs + 1):
+    train_input_fn = array_input_fn(
+      x={'user': train_data[:,0], 'movie': train_data[:,1]},
+      y=train_data[:,2],
+      batch_size=FLAGS.batch_size,
+      num_epochs=1,
+      shuffle=True,
+      seed=stream_seed(FLAGS.seed, SHUFFLE, epoch),
+      skip_batches=skip)
+
+    # Train the model for one step.
+    adult_classifier.train(input_fn=train_input_fn, steps=steps_per_epoch - skip)
+    skip = 0
+
+    # Evaluate the model in the background if --async_eval
+    evaluations.submit(epoch,
+                       tf.train.latest_checkpoint(adult_classifier.model_dir))
     
     # Compute the privacy budget expended so far.
+    mu = None
     if FLAGS.dpsgd:
+        delta = 1e-6
         if FLAGS.subsampling=='Poisson':
-            eps = compute_epsP(epoch,FLAGS.noise_multiplier,800167,10000,1e-6)
+            eps = cached_epsP(epoch,FLAGS.noise_multiplier,800167,10000,delta)
             mu = compute_muP(epoch,FLAGS.noise_multiplier,800167,10000)
         if FLAGS.subsampling=='Uniform':
-            eps = compute_epsU(epoch,FLAGS.noise_multiplier,800167,10000,1e-6)
+            eps = cached_epsU(epoch,FLAGS.noise_multiplier,800167,10000,delta)
             mu = compute_muU(epoch,FLAGS.noise_multiplier,800167,10000)
       
-        print('For delta=1e-5, the current MA epsilon is: %.2f' % 
-              compute_epsilon(epoch,FLAGS.noise_multiplier,800167,10000,1e-6))
-        print('For delta=1e-5, the current CLT epsilon is: %.2f' % eps)
-        print('For delta=1e-5, the current mu is: %.2f' % mu)
-      
-        if mu>FLAGS.max_mu:
-            break
+        print('For delta=%g, the current MA epsilon is: %.2f' % (delta,
+              cached_epsilon(epoch,FLAGS.noise_multiplier,800167,10000,delta)))
+        print('For delta=%g, the current CLT epsilon is: %.2f' % (delta, eps))
+        # The CLT is loose at 80 steps per epoch; the Edgeworth accountant
+        # corrects it at a few ms per epoch
+        eps_edgeworth, eps_error = edgeworth_epsilon(
+            epoch,FLAGS.noise_multiplier,800167,10000,delta,FLAGS.subsampling)
+        print('For delta=%g, the current Edgeworth epsilon is: %.2f (+/- %.2f)' %
+              (delta, eps_edgeworth, eps_error))
+        print('For delta=%g, the current mu is: %.2f' % (delta, mu))
     else:
       print('Trained with vanilla non-private SGD optimizer')
+
+    # The budget check does not wait for the evaluation
+    state.snapshot(epoch=epoch, global_step=epoch * steps_per_epoch, mu=mu)
+    for done in evaluations.completed():
+      report(*done)
+    if FLAGS.dpsgd and mu>FLAGS.max_mu:
+      break
+  for done in evaluations.drain():
+    report(*done)
+  evaluations.close()
+  if FLAGS.stream_eval:
+    evaluator.close()
+  state.close()
     
 if __name__ == '__main__':
   app.run(main)
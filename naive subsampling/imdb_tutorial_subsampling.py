@@ -12,7 +12,9 @@ from absl import app
 from absl import flags
 
 from tensorflow_privacy.privacy.optimizers import dp_optimizer
+from dp_noise import *
 from gdp_accountant import *
+from poisson_sampler import *
 from keras.preprocessing import sequence
 
 #### FLAGS
@@ -26,12 +28,12 @@ flags.DEFINE_integer('epochs', 1, 'Number of epochs')
 flags.DEFINE_string('model_dir', None, 'Model directory')
 flags.DEFINE_float('max_mu', 2, 'Maximum mu before termination')
 flags.DEFINE_string('subsampling', 'Poisson', 'Poisson or Uniform subsampling')
+flags.DEFINE_integer('seed', 0, 'Run seed of the initialization, sampling '
+                     'and DP noise streams')
 
 FLAGS = flags.FLAGS
 
 microbatches=512
-np.random.seed(0)
-tf.compat.v1.set_random_seed(0)
 
 max_features = 10000
 # cut texts after this number of words (among top max_features most common words)
@@ -61,9 +63,9 @@ def rnn_model_fn(features, labels, mode):
       # available in dp_optimizer. Most optimizers inheriting from
       # tf.train.Optimizer should be wrappable in differentially private
       # counterparts by calling dp_optimizer.optimizer_from_args().
-      optimizer = dp_optimizer.DPAdamGaussianOptimizer(
-          l2_norm_clip=FLAGS.l2_norm_clip,
-          noise_multiplier=FLAGS.noise_multiplier,
+      optimizer = dp_optimizer.DPAdamOptimizer(
+          stateless_gaussian_query(FLAGS.l2_norm_clip,
+                                   FLAGS.noise_multiplier, FLAGS.seed),
           num_microbatches=microbatches,
           learning_rate=FLAGS.learning_rate)
       opt_loss = vector_loss
@@ -111,8 +113,10 @@ def main(unused_argv):
   train_data,train_labels,test_data,test_labels = load_imdb()
 
   # Instantiate the tf.Estimator.
-  imdb_classifier = tf.estimator.Estimator(model_fn=rnn_model_fn,
-                                            model_dir=FLAGS.model_dir)
+  imdb_classifier = tf.estimator.Estimator(
+      model_fn=rnn_model_fn,
+      model_dir=FLAGS.model_dir,
+      config=tf.estimator.RunConfig(tf_random_seed=FLAGS.seed))
 
   # Create tf.Estimator input functions for the training and test data.
   eval_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
@@ -125,12 +129,12 @@ def main(unused_argv):
   steps_per_epoch = 25000 // 512
   test_accuracy_list = []
 
+  sampler = PoissonSampler(25000, 512, steps_per_epoch, FLAGS.seed)
   for epoch in range(1, FLAGS.epochs + 1):
-    np.random.seed(epoch)
+    # index lists of this epoch; the next one is drawn in the background
+    steps=sampler.epoch(epoch)
     for step in range(steps_per_epoch):
-        tf.compat.v1.set_random_seed(0)
-        whether=np.random.random_sample(25000)>(1-512/25000)
-        subsampling=[i for i in np.arange(25000) if whether[i]]
+        subsampling=steps[step]
         global microbatches
         microbatches=len(subsampling)
 
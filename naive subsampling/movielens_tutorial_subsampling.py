@@ -12,7 +12,9 @@ from absl import app
 from absl import flags
 
 from tensorflow_privacy.privacy.optimizers import dp_optimizer
+from dp_noise import *
 from gdp_accountant import *
+from poisson_sampler import *
 
 #### FLAGS
 flags.DEFINE_boolean('dpsgd', True, 'If True, train with DP-SGD. If False, '
@@ -25,12 +27,12 @@ flags.DEFINE_integer('epochs', 1, 'Number of epochs')
 flags.DEFINE_string('model_dir', None, 'Model directory')
 flags.DEFINE_float('max_mu', 2, 'Maximum mu before termination')
 flags.DEFINE_string('subsampling', 'Poisson', 'Poisson or Uniform subsampling')
+flags.DEFINE_integer('seed', 0, 'Run seed of the initialization, sampling '
+                     'and DP noise streams')
 
 FLAGS = flags.FLAGS
 
 microbatches=10000
-np.random.seed(0)
-tf.compat.v1.set_random_seed(0)
 
 n_users=6040
 n_movies=3706
@@ -82,9 +84,9 @@ def nn_model_fn(features, labels, mode):
         # available in dp_optimizer. Most optimizers inheriting from
         # tf.train.Optimizer should be wrappable in differentially private
         # counterparts by calling dp_optimizer.optimizer_from_args().
-        optimizer = dp_optimizer.DPAdamGaussianOptimizer(
-            l2_norm_clip=FLAGS.l2_norm_clip,
-            noise_multiplier=FLAGS.noise_multiplier,
+        optimizer = dp_optimizer.DPAdamOptimizer(
+            stateless_gaussian_query(FLAGS.l2_norm_clip,
+                                     FLAGS.noise_multiplier, FLAGS.seed),
             num_microbatches=microbatches,
             learning_rate=FLAGS.learning_rate)
         opt_loss = vector_loss
@@ -146,8 +148,10 @@ def main(unused_argv):
   train_data, test_data, mean = load_adult()
 
   # Instantiate the tf.Estimator.
-  adult_classifier = tf.estimator.Estimator(model_fn=nn_model_fn,
-                                            model_dir=FLAGS.model_dir)
+  adult_classifier = tf.estimator.Estimator(
+      model_fn=nn_model_fn,
+      model_dir=FLAGS.model_dir,
+      config=tf.estimator.RunConfig(tf_random_seed=FLAGS.seed))
 
   # Create tf.Estimator input functions for the training and test data.
   eval_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
@@ -159,12 +163,12 @@ def main(unused_argv):
   # Training loop.
   steps_per_epoch = 800167 // 10000
   test_accuracy_list = []
+  sampler = PoissonSampler(800167, 10000, steps_per_epoch, FLAGS.seed)
   for epoch in range(1, FLAGS.epochs + 1):
-    np.random.seed(epoch)
+    # index lists of this epoch; the next one is drawn in the background
+    steps=sampler.epoch(epoch)
     for step in range(steps_per_epoch):
-        tf.compat.v1.set_random_seed(0)
-        whether=np.random.random_sample(800167)>(1-10000/800167)
-        subsampling=[i for i in np.arange(800167) if whether[i]]
+        subsampling=steps[step]
         global microbatches
         microbatches=len(subsampling)
 
@@ -0,0 +1,132 @@
+r"""DP noise pre-generated on the host by a thread pool.
+
+Every DP-SGD step adds Gaussian noise shaped like the whole model. For
+large models, e.g. MovieLens embeddings with millions of rows, drawing it
+inside the step is a visible share of the step time. A NoiseEngine draws
+the noise of the next steps in the background instead, into a ring buffer
+of preallocated arrays, and the step only picks up a ready slot.
+
+The noise stays a pure function of (run, worker, global step), as with
+StatelessGaussianSumQuery: step s is filled from the dp_random streams
+(run, NOISE, s, worker), one Philox substream per chunk of chunk_size
+numbers. The chunks are filled in parallel, but their boundaries do not
+depend on the number of threads, so the noise is reproducible on any
+machine and no two steps or chunks ever share random numbers. A slot is
+refilled only once the step after it has asked for its noise, i.e. after
+the step that used it has finished, so the arrays handed to TF are never
+overwritten while in use.
+
+Example:
+  optimizer = dp_optimizer.DPAdamOptimizer(
+      engine_gaussian_query(l2_norm_clip, noise_multiplier, run=seed),
+      num_microbatches=microbatches, learning_rate=learning_rate)
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from dp_noise import *
+from dp_random import *
+
+
+class NoiseEngine(object):
+  """Ring buffer of standard normal noise, filled ahead by a thread pool."""
+
+  _shared = {}
+  _shared_lock = threading.Lock()
+
+  def __init__(self, shapes, run=0, worker=0, depth=3, threads=4,
+               chunk_size=1 << 20):
+    if depth < 2:
+      raise ValueError('depth must be at least 2, got %d' % depth)
+    self.shapes = [tuple(int(d) for d in shape) for shape in shapes]
+    self.run = run
+    self.worker = worker
+    self.chunk_size = chunk_size
+    sizes = [int(np.prod(shape)) for shape in self.shapes]
+    self._offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    self._slots = [np.empty(self._offsets[-1], np.float32)
+                   for _ in range(depth)]
+    self._steps = [None] * depth
+    self._pending = [[] for _ in range(depth)]
+    self._lock = threading.Lock()
+    self._executor = ThreadPoolExecutor(max_workers=threads)
+
+  @classmethod
+  def shared(cls, shapes, run=0, worker=0, **kwargs):
+    """One engine per (shapes, run, worker) for the whole process.
+
+    The Estimator rebuilds the graph on every train() call; sharing the
+    engine keeps its threads and the steps it already prefetched.
+    """
+    key = (tuple(tuple(int(d) for d in s) for s in shapes), run, worker)
+    with cls._shared_lock:
+      if key not in cls._shared:
+        cls._shared[key] = cls(shapes, run, worker, **kwargs)
+      return cls._shared[key]
+
+  def get(self, step):
+    """Noise arrays of global step `step`, shaped like shapes."""
+    step = int(step)
+    depth = len(self._slots)
+    with self._lock:
+      self._schedule(step)
+      futures = self._pending[step % depth]
+      # The slot of step - 1 is free again: it takes step + depth - 1
+      for ahead in range(1, depth):
+        self._schedule(step + ahead)
+    for future in futures:
+      future.result()
+    flat = self._slots[step % depth]
+    return [flat[start:end].reshape(shape) for start, end, shape in
+            zip(self._offsets[:-1], self._offsets[1:], self.shapes)]
+
+  def close(self):
+    self._executor.shutdown(wait=True)
+
+  def _schedule(self, step):
+    slot = step % len(self._slots)
+    if self._steps[slot] == step:
+      return
+    for future in self._pending[slot]:
+      future.result()
+    self._steps[slot] = step
+    self._pending[slot] = [
+        self._executor.submit(self._fill, slot, step, chunk)
+        for chunk in range(-(-int(self._offsets[-1]) // self.chunk_size))]
+
+  def _fill(self, slot, step, chunk):
+    view = self._slots[slot][chunk * self.chunk_size:
+                             (chunk + 1) * self.chunk_size]
+    stream = numpy_stream(self.run, NOISE, step, self.worker, chunk)
+    stream.standard_normal(out=view, dtype=np.float32)
+
+
+class EngineGaussianSumQuery(StatelessGaussianSumQuery):
+  """StatelessGaussianSumQuery whose noise comes from a NoiseEngine."""
+
+  def __init__(self, l2_norm_clip, stddev, run=0, worker=0, depth=3,
+               threads=4):
+    super(EngineGaussianSumQuery, self).__init__(l2_norm_clip, stddev, run,
+                                                 worker)
+    self._depth = depth
+    self._threads = threads
+
+  def standard_noise(self, leaves, step):
+    engine = NoiseEngine.shared([leaf.shape for leaf in leaves], self._run,
+                                self._worker, depth=self._depth,
+                                threads=self._threads)
+    noise = tf.numpy_function(engine.get, [step], [tf.float32] * len(leaves))
+    for n, leaf in zip(noise, leaves):
+      n.set_shape(leaf.shape)
+    return [tf.cast(n, leaf.dtype) for n, leaf in zip(noise, leaves)]
+
+
+def engine_gaussian_query(l2_norm_clip, noise_multiplier, run=0, worker=0,
+                          depth=3, threads=4):
+  """Drop-in dp_sum_query drawing its noise from a shared NoiseEngine."""
+  return EngineGaussianSumQuery(l2_norm_clip, l2_norm_clip * noise_multiplier,
+                                run, worker, depth, threads)
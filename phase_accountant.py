@@ -0,0 +1,129 @@
+r"""Privacy of a training run made of heterogeneous phases.
+
+Real runs have phases: a warm-up with one noise multiplier and batch size,
+the main phase, sometimes fine-tuning on a subset with its own N. A run is a
+list of Phase(epoch, noise_multi, N, batch_size), each phase being epoch
+passes of DP-SGD over its N examples, and the phases compose by one of
+
+  'CLT': GDP composition, mu = sqrt(sum of the phases' mu^2);
+  'RDP': the moments accountant, the phases' RDP vectors add up;
+  'PLD': pld_accountant, the phases' privacy loss distributions convolve.
+
+Per-phase results (mu, RDP vector, PLD) are cached by the phase and method
+parameters, so recomposing a plan after changing one phase only computes
+that phase again. The PLDs of a plan share their grid: the spacing is the
+largest power of two within eps_error/(total steps), so it only moves when
+the total number of steps doubles or halves.
+
+Example:
+  plan = [Phase(1, 2.0, 60000, 1024), Phase(14, 1.1, 60000, 256),
+          Phase(3, 1.3, 10000, 128)]
+  compose_epsilon(plan, 1e-5, method='PLD')
+"""
+
+import collections
+import functools
+
+import numpy as np
+
+from gdp_accountant import *
+
+Phase=collections.namedtuple('Phase',['epoch','noise_multi','N','batch_size'])
+
+# Per-phase PLDs kept in memory; each takes up to ~16 bytes per grid point
+PLD_CACHE_SIZE=16
+
+
+# GDP mu of one phase
+@functools.lru_cache(maxsize=None)
+def phase_mu(phase,subsampling='Poisson'):
+    if subsampling=='Poisson':
+        return float(compute_muP(*phase))
+    if subsampling=='Uniform':
+        return float(compute_muU(*phase))
+    raise ValueError('subsampling must be Poisson or Uniform, got %r' % subsampling)
+
+# RDP vector of one phase at RDP_ORDERS (shared, do not modify)
+@functools.lru_cache(maxsize=None)
+def phase_rdp(phase):
+    return compute_rdp_vector(*phase)
+
+# Composed PLD of one phase on the grid k*h, truncated to its bulk
+@functools.lru_cache(maxsize=PLD_CACHE_SIZE)
+def phase_pld(phase,direction,h,tail_mass=1e-15):
+    pld=subsampled_gaussian_pld(phase.noise_multi,phase.batch_size/phase.N,
+                                _steps(phase),direction,tail_mass=tail_mass,h=h)
+    return truncate_pld(pld,tail_mass)
+
+# Coarsest spacing one phase needs to keep its FFT window in max_points
+@functools.lru_cache(maxsize=None)
+def _memory_spacing(phase,direction,tail_mass,max_points):
+    return grid_spacing(phase.noise_multi,phase.batch_size/phase.N,_steps(phase),
+                        direction,0.,tail_mass,max_points)
+
+def _steps(phase):
+    return phase.epoch*phase.N/phase.batch_size
+
+def _phases(phases):
+    return [Phase(*phase) for phase in phases]
+
+def _directions(subsampling):
+    if subsampling=='Poisson':
+        return ('remove','add')
+    if subsampling=='Uniform':
+        return ('symmetric',)
+    raise ValueError('subsampling must be Poisson or Uniform, got %r' % subsampling)
+
+
+# Shared grid spacing of a plan, a power of two
+def plan_spacing(phases,direction,eps_error=0.01,tail_mass=1e-15,max_points=2**23):
+    phases=_phases(phases)
+    steps=sum(int(round(_steps(phase))) for phase in phases)
+    h=2.**np.floor(np.log2(eps_error/steps))
+    coarsest=max(_memory_spacing(phase,direction,tail_mass,max_points) for phase in phases)
+    return h if coarsest<=h else 2.**np.ceil(np.log2(coarsest))
+
+# PLD of the whole plan in one direction
+def plan_pld(phases,direction,eps_error=0.01,tail_mass=1e-15):
+    phases=_phases(phases)
+    h=plan_spacing(phases,direction,eps_error,tail_mass)
+    return compose_plds([phase_pld(phase,direction,h,tail_mass) for phase in phases],
+                        h,tail_mass)
+
+
+# GDP mu of the plan by CLT
+def compose_mu(phases,subsampling='Poisson'):
+    return np.sqrt(sum(phase_mu(phase,subsampling)**2 for phase in _phases(phases)))
+
+# RDP vector of the plan
+def compose_rdp(phases):
+    return sum(phase_rdp(phase) for phase in _phases(phases))
+
+# Epsilon of the plan; RDP is the moments accountant's Poisson analysis
+# whatever the subsampling, as for compute_epsilon
+def compose_epsilon(phases,delta,method='CLT',subsampling='Poisson',eps_error=0.01):
+    if method=='CLT':
+        return eps_from_mu(compose_mu(phases,subsampling),delta)
+    if method=='RDP':
+        return eps_from_rdp(compose_rdp(phases),delta)
+    if method=='PLD':
+        return max(float(plan_pld(phases,d,eps_error).epsilon(delta))
+                   for d in _directions(subsampling))
+    raise ValueError('method must be CLT, RDP or PLD, got %r' % method)
+
+# Delta of the plan at eps
+def compose_delta(phases,eps,method='CLT',subsampling='Poisson',eps_error=0.01):
+    if method=='CLT':
+        return float(delta_eps_mu(eps,compose_mu(phases,subsampling)))
+    if method=='RDP':
+        return delta_from_rdp(compose_rdp(phases),eps)
+    if method=='PLD':
+        return max(float(plan_pld(phases,d,eps_error).delta(eps))
+                   for d in _directions(subsampling))
+    raise ValueError('method must be CLT, RDP or PLD, got %r' % method)
+
+
+# Empties the per-phase caches
+def clear_phase_cache():
+    for cached in (phase_mu,phase_rdp,phase_pld,_memory_spacing):
+        cached.cache_clear()
@@ -0,0 +1,219 @@
+r"""Numerical privacy accountant for the subsampled Gaussian mechanism.
+
+The privacy loss distribution (PLD) of one DP-SGD step is discretized on a
+grid of spacing h, composed over T steps by FFT, and converted to
+(epsilon, delta). Unlike the CLT it needs neither many steps nor a small
+sampling rate, so gdp_accountant routes the points where the CLT is not
+reliable here.
+
+Each step with sampling rate p and noise multiplier sigma is the pair
+  P = N(0,1)  and  Q = (1-p) N(0,1) + p N(1/sigma,1)
+(removing an example, its tradeoff function is f_p = p G + (1-p) Id) or the
+same pair swapped (adding one, f_p^-1). Poisson subsampling reports the
+worse of the two directions. Uniform subsampling follows the analysis
+behind compute_muU: the tradeoff function is the symmetrization
+C_p(G) = min(f_p, f_p^-1)**, whose PLD keeps the positive losses of f_p,
+mirrors them (mass e^-l at -l) and puts the rest on a loss of 0.
+
+The discretization is pessimistic: every loss is rounded up to the grid and
+losses beyond the tail cut count as infinite, so the reported epsilon and
+delta are upper bounds and overshoot by at most T*h in epsilon. h is chosen
+as eps_error/T unless the grid would exceed max_points. Mass wrapping
+around the circular FFT window is below tail_mass.
+"""
+
+import numpy as np
+import scipy.fft
+from scipy.special import ndtr, ndtri
+
+
+class PrivacyLossDistribution(object):
+    """Discretized law of the privacy loss under Q, with an atom at +inf."""
+
+    def __init__(self,losses,pmf,infinity_mass=0.):
+        self.losses=np.asarray(losses,dtype=float)
+        self.pmf=np.asarray(pmf,dtype=float)
+        self.infinity_mass=infinity_mass
+        # Suffix sums of the positive losses give delta(eps) for eps >= 0
+        positive=self.losses>0
+        self._l=self.losses[positive]
+        w=self.pmf[positive]
+        self._tail=np.append(np.cumsum(w[::-1])[::-1],0.)
+        self._tail_exp=np.append(np.cumsum((w*np.exp(-self._l))[::-1])[::-1],0.)
+
+    def delta(self,eps):
+        """delta(eps) = E_Q[(1 - e^(eps - L))_+], elementwise for eps >= 0."""
+        eps=np.asarray(eps,dtype=float)
+        i=np.searchsorted(self._l,eps,side='right')
+        return np.maximum(self._tail[i]-np.exp(eps)*self._tail_exp[i],0.)+self.infinity_mass
+
+    def epsilon(self,delta):
+        """Smallest eps >= 0 with delta(eps) <= delta, elementwise."""
+        delta=np.asarray(delta,dtype=float)
+        # First grid loss where delta(eps) <= delta; below it the losses
+        # above eps are fixed, so tail - e^eps * tail_exp = delta is exact
+        at_grid=self.delta(self._l)
+        j=np.searchsorted(-at_grid,-delta,side='left')
+        with np.errstate(divide='ignore',invalid='ignore'):
+            eps=np.log((self._tail[j]+self.infinity_mass-delta)/self._tail_exp[j])
+        return np.maximum(np.where(j<len(self._l),eps,np.inf),0.)
+
+
+# Survival function S(l)=Q(L>l) and the loss range of one step of a pair
+def _pair(p,mu,direction,t):
+    if direction=='remove':
+        # L(x)=log(1-p+p*exp(mu*x-mu^2/2)) is increasing, Q is the mixture
+        def loss(x):
+            return np.logaddexp(np.log1p(-p) if p<1 else -np.inf,np.log(p)+mu*x-mu**2/2)
+        def survival(l):
+            with np.errstate(divide='ignore',invalid='ignore'):
+                x=(np.log1p(np.expm1(l)/p)+mu**2/2)/mu
+            x=np.where(np.isnan(x),-np.inf,x)
+            return (1-p)*ndtr(-x)+p*ndtr(mu-x)
+        return survival,loss(-t),loss(mu+t)
+    if direction=='add':
+        # L(x)=-log(1-p+p*exp(mu*x-mu^2/2)) is decreasing, Q is N(0,1)
+        def loss(x):
+            return -np.logaddexp(np.log1p(-p) if p<1 else -np.inf,np.log(p)+mu*x-mu**2/2)
+        def survival(l):
+            with np.errstate(divide='ignore',invalid='ignore'):
+                x=(np.log1p(np.expm1(-l)/p)+mu**2/2)/mu
+            x=np.where(np.isnan(x),-np.inf,x)
+            return ndtr(x)
+        return survival,loss(mu+t),loss(-t)
+    raise ValueError('direction must be add or remove, got %r' % direction)
+
+
+# Pessimistic per-step PLD on the grid k*h: lowest grid index, pmf, mass at +inf
+def _step_pld(p,noise_multi,direction,h,t):
+    mu=1./noise_multi
+    survival,low,high=_pair(p,mu,'remove' if direction=='symmetric' else direction,t)
+    if direction=='symmetric':
+        k_hi=max(int(np.ceil(high/h)),1)
+        s=survival(h*np.arange(0,k_hi+1))
+        positive=s[:-1]-s[1:]
+        l=h*np.arange(1,k_hi+1)
+        negative=(positive*np.exp(-l))[::-1]
+        zero=1.-positive.sum()-negative.sum()-s[-1]
+        return -k_hi,np.concatenate([negative,[zero],positive]),s[-1]
+    k_lo=int(np.floor(low/h))
+    k_hi=max(int(np.ceil(high/h)),k_lo+1)
+    s=survival(h*np.arange(k_lo,k_hi+1))
+    return k_lo,np.concatenate([[1.-s[0]],s[:-1]-s[1:]]),s[-1]
+
+
+def _moments(k_lo,pmf):
+    k=k_lo+np.arange(len(pmf))
+    mean=np.dot(k,pmf)/pmf.sum()
+    return k,mean,np.sqrt(max(np.dot((k-mean)**2,pmf)/pmf.sum(),0.))
+
+
+# FFT size holding one step's losses and stds deviations of the composed ones
+def _window(k_lo,pmf,steps,stds):
+    k,mean,sd=_moments(k_lo,pmf)
+    half=max(k[-1]-mean,mean-k[0])+stds*sd*np.sqrt(steps)+1
+    return 1<<int(np.ceil(np.log2(2*half)))
+
+
+# T-fold composition by FFT on a circular window of size n around the mean
+def _compose(k_lo,pmf,infinity_mass,steps,h,n):
+    k,mean,_=_moments(k_lo,pmf)
+    center=int(round(steps*mean))
+    x=np.zeros(n)
+    np.add.at(x,k%n,pmf)
+    composed=np.fft.irfft(np.fft.rfft(x)**steps,n)
+    # Composed index j stands for the grid index in [center-n/2, center+n/2)
+    index=center-n//2+np.arange(n)
+    composed=np.maximum(composed[index%n],0.)
+    return PrivacyLossDistribution(h*index,composed,1.-(1.-infinity_mass)**steps)
+
+
+# PLD of steps Poisson or uniformly subsampled Gaussian steps in one direction;
+# h fixes the grid spacing instead of eps_error (e.g. to compose with others)
+def subsampled_gaussian_pld(noise_multi,sampling_rate,steps,direction,
+                            eps_error=0.01,tail_mass=1e-15,max_points=2**23,h=None):
+    steps=int(round(steps))
+    t=-ndtri(tail_mass/steps)
+    if h is None:
+        h=grid_spacing(noise_multi,sampling_rate,steps,direction,eps_error,tail_mass,max_points)
+    k_lo,pmf,infinity_mass=_step_pld(sampling_rate,noise_multi,direction,h,t)
+    return _compose(k_lo,pmf,infinity_mass,steps,h,_window(k_lo,pmf,steps,t))
+
+
+# Grid spacing of subsampled_gaussian_pld: eps_error/steps unless the FFT
+# window would exceed 2*max_points
+def grid_spacing(noise_multi,sampling_rate,steps,direction,
+                 eps_error=0.01,tail_mass=1e-15,max_points=2**23):
+    steps=int(round(steps))
+    t=-ndtri(tail_mass/steps)
+    # The grid is sized on the range of one step's losses
+    _,low,high=_pair(sampling_rate,1./noise_multi,
+                     'remove' if direction=='symmetric' else direction,t)
+    span=2*max(abs(low),abs(high)) if direction=='symmetric' else high-low
+    h=max(eps_error/steps,span/max_points)
+    while True:
+        k_lo,pmf,_=_step_pld(sampling_rate,noise_multi,direction,h,t)
+        n=_window(k_lo,pmf,steps,t)
+        if n<=2*max_points:
+            return h
+        # The composed losses spread wider than one step's: coarsen the grid
+        h*=n/(2*max_points)
+
+
+# Drops the grid points outside [tail_mass, 1-tail_mass] of the law; the lower
+# tail moves up to the first kept loss and the upper tail to +inf, so the
+# truncated PLD stays pessimistic
+def truncate_pld(pld,tail_mass=1e-15):
+    cdf=np.cumsum(pld.pmf)
+    lo=int(np.searchsorted(cdf,tail_mass,side='right'))
+    hi=max(int(np.searchsorted(cdf,cdf[-1]-tail_mass,side='left'))+1,lo+1)
+    pmf=pld.pmf[lo:hi].copy()
+    pmf[0]+=cdf[lo-1] if lo>0 else 0.
+    return PrivacyLossDistribution(pld.losses[lo:hi],pmf,
+                                   pld.infinity_mass+cdf[-1]-cdf[hi-1])
+
+
+# Composition of PLDs on the grid k*h, e.g. training phases with different
+# noise multipliers, batch sizes or datasets: the laws convolve
+def compose_plds(plds,h,tail_mass=1e-15):
+    plds=[truncate_pld(pld,tail_mass) for pld in plds]
+    for pld in plds:
+        if len(pld.losses)>1 and not np.isclose(pld.losses[1]-pld.losses[0],h):
+            raise ValueError('PLD on spacing %g cannot compose on spacing %g'
+                             % (pld.losses[1]-pld.losses[0],h))
+    k_lo=sum(int(round(pld.losses[0]/h)) for pld in plds)
+    # One transform per PLD at the size of the full linear convolution
+    size=sum(len(pld.pmf) for pld in plds)-len(plds)+1
+    n=scipy.fft.next_fast_len(size,real=True)
+    spectrum=np.ones(n//2+1,dtype=complex)
+    for pld in plds:
+        spectrum*=scipy.fft.rfft(pld.pmf,n,workers=-1)
+    pmf=np.maximum(scipy.fft.irfft(spectrum,n,workers=-1)[:size],0.)
+    survive=np.prod([1.-pld.infinity_mass for pld in plds])
+    return PrivacyLossDistribution(h*(k_lo+np.arange(size)),pmf,1.-survive)
+
+
+# Numerical epsilon of DP-SGD, an upper bound within eps_error of the exact value
+def pld_epsilon(epoch,noise_multi,N,batch_size,delta,subsampling='Poisson',
+                eps_error=0.01):
+    steps=epoch*N/batch_size
+    p=batch_size/N
+    if subsampling=='Poisson':
+        return max(float(subsampled_gaussian_pld(noise_multi,p,steps,d,eps_error).epsilon(delta))
+                   for d in ('remove','add'))
+    if subsampling=='Uniform':
+        return float(subsampled_gaussian_pld(noise_multi,p,steps,'symmetric',eps_error).epsilon(delta))
+    raise ValueError('subsampling must be Poisson or Uniform, got %r' % subsampling)
+
+
+# Numerical delta of DP-SGD at eps, an upper bound
+def pld_delta(epoch,noise_multi,N,batch_size,eps,subsampling='Poisson',
+              eps_error=0.01):
+    steps=epoch*N/batch_size
+    p=batch_size/N
+    if subsampling=='Poisson':
+        return max(float(subsampled_gaussian_pld(noise_multi,p,steps,d,eps_error).delta(eps))
+                   for d in ('remove','add'))
+    if subsampling=='Uniform':
+        return float(subsampled_gaussian_pld(noise_multi,p,steps,'symmetric',eps_error).delta(eps))
+    raise ValueError('subsampling must be Poisson or Uniform, got %r' % subsampling)
@@ -0,0 +1,76 @@
+r"""Poisson subsampling in expected O(qN) time per step.
+
+Poisson subsampling includes each of the N examples independently with
+probability q = batch_size / N. Instead of drawing N uniforms per step, the
+gaps between consecutive included indices are drawn directly: they are
+i.i.d. Geometric(q), so a step costs about qN draws however large N is.
+
+Each step draws from its own counter-based stream (seed, SAMPLING, step), see
+dp_random.py, so a step's indices are reproducible on their own, in any order
+and in any thread. A
+PoissonSampler also precomputes the next epoch's index lists in a background
+thread while the current epoch trains.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from dp_random import *
+
+# Indices of range(N) included independently with probability q
+def poisson_sample(N,q,rng):
+    if q<=0:
+        return np.zeros(0,dtype=np.int64)
+    # Draw the gaps in chunks a few standard deviations above the mean count
+    expected=q*N
+    chunk=int(expected+6*np.sqrt(expected)+16)
+    samples=[]
+    last=-1
+    while True:
+        indices=last+np.cumsum(rng.geometric(q,size=chunk))
+        if indices[-1]>=N:
+            samples.append(indices[:np.searchsorted(indices,N)])
+            break
+        samples.append(indices)
+        last=indices[-1]
+    return np.concatenate(samples)
+
+
+class PoissonSampler(object):
+    """Reproducible per-step Poisson samples with background epoch prefetch."""
+
+    def __init__(self,N,batch_size,steps_per_epoch,seed=0):
+        self.N=N
+        self.q=batch_size/N
+        self.steps_per_epoch=steps_per_epoch
+        self.seed=seed
+        self._executor=ThreadPoolExecutor(max_workers=1)
+        self._epochs={}
+
+    def sample(self,step):
+        """Indices of the examples in global step `step`."""
+        return poisson_sample(self.N,self.q,numpy_stream(self.seed,SAMPLING,step))
+
+    def prefetch(self,epoch):
+        """Starts computing the index lists of epoch in the background."""
+        if epoch not in self._epochs:
+            self._epochs[epoch]=self._executor.submit(self._sample_epoch,epoch)
+
+    def epoch(self,epoch):
+        """Index lists of every step of epoch (counted from 1).
+
+        Also starts precomputing the next epoch.
+        """
+        self.prefetch(epoch)
+        steps=self._epochs.pop(epoch).result()
+        self.prefetch(epoch+1)
+        return steps
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._epochs.clear()
+
+    def _sample_epoch(self,epoch):
+        first=(epoch-1)*self.steps_per_epoch
+        return [self.sample(step) for step in range(first,first+self.steps_per_epoch)]
@@ -0,0 +1,57 @@
+r"""Reduced-precision DP-SGD: forward and backward passes in bfloat16/float16
+while per-example clipping and noise addition stay in float32.
+
+Under a 'mixed_bfloat16' or 'mixed_float16' Keras policy every layer keeps
+float32 variables and casts them to the compute dtype inside `call`, so the
+gradients handed to the DP optimizer are float32. Per-example norms, clipping
+and the Gaussian noise of `dp_optimizer` therefore run in float32 and the
+privacy guarantee (noise_multiplier = stddev / l2_norm_clip) is unchanged.
+
+Loss scaling: float16 gradients underflow, so the per-example losses are
+multiplied by a static loss_scale S. Clipping is not linear, but it commutes
+with scaling when the clipping norm is scaled as well:
+
+  clip(S * g, S * C) = S * clip(g, C)
+
+and the optimizer's noise stddev noise_multiplier * (S * C) scales with it.
+The privatized gradient is thus exactly S times the unscaled one and is
+unscaled through the optimizer hyperparameters: learning_rate / S for SGD,
+epsilon * S for Adam (which is otherwise invariant to the gradient scale).
+bfloat16 has the float32 exponent range and needs no loss scaling (S = 1).
+"""
+
+import tensorflow as tf
+
+PRECISIONS = ('float32', 'bfloat16', 'float16')
+
+
+def set_precision(precision):
+  """Sets the Keras dtype policy used by layers built afterwards."""
+  if precision not in PRECISIONS:
+    raise ValueError('precision must be one of %s, got %r' %
+                     (', '.join(PRECISIONS), precision))
+  policy = precision if precision == 'float32' else 'mixed_' + precision
+  try:
+    set_policy = tf.keras.mixed_precision.set_global_policy
+  except AttributeError:  # TF < 2.4
+    set_policy = tf.keras.mixed_precision.experimental.set_policy
+  set_policy(policy)
+
+
+def scale_for_clipping(vector_loss, l2_norm_clip, loss_scale):
+  """Scales the per-example losses and the clipping norm by loss_scale.
+
+  Feed the returned loss and clipping norm to the DP optimizer together with
+  `unscaled_learning_rate` (SGD) or `unscaled_epsilon` (Adam).
+  """
+  return vector_loss * loss_scale, l2_norm_clip * loss_scale
+
+
+def unscaled_learning_rate(learning_rate, loss_scale):
+  """SGD learning rate that undoes a static loss scale."""
+  return learning_rate / loss_scale
+
+
+def unscaled_epsilon(epsilon, loss_scale):
+  """Adam epsilon that makes the update exactly invariant to a loss scale."""
+  return epsilon * loss_scale
@@ -0,0 +1,237 @@
+r"""Persistent, append-only ledger of the privacy spent on each dataset.
+
+Every training run on a dataset is appended with its mu (GDP CLT) and/or
+its RDP vector at RDP_ORDERS (moments accountant). Runs on one dataset
+compose: mu^2 adds up for GDP and RDP vectors add up for the MA, so the
+ledger keeps these running sums per dataset and answers "how much budget is
+left on dataset X" in O(1), however many runs were logged.
+
+A ledger is a directory with two files:
+  runs.log    append-only records (dataset key, time, mu, RDP vector)
+  totals.bin  one fixed-size slot per dataset with the run counts, the sum
+              of mu^2 and the summed RDP vector; the header stores how much
+              of runs.log the totals cover
+
+Runs are appended to runs.log before totals.bin is updated, and each slot
+remembers the log offset it has applied up to. If a process dies between
+the two writes, the next open replays the uncovered tail of runs.log, so
+the totals never miss or double count a run. Writers in several processes
+are serialized with a file lock where fcntl is available.
+
+Example:
+  ledger = PrivacyLedger('ledger/')
+  ledger.record_run('mnist', 15, 1.3, 60000, 256)
+  ledger.remaining('mnist', max_mu=2, max_eps=8, delta=1e-5)
+"""
+
+import contextlib
+import hashlib
+import os
+import struct
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking
+    fcntl = None
+
+from gdp_accountant import *
+
+_LOG_MAGIC=b'GDPLOG01'
+_TOTALS_MAGIC=b'GDPTOT01'
+# dataset key, time, mu (nan if not given), length of the RDP vector
+_RECORD=struct.Struct('<16sddI')
+# magic, length of the RDP vectors, size of runs.log covered by the totals
+_HEADER=struct.Struct('<8sIQ')
+# dataset key, runs, runs with mu, runs with RDP, sum of mu^2, applied log end
+_SLOT=struct.Struct('<16sQQQdQ')
+
+
+# Fingerprint of the arrays making up a dataset, usable as a ledger key
+def dataset_fingerprint(*arrays):
+    h=hashlib.sha256()
+    for a in arrays:
+        a=np.ascontiguousarray(a)
+        h.update(repr((a.dtype.str,a.shape)).encode())
+        h.update(a.data)
+    return h.hexdigest()[:32]
+
+
+def _key(dataset):
+    return hashlib.sha256(dataset.encode()).digest()[:16]
+
+
+class PrivacyLedger(object):
+    """Per-dataset privacy totals backed by an append-only run log."""
+
+    def __init__(self,path):
+        self.num_orders=len(RDP_ORDERS)
+        self._slot_size=_SLOT.size+8*self.num_orders
+        os.makedirs(path,exist_ok=True)
+        log_path=os.path.join(path,'runs.log')
+        totals_path=os.path.join(path,'totals.bin')
+        if not os.path.exists(log_path):
+            with open(log_path,'wb') as f:
+                f.write(_LOG_MAGIC)
+        if not os.path.exists(totals_path):
+            with open(totals_path,'wb') as f:
+                f.write(_HEADER.pack(_TOTALS_MAGIC,self.num_orders,len(_LOG_MAGIC)))
+        self._log=open(log_path,'a+b')
+        self._totals=open(totals_path,'r+b')
+        # Slot of each dataset key; slots are only ever appended
+        self._slots={}
+        with self._locked():
+            magic,num_orders,_=self._read_header()
+            if magic!=_TOTALS_MAGIC or num_orders!=self.num_orders:
+                raise ValueError('%s is not a ledger for %d RDP orders' %
+                                 (totals_path,self.num_orders))
+            self._recover()
+
+    def close(self):
+        self._log.close()
+        self._totals.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+    def append(self,dataset,mu=None,rdp=None):
+        """Logs one run on dataset with its mu and/or RDP vector."""
+        rdp=np.zeros(0) if rdp is None else np.asarray(rdp,dtype='<f8')
+        if rdp.size not in (0,self.num_orders):
+            raise ValueError('rdp must have one value per RDP_ORDERS entry')
+        mu=np.nan if mu is None else float(mu)
+        key=_key(dataset)
+        with self._locked():
+            self._recover()
+            self._log.seek(0,os.SEEK_END)
+            self._log.write(_RECORD.pack(key,time.time(),mu,rdp.size)+rdp.tobytes())
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            end=self._log.tell()
+            self._apply(key,end,mu,rdp)
+            self._write_header(end)
+
+    def record_run(self,dataset,epoch,noise_multi,N,batch_size,subsampling='Poisson'):
+        """Logs a training run with both its CLT mu and its MA RDP vector."""
+        if subsampling=='Poisson':
+            mu=compute_muP(epoch,noise_multi,N,batch_size)
+        elif subsampling=='Uniform':
+            mu=compute_muU(epoch,noise_multi,N,batch_size)
+        else:
+            raise ValueError('subsampling must be Poisson or Uniform, got %r' % subsampling)
+        self.append(dataset,mu,compute_rdp_vector(epoch,noise_multi,N,batch_size))
+
+    def totals(self,dataset):
+        """Composed mu and RDP vector over all runs logged on dataset.
+
+        A total is inf if some run was logged without that quantity.
+        """
+        key=_key(dataset)
+        with self._locked(fcntl.LOCK_SH if fcntl else None):
+            slot=self._index().get(key)
+            if slot is None:
+                runs,gdp_runs,rdp_runs,mu2,rdp=0,0,0,0.,np.zeros(self.num_orders)
+            else:
+                _,runs,gdp_runs,rdp_runs,mu2,_,rdp=self._read_slot(slot)
+        return {'runs':runs,
+                'mu':np.sqrt(mu2) if gdp_runs==runs else np.inf,
+                'rdp':rdp if rdp_runs==runs else np.full(self.num_orders,np.inf)}
+
+    def remaining(self,dataset,max_mu=None,max_eps=None,delta=None):
+        """Budget left on dataset, as mu (GDP) and/or epsilon at delta (MA)."""
+        totals=self.totals(dataset)
+        result={'runs':totals['runs'],'mu':totals['mu']}
+        if max_mu is not None:
+            result['remaining_mu']=np.sqrt(max(max_mu**2-totals['mu']**2,0.))
+        if max_eps is not None:
+            eps=eps_from_rdp(totals['rdp'],delta) if totals['runs'] else 0.
+            result['eps']=eps
+            result['remaining_eps']=max(max_eps-eps,0.)
+        return result
+
+    @contextlib.contextmanager
+    def _locked(self,operation=fcntl.LOCK_EX if fcntl else None):
+        if operation is None:
+            yield
+            return
+        fcntl.flock(self._log.fileno(),operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._log.fileno(),fcntl.LOCK_UN)
+
+    def _read_header(self):
+        self._totals.seek(0)
+        return _HEADER.unpack(self._totals.read(_HEADER.size))
+
+    def _write_header(self,log_size):
+        self._totals.seek(0)
+        self._totals.write(_HEADER.pack(_TOTALS_MAGIC,self.num_orders,log_size))
+        self._totals.flush()
+
+    # Reads only the slots added since the last call, by any process
+    def _index(self):
+        self._totals.seek(0,os.SEEK_END)
+        num_slots=(self._totals.tell()-_HEADER.size)//self._slot_size
+        if num_slots<len(self._slots):
+            self._slots={}
+        for slot in range(len(self._slots),num_slots):
+            self._totals.seek(_HEADER.size+slot*self._slot_size)
+            self._slots[self._totals.read(16)]=slot
+        return self._slots
+
+    def _read_slot(self,slot):
+        self._totals.seek(_HEADER.size+slot*self._slot_size)
+        data=self._totals.read(self._slot_size)
+        rdp=np.frombuffer(data,dtype='<f8',offset=_SLOT.size).copy()
+        return _SLOT.unpack_from(data)+(rdp,)
+
+    def _apply(self,key,end,mu,rdp):
+        index=self._index()
+        if key in index:
+            slot=index[key]
+            _,runs,gdp_runs,rdp_runs,mu2,applied,rdp_sum=self._read_slot(slot)
+            if end<=applied:
+                return
+        else:
+            slot=len(index)
+            runs,gdp_runs,rdp_runs,mu2,rdp_sum=0,0,0,0.,np.zeros(self.num_orders)
+        runs+=1
+        if not np.isnan(mu):
+            gdp_runs+=1
+            mu2+=mu**2
+        if rdp.size:
+            rdp_runs+=1
+            rdp_sum=rdp_sum+rdp
+        self._totals.seek(_HEADER.size+slot*self._slot_size)
+        self._totals.write(_SLOT.pack(key,runs,gdp_runs,rdp_runs,mu2,end)+
+                           rdp_sum.astype('<f8').tobytes())
+
+    def _recover(self):
+        """Applies runs that reached runs.log but not totals.bin."""
+        _,_,covered=self._read_header()
+        self._log.seek(0,os.SEEK_END)
+        log_size=self._log.tell()
+        if covered==log_size:
+            return
+        if covered>log_size:
+            raise ValueError('runs.log is shorter than the totals it produced')
+        self._log.seek(covered)
+        offset=covered
+        while offset+_RECORD.size<=log_size:
+            key,_,mu,num_orders=_RECORD.unpack(self._log.read(_RECORD.size))
+            end=offset+_RECORD.size+8*num_orders
+            if end>log_size:
+                break
+            rdp=np.frombuffer(self._log.read(8*num_orders),dtype='<f8')
+            self._apply(key,end,mu,rdp)
+            offset=end
+        if offset<log_size:
+            # Drop a partially written trailing record.
+            self._log.truncate(offset)
+        self._write_header(offset)
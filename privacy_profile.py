@@ -0,0 +1,174 @@
+r"""The privacy profile of a trained model: epsilon as a function of delta.
+
+A single (epsilon, delta) hides the rest of the curve, which downstream
+reviews ask for. Calling compute_epsP or compute_epsilon once per delta
+pays a root solve (or an RDP computation) per point; here the whole
+profile comes from one pass:
+
+  'CLT': the curve of mu-GDP is known in closed form,
+    delta(eps) = Phi(-eps/mu + mu/2) - e^eps Phi(-eps/mu - mu/2),
+    so every delta is solved at once by safeguarded Newton steps on
+    log delta(eps), vectorized over delta, starting from the bound
+    eps <= mu^2/2 - mu Phi^-1(delta);
+  'MA': one RDP vector at RDP_ORDERS gives every delta by minimizing over
+    the orders, eps = min_a rdp_a + log(1-1/a) - log(a delta)/(a-1) (the
+    conversion of recent tensorflow_privacy releases), a single
+    (deltas x orders) array operation.
+
+A profile records the configuration, mu and the RDP vector, from which any
+other delta can be recomputed, and is saved as JSON (text for any
+tooling; floats round-trip exactly) or NPZ (compressed, about a third of
+the size).
+
+Example:
+  python privacy_profile.py \
+    --N=60000 \
+    --batch_size=256 \
+    --noise_multiplier=1.3 \
+    --epochs=15 \
+    --output=mnist_profile.json
+
+  profile = privacy_profile(15, 1.3, 60000, 256)
+  save_profile(profile, 'mnist_profile.json')
+"""
+
+import collections
+import json
+
+import numpy as np
+from scipy.special import log_ndtr, ndtri
+
+from gdp_accountant import *
+
+# 10 points per decade from 1e-12 to 1e-1
+PROFILE_DELTAS=np.logspace(-12,-1,111)
+
+PrivacyProfile=collections.namedtuple('PrivacyProfile',
+                                      ['config','delta','eps','mu','orders','rdp'])
+
+
+# Epsilon of mu-GDP at each delta, vectorized (eps_from_mu for arrays)
+def gdp_profile(mu,deltas,tol=1e-12,max_iter=100):
+    deltas=np.asarray(deltas,dtype=float)
+    target=np.log(deltas)
+    lo=np.zeros_like(deltas)
+    hi=np.maximum(mu**2/2-mu*ndtri(deltas),0.)
+    eps=hi.copy()
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        for _ in range(max_iter):
+            log_delta=np.log(delta_eps_mu(eps,mu))
+            g=log_delta-target
+            # delta decreases in eps: g>0 means eps is too small
+            lo=np.where(g>0,eps,lo)
+            hi=np.where(g>0,hi,eps)
+            slope=-np.exp(eps+log_ndtr(-eps/mu-mu/2)-log_delta)
+            done=(np.abs(g)<tol)|(hi-lo<tol*np.maximum(hi,1.))
+            if np.all(done):
+                break
+            step=eps-g/slope
+            inside=np.isfinite(step)&(step>=lo)&(step<=hi)
+            eps=np.where(done,eps,np.where(inside,step,(lo+hi)/2))
+    # delta(0) within the target: (0,delta)-DP
+    return np.where(delta_eps_mu(0.,mu)<=deltas,0.,eps)
+
+# Epsilon at each delta from one RDP vector at orders, and the best order
+def rdp_profile(rdp,deltas,orders=RDP_ORDERS):
+    deltas=np.asarray(deltas,dtype=float)[...,None]
+    orders=np.asarray(orders,dtype=float)
+    rdp=np.asarray(rdp,dtype=float)
+    with np.errstate(divide='ignore'):
+        eps=rdp+np.log1p(-1/orders)-np.log(deltas*orders)/(orders-1)
+    eps=np.where(orders>1.01,eps,np.inf)
+    eps=np.where(deltas**2+np.expm1(-rdp)>=0,0.,eps)
+    best=np.argmin(eps,axis=-1)
+    return np.maximum(np.take_along_axis(eps,best[...,None],-1)[...,0],0.),orders[best]
+
+# Profile of DP-SGD trained for epoch epochs, by CLT and/or the MA
+def privacy_profile(epoch,noise_multi,N,batch_size,deltas=PROFILE_DELTAS,
+                    subsampling='Poisson',methods=('CLT','MA')):
+    deltas=np.asarray(deltas,dtype=float)
+    config={'epoch':epoch,'noise_multi':noise_multi,'N':N,'batch_size':batch_size,
+            'subsampling':subsampling}
+    eps={}
+    mu=rdp=None
+    for method in methods:
+        if method=='CLT':
+            compute_mu=compute_muP if subsampling=='Poisson' else compute_muU
+            mu=float(compute_mu(epoch,noise_multi,N,batch_size))
+            eps['CLT']=gdp_profile(mu,deltas)
+        elif method=='MA':
+            # The moments accountant analyses Poisson subsampling, as compute_epsilon
+            rdp=np.asarray(compute_rdp_vector(epoch,noise_multi,N,batch_size),dtype=float)
+            eps['MA']=rdp_profile(rdp,deltas)[0]
+        else:
+            raise ValueError('method must be CLT or MA, got %r' % method)
+    return PrivacyProfile(config,deltas,eps,mu,
+                          None if rdp is None else np.asarray(RDP_ORDERS,dtype=float),rdp)
+
+
+# Writes a profile as JSON or NPZ, by the extension of path
+def save_profile(profile,path):
+    if path.endswith('.npz'):
+        arrays={'delta':profile.delta,'config':np.array(json.dumps(profile.config))}
+        arrays.update(('eps_'+method,eps) for method,eps in profile.eps.items())
+        if profile.mu is not None:
+            arrays['mu']=np.array(profile.mu)
+        if profile.rdp is not None:
+            arrays.update(orders=profile.orders,rdp=profile.rdp)
+        np.savez_compressed(path,**arrays)
+    elif path.endswith('.json'):
+        record=profile._replace(
+            delta=profile.delta.tolist(),
+            eps={method:eps.tolist() for method,eps in profile.eps.items()},
+            orders=None if profile.orders is None else profile.orders.tolist(),
+            rdp=None if profile.rdp is None else profile.rdp.tolist())._asdict()
+        with open(path,'w') as f:
+            json.dump(record,f,separators=(',',':'))
+    else:
+        raise ValueError('profiles are saved as .json or .npz, got %r' % path)
+
+# Reads a profile written by save_profile
+def load_profile(path):
+    if path.endswith('.npz'):
+        with np.load(path) as f:
+            eps={name[4:]:f[name] for name in f.files if name.startswith('eps_')}
+            return PrivacyProfile(json.loads(str(f['config'])),f['delta'],eps,
+                                  float(f['mu']) if 'mu' in f.files else None,
+                                  f['orders'] if 'orders' in f.files else None,
+                                  f['rdp'] if 'rdp' in f.files else None)
+    with open(path) as f:
+        record=json.load(f)
+    return PrivacyProfile(record['config'],_array(record['delta']),
+                          {method:_array(eps) for method,eps in record['eps'].items()},
+                          record['mu'],_array(record['orders']),_array(record['rdp']))
+
+def _array(values):
+    return None if values is None else np.asarray(values,dtype=float)
+
+
+def main(unused_argv):
+    FLAGS=flags.FLAGS
+    profile=privacy_profile(FLAGS.epochs,FLAGS.noise_multiplier,FLAGS.N,
+                            FLAGS.batch_size,np.logspace(FLAGS.min_log_delta,FLAGS.max_log_delta,
+                                                         FLAGS.points),
+                            FLAGS.subsampling,FLAGS.methods)
+    save_profile(profile,FLAGS.output)
+    print('Wrote the profile at %d deltas to %s' % (len(profile.delta),FLAGS.output))
+
+
+if __name__ == '__main__':
+    from absl import app
+    from absl import flags
+
+    flags.DEFINE_integer('N', 60000, 'Total number of examples')
+    flags.DEFINE_integer('batch_size', 256, 'Batch size')
+    flags.DEFINE_float('noise_multiplier', 1.3,
+                       'Ratio of the standard deviation to the clipping norm')
+    flags.DEFINE_float('epochs', 15, 'Number of epochs')
+    flags.DEFINE_string('subsampling', 'Poisson', 'Poisson or Uniform subsampling')
+    flags.DEFINE_list('methods', ['CLT','MA'], 'Accountants: CLT and/or MA')
+    flags.DEFINE_float('min_log_delta', -12, 'log10 of the smallest delta')
+    flags.DEFINE_float('max_log_delta', -1, 'log10 of the largest delta')
+    flags.DEFINE_integer('points', 111, 'Number of deltas, log-spaced')
+    flags.DEFINE_string('output', 'privacy_profile.json', 'Output .json or .npz')
+    app.run(main)
@@ -0,0 +1,363 @@
+r"""Hyperparameter search for DP training under a hard privacy budget.
+
+Trials are proposed by Bayesian optimization (a Gaussian process on the unit
+cube with expected improvement) and run in parallel brackets of successive
+halving: every trial of a bracket trains for min_epochs, the best 1/eta of
+them continue to eta times as many epochs, and so on up to max_epochs.
+Trials continue from their own model_dir, so a promotion only trains the
+additional epochs (see training_state.py).
+
+Privacy enters in two places:
+  * the noise multiplier is searched only where a trial trained for
+    max_epochs stays within max_mu (or max_eps at delta), so every trial
+    satisfies the constraint whichever rung it stops at;
+  * every trial touches the training data, so the released result of the
+    search composes all of them: as GDP, the tuning mu is the square root of
+    the sum of the trials' mu^2 at the epochs they actually trained.
+    Promotions that would take the tuning mu above max_tuning_mu are not
+    run, and the search stops once no trial can continue within it.
+
+Example:
+  python privacy_search.py \
+    --script=mnist_tutorial.py \
+    --N=60000 \
+    --batch_size=256 \
+    --max_mu=2 \
+    --max_tuning_mu=4 \
+    --space=learning_rate:0.05:0.5:log
+"""
+
+import json
+import math
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import optimize
+from scipy.stats import norm
+
+from accountant_cache import *
+from gdp_accountant import *
+
+
+# mu of one trial of epochs epochs
+def trial_mu(epochs,noise_multi,N,batch_size,subsampling='Poisson'):
+    if subsampling=='Poisson':
+        return compute_muP(epochs,noise_multi,N,batch_size)
+    if subsampling=='Uniform':
+        return compute_muU(epochs,noise_multi,N,batch_size)
+    raise ValueError('subsampling must be Poisson or Uniform, got %r' % subsampling)
+
+
+# Smallest noise multiplier keeping a trial of epochs epochs within max_mu
+def min_noise_multiplier(max_mu,epochs,N,batch_size,subsampling='Poisson'):
+    def f(log_sigma):
+        return trial_mu(epochs,np.exp(log_sigma),N,batch_size,subsampling)-max_mu
+    return np.exp(optimize.root_scalar(f,bracket=[np.log(0.1),np.log(1e4)],
+                                       method='brentq').root)
+
+
+class GaussianProcess(object):
+    """GP regression with an RBF kernel on the unit cube.
+
+    The length scale is picked from a small grid by marginal likelihood and
+    the signal variance is the variance of the observations.
+    """
+
+    def __init__(self,length_scales=(0.1,0.2,0.5,1.),noise=1e-3):
+        self.length_scales=length_scales
+        self.noise=noise
+
+    def fit(self,X,y):
+        self.X=np.asarray(X,dtype=float)
+        self.mean=np.mean(y)
+        self.scale=np.std(y) or 1.
+        z=(np.asarray(y,dtype=float)-self.mean)/self.scale
+        best=-np.inf
+        for length_scale in self.length_scales:
+            K=self._kernel(self.X,self.X,length_scale)+self.noise*np.eye(len(z))
+            L=np.linalg.cholesky(K)
+            alpha=np.linalg.solve(L.T,np.linalg.solve(L,z))
+            log_likelihood=-0.5*z.dot(alpha)-np.log(np.diag(L)).sum()
+            if log_likelihood>best:
+                best=log_likelihood
+                self.length_scale,self._L,self._alpha=length_scale,L,alpha
+        return self
+
+    def predict(self,X):
+        """Posterior mean and standard deviation at the rows of X."""
+        k=self._kernel(np.asarray(X,dtype=float),self.X,self.length_scale)
+        v=np.linalg.solve(self._L,k.T)
+        var=np.maximum(1.-np.sum(v**2,axis=0),1e-12)
+        return self.mean+self.scale*k.dot(self._alpha),self.scale*np.sqrt(var)
+
+    @staticmethod
+    def _kernel(A,B,length_scale):
+        d2=np.sum(A**2,1)[:,None]+np.sum(B**2,1)[None,:]-2*A.dot(B.T)
+        return np.exp(-0.5*np.maximum(d2,0.)/length_scale**2)
+
+
+def expected_improvement(mean,std,best):
+    z=(mean-best)/std
+    return (mean-best)*norm.cdf(z)+std*norm.pdf(z)
+
+
+class PrivacySearch(object):
+    """Successive halving with GP-proposed trials under a privacy budget.
+
+    objective(trial_id, config, epochs) trains trial trial_id with the
+    hyperparameters in config until it has trained epochs epochs in total
+    and returns its score (higher is better). space maps the other searched
+    hyperparameters to (low, high, log); the noise multiplier is searched
+    in [min feasible, max_noise_multiplier] on a log scale.
+    """
+
+    def __init__(self,objective,space,N,batch_size,max_epochs,max_mu,
+                 max_tuning_mu=np.inf,min_epochs=1,eta=3,parallel=4,
+                 max_noise_multiplier=10.,subsampling='Poisson',
+                 random_fraction=1/3.,seed=0):
+        self.objective=objective
+        self.N=N
+        self.batch_size=batch_size
+        self.max_epochs=max_epochs
+        self.max_mu=max_mu
+        self.max_tuning_mu=max_tuning_mu
+        self.eta=eta
+        self.parallel=parallel
+        self.subsampling=subsampling
+        self.random_fraction=random_fraction
+        self.rungs=[]
+        epochs=min_epochs
+        while epochs<max_epochs:
+            self.rungs.append(epochs)
+            epochs*=eta
+        self.rungs.append(max_epochs)
+        low=min_noise_multiplier(max_mu,max_epochs,N,batch_size,subsampling)
+        if low>=max_noise_multiplier:
+            raise ValueError('no noise multiplier up to %g keeps %d epochs within mu=%g'
+                             % (max_noise_multiplier,max_epochs,max_mu))
+        self.space=dict(space)
+        self.space['noise_multiplier']=(low,max_noise_multiplier,True)
+        self.names=sorted(self.space)
+        self.trials=[]
+        self._rng=np.random.default_rng(seed)
+
+    @property
+    def tuning_mu(self):
+        """Composed mu of all trials so far (GDP composition)."""
+        return np.sqrt(sum(self._mu(t,t['epochs'])**2 for t in self.trials))
+
+    def tuning_eps(self,delta):
+        mu=self.tuning_mu
+        return eps_from_mu(mu,delta) if mu>0 else 0.
+
+    def best(self):
+        scored=[t for t in self.trials if t['epochs']==self.max_epochs] or self.trials
+        return max(scored,key=lambda t:t['score'])
+
+    def run(self,brackets=1):
+        """Runs brackets of successive halving; returns the best trial."""
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            for _ in range(brackets):
+                if not self._run_bracket(executor):
+                    break
+        return self.best()
+
+    def _run_bracket(self,executor):
+        n=self.eta**(len(self.rungs)-1)
+        alive=[]
+        for config in self._propose(n):
+            trial={'id':len(self.trials),'config':config,'epochs':0,
+                   'score':-np.inf,'history':{}}
+            self.trials.append(trial)
+            alive.append(trial)
+        for epochs in self.rungs:
+            alive=self._affordable(alive,epochs)
+            if not alive:
+                return False
+            futures=[executor.submit(self.objective,t['id'],t['config'],epochs) for t in alive]
+            for trial,future in zip(alive,futures):
+                trial['epochs']=epochs
+                trial['score']=float(future.result())
+                trial['history'][epochs]=trial['score']
+            alive.sort(key=lambda t:t['score'],reverse=True)
+            alive=alive[:max(1,len(alive)//self.eta)]
+        return True
+
+    def _affordable(self,trials,epochs):
+        """The best trials whose promotion to epochs fits the tuning budget."""
+        spent=self.tuning_mu**2
+        kept=[]
+        for t in trials:
+            extra=self._mu(t,epochs)**2-self._mu(t,t['epochs'])**2
+            if spent+extra<=self.max_tuning_mu**2:
+                spent+=extra
+                kept.append(t)
+        return kept
+
+    def _mu(self,trial,epochs):
+        if epochs==0:
+            return 0.
+        return trial_mu(epochs,trial['config']['noise_multiplier'],self.N,
+                        self.batch_size,self.subsampling)
+
+    def _propose(self,n):
+        """n configurations: random ones plus the best by expected improvement."""
+        num_random=n
+        observed=self._observations()
+        if observed is not None:
+            num_random=int(math.ceil(self.random_fraction*n))
+        configs=[self._decode(u) for u in self._rng.random((num_random,len(self.names)))]
+        if num_random<n:
+            X,y=observed
+            gp=GaussianProcess().fit(X,y)
+            candidates=self._rng.random((100*n,len(self.names)))
+            mean,std=gp.predict(candidates)
+            ei=expected_improvement(mean,std,np.max(y))
+            for i in np.argsort(-ei)[:n-num_random]:
+                configs.append(self._decode(candidates[i]))
+        return configs
+
+    def _observations(self):
+        """Scores at the largest rung with enough trials to fit the GP."""
+        for epochs in reversed(self.rungs):
+            done=[t for t in self.trials if epochs in t['history']
+                  and np.isfinite(t['history'][epochs])]
+            if len(done)>=len(self.names)+2:
+                return (np.array([self._encode(t['config']) for t in done]),
+                        np.array([t['history'][epochs] for t in done]))
+        return None
+
+    def _decode(self,u):
+        config={}
+        for name,x in zip(self.names,u):
+            low,high,log=self.space[name]
+            config[name]=float(np.exp(np.log(low)+x*np.log(high/low)) if log
+                               else low+x*(high-low))
+        return config
+
+    def _encode(self,config):
+        u=[]
+        for name in self.names:
+            low,high,log=self.space[name]
+            value=config[name]
+            u.append(np.log(value/low)/np.log(high/low) if log
+                     else (value-low)/(high-low))
+        return u
+
+
+class TutorialObjective(object):
+    """Runs a tutorial script as a trial and reads its last reported score.
+
+    Each trial trains in workdir/trial_<id>; a promoted trial reruns the
+    script with more epochs and resumes from its checkpoint. The score is
+    the metric of the last epoch snapshot the tutorial wrote to
+    training_state.jsonl, negated if minimize (e.g. the MovieLens RMSE).
+    Trials share the accountant results in accountant_cache, an SQLite file
+    (see accountant_cache.py), unless it is None.
+    """
+
+    def __init__(self,script,workdir,metric='accuracy',minimize=False,
+                 max_mu=np.inf,extra_flags=(),accountant_cache=None):
+        self.script=script
+        self.workdir=workdir
+        self.metric=metric
+        self.minimize=minimize
+        self.max_mu=max_mu
+        self.extra_flags=list(extra_flags)
+        self.env=dict(os.environ)
+        if accountant_cache:
+            self.env[ACCOUNTANT_CACHE_ENV]=os.path.abspath(accountant_cache)
+
+    def __call__(self,trial_id,config,epochs):
+        model_dir=os.path.join(self.workdir,'trial_%d' % trial_id)
+        command=[sys.executable,self.script,'--epochs=%d' % epochs,
+                 '--model_dir=%s' % model_dir,'--max_mu=%r' % self.max_mu]
+        command+=['--%s=%r' % (name,value) for name,value in sorted(config.items())]
+        with open(os.path.join(self.workdir,'trial_%d.log' % trial_id),'ab') as log:
+            returncode=subprocess.call(command+self.extra_flags,stdout=log,stderr=log,
+                                       env=self.env)
+        score=self._last_score(model_dir) if returncode==0 else None
+        if score is None:
+            return -np.inf
+        return -score if self.minimize else score
+
+    def _last_score(self,model_dir):
+        # Snapshots written by training_state.TrainingState, one JSON per line
+        path=os.path.join(model_dir,'training_state.jsonl')
+        if not os.path.exists(path):
+            return None
+        score=None
+        with open(path) as f:
+            for line in f:
+                try:
+                    score=json.loads(line).get(self.metric,score)
+                except ValueError:
+                    break
+        return score
+
+
+def _parse_space(entries):
+    space={}
+    for entry in entries:
+        name,low,high,scale=entry.split(':')
+        space[name]=(float(low),float(high),scale=='log')
+    return space
+
+
+def main(unused_argv):
+    FLAGS=flags.FLAGS
+    max_mu=FLAGS.max_mu
+    if FLAGS.max_eps is not None:
+        max_mu=mu_from_eps(FLAGS.max_eps,FLAGS.delta)
+    os.makedirs(FLAGS.workdir,exist_ok=True)
+    cache=FLAGS.accountant_cache and os.path.join(FLAGS.workdir,FLAGS.accountant_cache)
+    objective=TutorialObjective(FLAGS.script,FLAGS.workdir,FLAGS.metric,
+                                FLAGS.minimize,max_mu,accountant_cache=cache)
+    search=PrivacySearch(objective,_parse_space(FLAGS.space),FLAGS.N,
+                         FLAGS.batch_size,FLAGS.max_epochs,max_mu,
+                         FLAGS.max_tuning_mu,FLAGS.min_epochs,FLAGS.eta,
+                         FLAGS.parallel,FLAGS.max_noise_multiplier,
+                         FLAGS.subsampling,seed=FLAGS.seed)
+    best=search.run(FLAGS.brackets)
+    for t in search.trials:
+        print('trial %3d  %s  epochs %3d  score %.4f' %
+              (t['id'],json.dumps(t['config'],sort_keys=True),t['epochs'],t['score']))
+    print('Best trial %d: %s, score %.4f after %d epochs' %
+          (best['id'],json.dumps(best['config'],sort_keys=True),best['score'],best['epochs']))
+    print('Each trial is within %.3f-GDP; the whole search is %.3f-GDP, '
+          'i.e. (%.3f, %g)-DP' % (max_mu,search.tuning_mu,
+                                  search.tuning_eps(FLAGS.delta),FLAGS.delta))
+
+
+if __name__ == '__main__':
+    from absl import app
+    from absl import flags
+
+    flags.DEFINE_string('script', 'mnist_tutorial.py', 'Tutorial run by each trial')
+    flags.DEFINE_string('workdir', 'privacy_search', 'Directory of the trials')
+    flags.DEFINE_list('space', ['learning_rate:0.05:0.5:log'],
+                      'Searched flags besides noise_multiplier, as name:low:high:log|linear')
+    flags.DEFINE_string('metric', 'accuracy', 'Score reported by the tutorial')
+    flags.DEFINE_boolean('minimize', False, 'Minimize the metric (e.g. RMSE)')
+    flags.DEFINE_integer('N', 60000, 'Total number of examples')
+    flags.DEFINE_integer('batch_size', 256, 'Batch size of the tutorial')
+    flags.DEFINE_string('subsampling', 'Poisson', 'Poisson or Uniform subsampling')
+    flags.DEFINE_float('max_mu', 2, 'Per-trial budget')
+    flags.DEFINE_float('max_eps', None, 'Per-trial budget as epsilon at delta; '
+                       'overrides max_mu')
+    flags.DEFINE_float('delta', 1e-5, 'Target delta')
+    flags.DEFINE_float('max_tuning_mu', np.inf, 'Budget of the whole search')
+    flags.DEFINE_float('max_noise_multiplier', 10., 'Largest noise multiplier searched')
+    flags.DEFINE_integer('min_epochs', 1, 'Epochs of the first rung')
+    flags.DEFINE_integer('max_epochs', 9, 'Epochs of the last rung')
+    flags.DEFINE_integer('eta', 3, 'Halving rate of successive halving')
+    flags.DEFINE_integer('brackets', 3, 'Brackets of successive halving')
+    flags.DEFINE_integer('parallel', 4, 'Trials trained at the same time')
+    flags.DEFINE_integer('seed', 0, 'Seed of the search')
+    flags.DEFINE_string('accountant_cache', 'accountant_cache.sqlite',
+                        'Accountant cache shared by the trials, in workdir; '
+                        'empty to disable')
+    app.run(main)
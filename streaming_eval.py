@@ -0,0 +1,240 @@
+r"""Evaluation over memory-mapped test sets, in bounded memory.
+
+Estimator.evaluate on an array_input_fn needs the whole test set in memory,
+and tf.compat.v1.metrics accumulate in float32. A StreamingEvaluator reads
+the test set instead from a directory of .npy columns (save_columns), memory
+mapped, one chunk of chunk_size rows at a time: the model's PREDICT branch
+maps a chunk to predictions and the metrics are updated on the host, so
+memory holds one chunk whatever the size of the test set. The metrics
+reduce exactly where they can: counts are integers, and sums of squared
+errors are taken in float64 by math.fsum, correctly rounded within each
+chunk, and the chunk sums are added by math.fsum again.
+
+With process=True the evaluation runs in a worker process (started with
+spawn, so TF is never forked), and submit() returns at once: the snapshot
+of one epoch is evaluated while the next one trains. AsyncEvaluator does
+the same for any evaluation function on a thread, and hands the results
+back tagged with their epoch. The worker builds its
+own Estimator from estimator_fn, so this must be picklable, e.g. a
+functools.partial of tf.estimator.Estimator with a module-level model_fn.
+
+Example:
+  save_columns('data/test', user=test[:, 0], movie=test[:, 1],
+               rating=test[:, 2])
+  evaluator = StreamingEvaluator(estimator_fn, 'data/test', ['user', 'movie'],
+                                 'rating', [RootMeanSquaredError('rating')])
+  evaluator.evaluate(tf.train.latest_checkpoint(model_dir))['rmse']
+"""
+
+import math
+import multiprocessing
+import os
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+
+def save_columns(path, **columns):
+  """Writes each column to path/<name>.npy, loadable memory mapped."""
+  os.makedirs(path, exist_ok=True)
+  for name, column in columns.items():
+    np.save(os.path.join(path, name + '.npy'), np.asarray(column))
+
+
+def load_columns(path, names):
+  """The columns of save_columns, memory mapped read-only."""
+  return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+          for name in names}
+
+
+def chunk_input_fn(path, features, chunk_size=65536):
+  """input_fn yielding the feature columns of path in chunks of rows."""
+  def input_fn():
+    columns = load_columns(path, features)
+    rows = len(columns[features[0]])
+
+    def chunks():
+      for start in range(0, rows, chunk_size):
+        yield {name: np.asarray(column[start:start + chunk_size])
+               for name, column in columns.items()}
+
+    return tf.data.Dataset.from_generator(
+        chunks,
+        {name: tf.as_dtype(column.dtype) for name, column in columns.items()},
+        {name: tf.TensorShape([None] + list(column.shape[1:]))
+         for name, column in columns.items()}).prefetch(1)
+  return input_fn
+
+
+class Accuracy(object):
+  """Fraction of predictions equal to the labels, from integer counts."""
+
+  name = 'accuracy'
+
+  def __init__(self, key='classes'):
+    self.key = key
+    self.correct = 0
+    self.count = 0
+
+  def update(self, predictions, labels):
+    self.correct += int(np.count_nonzero(predictions[self.key] == labels))
+    self.count += len(labels)
+
+  def result(self):
+    return self.correct / self.count
+
+
+class RootMeanSquaredError(object):
+  """RMSE of predictions[key], from float64 sums correctly rounded by chunk."""
+
+  name = 'rmse'
+
+  def __init__(self, key='predictions'):
+    self.key = key
+    self.sums = []
+    self.count = 0
+
+  def update(self, predictions, labels):
+    errors = (np.asarray(predictions[self.key], np.float64) -
+              np.asarray(labels, np.float64))
+    self.sums.append(math.fsum(np.square(errors)))
+    self.count += len(labels)
+
+  def result(self):
+    return math.sqrt(math.fsum(self.sums) / self.count)
+
+
+def stream_evaluate(estimator, path, features, label, metrics,
+                    checkpoint_path=None, chunk_size=65536):
+  """Updates metrics over the test set at path; returns {name: result}."""
+  labels = load_columns(path, [label])[label]
+  start = 0
+  for predictions in estimator.predict(
+      chunk_input_fn(path, features, chunk_size),
+      checkpoint_path=checkpoint_path, yield_single_examples=False):
+    rows = len(next(iter(predictions.values())))
+    chunk_labels = np.asarray(labels[start:start + rows])
+    for metric in metrics:
+      metric.update(predictions, chunk_labels)
+    start += rows
+  if start != len(labels):
+    raise ValueError('predicted %d rows of %d' % (start, len(labels)))
+  return {metric.name: metric.result() for metric in metrics}
+
+
+class StreamingEvaluator(object):
+  """Evaluates checkpoints over a test set on disk, here or in a process."""
+
+  def __init__(self, estimator_fn, path, features, label, metrics,
+               chunk_size=65536, process=False):
+    self._estimator_fn = estimator_fn
+    self._args = (path, list(features), label, list(metrics), chunk_size)
+    self._estimator = None
+    self._executor = None
+    if process:
+      self._executor = ProcessPoolExecutor(
+          1, mp_context=multiprocessing.get_context('spawn'),
+          initializer=_init_worker, initargs=(sys.argv,))
+
+  def evaluate(self, checkpoint_path=None):
+    """Metrics of a checkpoint (default: the latest), computed now."""
+    if self._executor is not None:
+      return self.submit(checkpoint_path).result()
+    if self._estimator is None:
+      self._estimator = self._estimator_fn()
+    return _evaluate(self._estimator, checkpoint_path, *self._args)
+
+  def submit(self, checkpoint_path=None):
+    """Future of the metrics, computed in the worker process if any.
+
+    Pass an explicit checkpoint: the latest one moves on with training.
+    """
+    if self._executor is None:
+      raise ValueError('submit() needs a StreamingEvaluator with process=True')
+    return self._executor.submit(_evaluate_in_worker, self._estimator_fn,
+                                 checkpoint_path, *self._args)
+
+  def close(self):
+    if self._executor is not None:
+      self._executor.shutdown(wait=True)
+
+
+class AsyncEvaluator(object):
+  """Evaluates epoch checkpoints in the background, reporting by epoch.
+
+  evaluate maps a checkpoint path to a dict of metrics and runs on workers
+  threads, or in submit() itself with workers=0. Estimator.evaluate builds
+  its own graph and session, so it can run while train() does. An epoch
+  whose checkpoint could not be read, e.g. deleted by the Estimator before
+  its evaluation started, is logged and left out of the results.
+  """
+
+  def __init__(self, evaluate, workers=1):
+    self._evaluate = evaluate
+    self._executor = ThreadPoolExecutor(workers) if workers else None
+    self._pending = []
+
+  def submit(self, epoch, checkpoint_path):
+    """Starts evaluating the checkpoint written at the end of epoch."""
+    if self._executor is None:
+      future = Future()
+      future.set_result(self._evaluate(checkpoint_path))
+    else:
+      future = self._executor.submit(self._evaluate, checkpoint_path)
+    self._pending.append((epoch, future))
+
+  def completed(self):
+    """(epoch, metrics) of the evaluations done so far, in epoch order."""
+    done = []
+    while self._pending and self._pending[0][1].done():
+      epoch, future = self._pending.pop(0)
+      done += self._result(epoch, future)
+    return done
+
+  def drain(self):
+    """Waits for the pending evaluations; returns them like completed()."""
+    done = []
+    for epoch, future in self._pending:
+      done += self._result(epoch, future)
+    self._pending = []
+    return done
+
+  def _result(self, epoch, future):
+    # A missing checkpoint costs the epoch its metrics, not the training
+    try:
+      return [(epoch, future.result())]
+    except (ValueError, tf.errors.NotFoundError) as e:
+      tf.compat.v1.logging.error('Evaluation of epoch %d failed: %s', epoch, e)
+      return []
+
+  def close(self):
+    if self._executor is not None:
+      self._executor.shutdown(wait=True)
+
+
+def _evaluate(estimator, checkpoint_path, path, features, label, metrics,
+              chunk_size):
+  # Fresh metrics for every evaluation
+  metrics = [type(metric)(metric.key) for metric in metrics]
+  return stream_evaluate(estimator, path, features, label, metrics,
+                         checkpoint_path, chunk_size)
+
+
+_worker_estimator = None
+
+
+def _init_worker(argv):
+  # The tutorials' model_fn read absl flags, which the spawned worker has
+  # defined (on importing the main module) but not parsed
+  from absl import flags
+  if not flags.FLAGS.is_parsed():
+    flags.FLAGS(argv, known_only=True)
+
+
+def _evaluate_in_worker(estimator_fn, checkpoint_path, *args):
+  global _worker_estimator
+  if _worker_estimator is None:
+    _worker_estimator = estimator_fn()
+  return _evaluate(_worker_estimator, checkpoint_path, *args)
@@ -0,0 +1,133 @@
+r"""Resumable DP training: run snapshots next to the Estimator checkpoints.
+
+A pre-empted Estimator restarts from the last checkpoint in model_dir, but a
+tutorial loop restarted from epoch 1 would account only for the steps taken
+after the restart and under-report the privacy spent. The global step stored
+in the checkpoint already determines the exact resume point:
+
+  * the accountants only need the number of steps composed, since
+    compute_muP/compute_epsP/compute_epsilon take fractional epochs;
+  * the RNG state is the counter of the dp_random streams, i.e. (seed,
+    global step): the shuffling order of the current epoch is regenerated and
+    its finished batches skipped, and the DP noise of a step is keyed by the
+    global step, so replaying a step lost after the last checkpoint adds the
+    very same noise and releases nothing new.
+
+TrainingState keeps the rest in model_dir/training_state.jsonl: the run
+configuration (seed, noise multiplier, sampling, dataset size, so a resume
+with different settings is refused) and the epoch snapshots: one with the
+global step and spent mu when the epoch has trained, and one with its test
+metrics when its evaluation is done, which with asynchronous evaluation
+may be after later epochs have trained. Snapshots are appended as single JSON
+lines by a background thread, so writing one costs the training loop
+nothing, and a line cut short by a crash is dropped on the next start. The
+model weights are the Estimator's own checkpoints; the privacy ledger is
+durable on its own (privacy_ledger.py) and is only written by finished runs.
+
+Example:
+  state = TrainingState(classifier.model_dir, config)
+  epoch, skip = state.resume(checkpoint_step(classifier.model_dir),
+                             steps_per_epoch)
+  ...
+  state.snapshot(epoch=epoch, global_step=global_step, mu=mu)
+  state.snapshot(epoch=epoch, accuracy=acc)
+  state.close()
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import tensorflow as tf
+
+STATE_FILE = 'training_state.jsonl'
+
+
+def checkpoint_step(model_dir):
+  """Global step of the latest checkpoint in model_dir (0 if there is none)."""
+  path = tf.train.latest_checkpoint(model_dir)
+  if path is None:
+    return 0
+  return int(tf.train.load_variable(path, 'global_step'))
+
+
+class TrainingState(object):
+  """Run configuration and per-epoch snapshots of a resumable training run."""
+
+  def __init__(self, model_dir, config):
+    self.config = dict(config)
+    self.path = os.path.join(model_dir, STATE_FILE)
+    self.history = []
+    os.makedirs(model_dir, exist_ok=True)
+    if os.path.exists(self.path):
+      self._load()
+    self._executor = ThreadPoolExecutor(max_workers=1)
+    if not self.history:
+      self._write({'config': self.config})
+
+  @property
+  def last(self):
+    """Latest epoch snapshot, or None before the first one."""
+    return self.history[-1] if self.history else None
+
+  def values(self, key):
+    """The value of key in every snapshot having it, e.g. the accuracies."""
+    return [record[key] for record in self.history if key in record]
+
+  def exhausted(self, max_mu):
+    """Whether the last snapshot with a mu already spent more than max_mu."""
+    mus = self.values('mu')
+    return bool(mus) and mus[-1] is not None and mus[-1] > max_mu
+
+  def resume(self, global_step, steps_per_epoch):
+    """(completed epochs, finished steps of the next one) at global_step."""
+    return divmod(global_step, steps_per_epoch)
+
+  def snapshot(self, **state):
+    """Appends an epoch snapshot in the background; returns its future."""
+    record = {key: _plain(value) for key, value in state.items()}
+    self.history.append(record)
+    return self._executor.submit(self._append, record)
+
+  def close(self):
+    """Waits until every snapshot is on disk."""
+    self._executor.shutdown(wait=True)
+
+  def _write(self, record):
+    with open(self.path, 'w') as f:
+      f.write(json.dumps(record) + '\n')
+      f.flush()
+      os.fsync(f.fileno())
+
+  def _append(self, record):
+    with open(self.path, 'a') as f:
+      f.write(json.dumps(record) + '\n')
+      f.flush()
+      os.fsync(f.fileno())
+
+  def _load(self):
+    with open(self.path, 'rb') as f:
+      lines = f.read().split(b'\n')
+    records, size = [], 0
+    # A line without its newline was cut short; it and anything after it
+    # are dropped.
+    for line in lines[:-1]:
+      try:
+        records.append(json.loads(line))
+      except ValueError:
+        break
+      size += len(line) + 1
+    if size < sum(len(line) + 1 for line in lines) - 1:
+      with open(self.path, 'r+b') as f:
+        f.truncate(size)
+    if not records:
+      return
+    if records[0].get('config') != self.config:
+      raise ValueError('%s belongs to a run with config %r, not %r' %
+                       (self.path, records[0].get('config'), self.config))
+    self.history = records[1:]
+
+
+def _plain(value):
+  """JSON-serializable copy of numpy scalars."""
+  return value.item() if hasattr(value, 'item') else value